@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import copy
+import threading
 import time
 
 from elasticsearch import Elasticsearch
@@ -7,15 +8,30 @@ from elasticsearch import RequestsHttpConnection
 from elasticsearch.client import _make_path
 from elasticsearch.client import query_params
 from elasticsearch.exceptions import TransportError
+from requests.adapters import HTTPAdapter
+
+from elastalert.governor import get_governor
+from elastalert.governor import GovernedConnection
+from elastalert.serializer import get_serializer
 
 
 class ElasticSearchClient(Elasticsearch):
     """ Extension of low level :class:`Elasticsearch` client with additional version resolving features """
 
+    # The versions of the clusters probed by any client, by es_host, es_port and es_url_prefix
+    es_versions = {}
+    es_versions_lock = threading.Lock()
+
     def __init__(self, conf):
         """
         :arg conf: es_conn_config dictionary. Ref. :func:`~util.build_es_conn_config`
         """
+        connection_args = {'connection_class': RequestsHttpConnection}
+        if conf.get('es_concurrency_governor'):
+            governor = get_governor((conf['es_host'], conf['es_port'], conf['es_url_prefix']),
+                                    max_limit=conf['es_max_concurrency'], latency_target=conf['es_target_latency'])
+            connection_args = {'connection_class': GovernedConnection, 'governor': governor,
+                               'max_rejection_retries': conf['es_max_rejection_retries']}
         super(ElasticSearchClient, self).__init__(host=conf['es_host'],
                                                   port=conf['es_port'],
                                                   url_prefix=conf['es_url_prefix'],
@@ -23,16 +39,25 @@ class ElasticSearchClient(Elasticsearch):
                                                   verify_certs=conf['verify_certs'],
                                                   ca_certs=conf['ca_certs'],
                                                   ssl_show_warn=conf['ssl_show_warn'],
-                                                  connection_class=RequestsHttpConnection,
                                                   http_auth=conf['http_auth'],
                                                   headers=conf['headers'],
                                                   timeout=conf['es_conn_timeout'],
                                                   send_get_body_as=conf['send_get_body_as'],
                                                   client_cert=conf['client_cert'],
-                                                  client_key=conf['client_key'])
+                                                  client_key=conf['client_key'],
+                                                  serializer=get_serializer(conf.get('json_serializer')),
+                                                  **connection_args)
         self._conf = copy.copy(conf)
         self._es_version = None
 
+        # Keep a pooled connection for each thread which may share this client
+        pool_maxsize = conf.get('es_pool_maxsize')
+        if pool_maxsize:
+            for connection in self.transport.connection_pool.connections:
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+                connection.session.mount('http://', adapter)
+                connection.session.mount('https://', adapter)
+
     @property
     def conf(self):
         """
@@ -46,14 +71,20 @@ class ElasticSearchClient(Elasticsearch):
         Returns the reported version from the Elasticsearch server.
         """
         if self._es_version is None:
-            for retry in range(3):
-                try:
-                    self._es_version = self.info()['version']['number']
-                    break
-                except TransportError:
-                    if retry == 2:
-                        raise
-                    time.sleep(3)
+            # Every client of a cluster shares the version the first one probed
+            cluster = (str(self._conf['es_host']).strip().lower(), self._conf['es_port'], self._conf['es_url_prefix'].strip('/'))
+            self._es_version = ElasticSearchClient.es_versions.get(cluster)
+            if self._es_version is None:
+                for retry in range(3):
+                    try:
+                        self._es_version = self.info()['version']['number']
+                        break
+                    except TransportError:
+                        if retry == 2:
+                            raise
+                        time.sleep(3)
+                with ElasticSearchClient.es_versions_lock:
+                    ElasticSearchClient.es_versions[cluster] = self._es_version
         return self._es_version
 
     def is_atleastfive(self):
@@ -75,6 +106,13 @@ class ElasticSearchClient(Elasticsearch):
         major, minor = list(map(int, self.es_version.split(".")[:2]))
         return major > 6 or (major == 6 and minor >= 2)
 
+    def is_atleastsixthree(self):
+        """
+        Returns True when the Elasticsearch server version >= 6.3
+        """
+        major, minor = list(map(int, self.es_version.split(".")[:2]))
+        return major > 6 or (major == 6 and minor >= 3)
+
     def is_atleastsixsix(self):
         """
         Returns True when the Elasticsearch server version >= 6.6
@@ -88,6 +126,13 @@ class ElasticSearchClient(Elasticsearch):
         """
         return int(self.es_version.split(".")[0]) >= 7
 
+    def is_atleastseventen(self):
+        """
+        Returns True when the Elasticsearch server version >= 7.10
+        """
+        major, minor = list(map(int, self.es_version.split(".")[:2]))
+        return major > 7 or (major == 7 and minor >= 10)
+
     def resolve_writeback_index(self, writeback_index, doc_type):
         """ In ES6, you cannot have multiple _types per index,
         therefore we use self.writeback_index as the prefix for the actual
@@ -102,6 +147,10 @@ class ElasticSearchClient(Elasticsearch):
             return writeback_index + '_status'
         elif doc_type == 'elastalert_error':
             return writeback_index + '_error'
+        elif doc_type == 'elastalert_heartbeat':
+            return writeback_index + '_heartbeat'
+        elif doc_type == 'elastalert_checkpoint':
+            return writeback_index + '_checkpoint'
         return writeback_index
 
     @query_params(
@@ -257,3 +306,34 @@ class ElasticSearchClient(Elasticsearch):
         if type(res) == list or type(res) == tuple:
             return res[1]
         return res
+
+    @query_params("expand_wildcards", "ignore_unavailable", "keep_alive", "preference", "routing")
+    def open_point_in_time(self, index=None, params=None):
+        """
+        Open a point in time that can be used in subsequent searches.
+        `<https://www.elastic.co/guide/en/elasticsearch/reference/7.10/point-in-time-api.html>`_
+        :arg index: A comma-separated list of index names to open point in time
+        :arg expand_wildcards: Whether to expand wildcard expression to concrete
+            indices that are open, closed or both., default 'open', valid
+            choices are: 'open', 'closed', 'hidden', 'none', 'all'
+        :arg ignore_unavailable: Whether specified concrete indices should be
+            ignored when unavailable (missing or closed)
+        :arg keep_alive: Specific the time to live for the point in time
+        :arg preference: Specify the node or shard the operation should be
+            performed on (default: random)
+        :arg routing: Specific routing value
+        """
+        return self.transport.perform_request(
+            "POST", _make_path(index, "_pit"), params=params
+        )
+
+    @query_params()
+    def close_point_in_time(self, body=None, params=None):
+        """
+        Close a point in time
+        `<https://www.elastic.co/guide/en/elasticsearch/reference/7.10/point-in-time-api.html>`_
+        :arg body: a point-in-time id to close
+        """
+        return self.transport.perform_request(
+            "DELETE", "/_pit", params=params, body=body
+        )
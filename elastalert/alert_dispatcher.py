@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import collections
+import queue
+import threading
+import time
+
+from elastalert.util import elastalert_logger
+
+
+class AlertDispatcher(object):
+    """ Sends alerts from a bounded queue in a pool of worker threads, so that rules can go on to their next query
+    while slow alerters deliver. Once the queue is full, dispatch waits for room in it.
+
+    :param send: Called with (matches, rule, current_es) in a worker thread to send each alert. Returns the number of
+        alerters which sent it.
+    :param workers: The number of worker threads.
+    :param queue_size: The number of alerts which may wait in the queue.
+    """
+
+    def __init__(self, send, workers=4, queue_size=1000):
+        self.send = send
+        self.queue = queue.Queue(maxsize=queue_size)
+        # rule name: the number of alerts sent since it was last popped
+        self.sent = collections.Counter()
+        self.sent_lock = threading.Lock()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.run, name='elastalert-alert-dispatch-%d' % i, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def dispatch(self, matches, rule, current_es=None):
+        """ Queues an alert, waiting for room in the queue if it is full. """
+        try:
+            self.queue.put_nowait((matches, rule, current_es))
+        except queue.Full:
+            elastalert_logger.warning('Alert dispatch queue is full, waiting to queue alert for rule %s' % (rule['name']))
+            self.queue.put((matches, rule, current_es))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                matches, rule, current_es = item
+                sent = self.send(matches, rule, current_es)
+                if sent:
+                    with self.sent_lock:
+                        self.sent[rule['name']] += sent
+            except Exception:
+                elastalert_logger.exception('Error dispatching alert')
+            finally:
+                self.queue.task_done()
+
+    def pop_sent(self, name):
+        """ Returns the number of alerts of the rule named name which were sent since the last call. """
+        with self.sent_lock:
+            return self.sent.pop(name, 0)
+
+    def join(self):
+        """ Waits until every queued alert has been sent. """
+        self.queue.join()
+
+    def shutdown(self, timeout=None):
+        """ Sends the queued alerts and stops the worker threads. With a timeout, stops waiting for them after timeout
+        seconds, and returns the (matches, rule) of the alerts which were still queued then. """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else max(deadline - time.monotonic(), 0)
+        try:
+            for _ in self.threads:
+                self.queue.put(None, timeout=remaining())
+        except queue.Full:
+            pass
+        for thread in self.threads:
+            thread.join(remaining())
+        self.threads = []
+
+        unsent = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                matches, rule, _ = item
+                unsent.append((matches, rule))
+            self.queue.task_done()
+        return unsent
@@ -5,15 +5,16 @@ import os
 
 from texttable import Texttable
 
+from elastalert.serializer import json_default
 from elastalert.util import EAException, lookup_es_key
 from elastalert.yaml import read_yaml
 
 
 class DateTimeEncoder(json.JSONEncoder):
     def default(self, obj):
-        if hasattr(obj, 'isoformat'):
-            return obj.isoformat()
-        else:
+        try:
+            return json_default(obj)
+        except TypeError:
             return json.JSONEncoder.default(self, obj)
 
 
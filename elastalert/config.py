@@ -76,6 +76,7 @@ def load_conf(args, defaults=None, overwrites=None):
     conf.setdefault('disable_rules_on_error', True)
     conf.setdefault('scan_subdirectories', True)
     conf.setdefault('rules_loader', 'file')
+    conf.setdefault('worker_processes', 1)
 
     # Convert run_every, buffer_time into a timedelta object
     try:
@@ -89,6 +90,10 @@ def load_conf(args, defaults=None, overwrites=None):
             conf['old_query_limit'] = datetime.timedelta(**conf['old_query_limit'])
         else:
             conf['old_query_limit'] = datetime.timedelta(weeks=1)
+        if 'silence_cache_ttl' in conf:
+            conf['silence_cache_ttl'] = datetime.timedelta(**conf['silence_cache_ttl'])
+        else:
+            conf['silence_cache_ttl'] = datetime.timedelta(days=1)
     except (KeyError, TypeError) as e:
         raise EAException('Invalid time format used: %s' % e)
 
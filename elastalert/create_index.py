@@ -39,6 +39,8 @@ def create_index_mappings(es_client, ea_index, recreate=False, old_ea_index=None
             ea_index + '_silence',
             ea_index + '_error',
             ea_index + '_past',
+            ea_index + '_heartbeat',
+            ea_index + '_checkpoint',
         )
     else:
         index_names = (
@@ -70,6 +72,10 @@ def create_index_mappings(es_client, ea_index, recreate=False, old_ea_index=None
                                       body=es_index_mappings['elastalert_error'], include_type_name=True)
         es_client.indices.put_mapping(index=ea_index + '_past', doc_type='_doc',
                                       body=es_index_mappings['past_elastalert'], include_type_name=True)
+        es_client.indices.put_mapping(index=ea_index + '_heartbeat', doc_type='_doc',
+                                      body=es_index_mappings['elastalert_heartbeat'], include_type_name=True)
+        es_client.indices.put_mapping(index=ea_index + '_checkpoint', doc_type='_doc',
+                                      body=es_index_mappings['elastalert_checkpoint'], include_type_name=True)
     elif is_atleastsixtwo(esversion):
         es_client.indices.put_mapping(index=ea_index, doc_type='_doc',
                                       body=es_index_mappings['elastalert'])
@@ -81,6 +87,10 @@ def create_index_mappings(es_client, ea_index, recreate=False, old_ea_index=None
                                       body=es_index_mappings['elastalert_error'])
         es_client.indices.put_mapping(index=ea_index + '_past', doc_type='_doc',
                                       body=es_index_mappings['past_elastalert'])
+        es_client.indices.put_mapping(index=ea_index + '_heartbeat', doc_type='_doc',
+                                      body=es_index_mappings['elastalert_heartbeat'])
+        es_client.indices.put_mapping(index=ea_index + '_checkpoint', doc_type='_doc',
+                                      body=es_index_mappings['elastalert_checkpoint'])
     elif is_atleastsix(esversion):
         es_client.indices.put_mapping(index=ea_index, doc_type='elastalert',
                                       body=es_index_mappings['elastalert'])
@@ -92,6 +102,10 @@ def create_index_mappings(es_client, ea_index, recreate=False, old_ea_index=None
                                       body=es_index_mappings['elastalert_error'])
         es_client.indices.put_mapping(index=ea_index + '_past', doc_type='past_elastalert',
                                       body=es_index_mappings['past_elastalert'])
+        es_client.indices.put_mapping(index=ea_index + '_heartbeat', doc_type='elastalert_heartbeat',
+                                      body=es_index_mappings['elastalert_heartbeat'])
+        es_client.indices.put_mapping(index=ea_index + '_checkpoint', doc_type='elastalert_checkpoint',
+                                      body=es_index_mappings['elastalert_checkpoint'])
     else:
         es_client.indices.put_mapping(index=ea_index, doc_type='elastalert',
                                       body=es_index_mappings['elastalert'])
@@ -103,6 +117,10 @@ def create_index_mappings(es_client, ea_index, recreate=False, old_ea_index=None
                                       body=es_index_mappings['elastalert_error'])
         es_client.indices.put_mapping(index=ea_index, doc_type='past_elastalert',
                                       body=es_index_mappings['past_elastalert'])
+        es_client.indices.put_mapping(index=ea_index, doc_type='elastalert_heartbeat',
+                                      body=es_index_mappings['elastalert_heartbeat'])
+        es_client.indices.put_mapping(index=ea_index, doc_type='elastalert_checkpoint',
+                                      body=es_index_mappings['elastalert_checkpoint'])
 
     print('New index %s created' % ea_index)
     if old_ea_index:
@@ -120,7 +138,9 @@ def read_es_index_mappings(es_version=6):
         'elastalert_status': read_es_index_mapping('elastalert_status', es_version),
         'elastalert': read_es_index_mapping('elastalert', es_version),
         'past_elastalert': read_es_index_mapping('past_elastalert', es_version),
-        'elastalert_error': read_es_index_mapping('elastalert_error', es_version)
+        'elastalert_error': read_es_index_mapping('elastalert_error', es_version),
+        'elastalert_heartbeat': read_es_index_mapping('elastalert_heartbeat', es_version),
+        'elastalert_checkpoint': read_es_index_mapping('elastalert_checkpoint', es_version)
     }
 
 
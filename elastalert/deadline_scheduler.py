@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import concurrent.futures
+import datetime
+import heapq
+import itertools
+import math
+import threading
+import time
+import zlib
+
+from elastalert.util import elastalert_logger
+
+
+def to_timestamp(run_time):
+    """ Converts a next_run_time, given as a naive local or an aware datetime as APScheduler accepts, to a unix timestamp. """
+    if isinstance(run_time, datetime.datetime):
+        return run_time.timestamp()
+    return run_time
+
+
+class DeadlineJob(object):
+    """ A job run every interval seconds by a DeadlineScheduler.
+
+    :param cost: The moving average of the number of seconds the job takes to run.
+    """
+
+    def __init__(self, scheduler, job_id, func, args, interval, next_run_time):
+        self.scheduler = scheduler
+        self.id = job_id
+        self.func = func
+        self.args = args
+        self.interval = interval
+        self.next_run_time = next_run_time
+        self.cost = 0.0
+        self.version = 0
+        self.paused = False
+        self.running = False
+        self.removed = False
+
+    def modify(self, next_run_time=None, **changes):
+        self.scheduler.modify_job(job_id=self.id, next_run_time=next_run_time)
+
+
+class DeadlineScheduler(object):
+    """ Runs interval jobs in a pool of max_workers threads, dispatching the jobs which are due by earliest deadline first.
+
+    The deadline of a run is the time its next run is due, less the job's lag and measured cost, so that when more jobs
+    are due than there are free workers, the jobs furthest behind run first instead of being skipped as misfires.
+    Jobs added without a next_run_time start at a phase of their interval derived from their id, which spreads
+    them evenly over the interval instead of starting them all at once. Implements the parts of the APScheduler
+    scheduler interface ElastAlert uses.
+
+    :param max_workers: The number of jobs which may run at the same time.
+    :param lag_func: Returns the number of seconds a job is behind, given the job.
+    """
+
+    def __init__(self, max_workers=10, lag_func=None):
+        self.max_workers = max_workers
+        self.lag_func = lag_func
+        self.jobs = {}
+        # (next_run_time, seq, version, job) of the jobs waiting for their next run
+        self.waiting = []
+        # (deadline, seq, version, job) of the jobs which are due
+        self.ready = []
+        self.seq = itertools.count()
+        self.free_workers = max_workers
+        self.condition = threading.Condition()
+        self.executor = None
+        self.running = False
+
+    def add_job(self, func, trigger='interval', args=None, id=None, seconds=0, next_run_time=None, **kwargs):
+        """ Adds a job which runs func(*args) every seconds seconds. jitter, max_instances and the other
+        APScheduler options are not used: a job never runs twice at the same time and missed runs are coalesced. """
+        if trigger != 'interval':
+            raise ValueError('DeadlineScheduler only supports interval jobs')
+        if next_run_time is None:
+            phase = zlib.crc32(id.encode('utf-8')) / 2 ** 32 * seconds
+            next_run_time = time.time() + phase
+        with self.condition:
+            job = DeadlineJob(self, id, func, args or [], seconds, to_timestamp(next_run_time))
+            self.jobs[id] = job
+            self.push_waiting(job)
+            self.condition.notify()
+        return job
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def remove_job(self, job_id):
+        with self.condition:
+            job = self.jobs.pop(job_id)
+            job.removed = True
+            job.version += 1
+
+    def modify_job(self, job_id, next_run_time=None, **changes):
+        with self.condition:
+            job = self.jobs[job_id]
+            job.version += 1
+            if next_run_time is not None:
+                job.next_run_time = to_timestamp(next_run_time)
+            if not job.running:
+                self.push_waiting(job)
+            self.condition.notify()
+
+    def pause_job(self, job_id):
+        with self.condition:
+            job = self.jobs[job_id]
+            job.paused = True
+            job.version += 1
+
+    def push_waiting(self, job):
+        heapq.heappush(self.waiting, (job.next_run_time, next(self.seq), job.version, job))
+
+    def get_deadline(self, job):
+        lag = self.lag_func(job) if self.lag_func else 0
+        return job.next_run_time + job.interval - lag - job.cost
+
+    def release_jobs(self, now):
+        """ Moves the jobs due by now from the waiting to the ready queue. Returns the time the next waiting job is due, or None. """
+        while self.waiting and self.waiting[0][0] <= now:
+            _, _, version, job = heapq.heappop(self.waiting)
+            if version != job.version or job.removed or job.paused or job.running:
+                continue
+            heapq.heappush(self.ready, (self.get_deadline(job), next(self.seq), version, job))
+        return self.waiting[0][0] if self.waiting else None
+
+    def pop_ready_job(self):
+        """ Returns the due job with the earliest deadline, or None. """
+        while self.ready:
+            _, _, version, job = heapq.heappop(self.ready)
+            if version != job.version or job.removed or job.paused or job.running:
+                continue
+            return job
+        return None
+
+    def start(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        self.running = True
+        threading.Thread(target=self.dispatch, name='elastalert-deadline-scheduler', daemon=True).start()
+
+    def shutdown(self, wait=True):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.executor:
+            self.executor.shutdown(wait=wait)
+
+    def dispatch(self):
+        with self.condition:
+            while self.running:
+                next_release = self.release_jobs(time.time())
+                while self.free_workers > 0:
+                    job = self.pop_ready_job()
+                    if job is None:
+                        break
+                    job.running = True
+                    self.free_workers -= 1
+                    self.executor.submit(self.run_job, job, job.version)
+                timeout = None
+                if next_release is not None:
+                    timeout = max(next_release - time.time(), 0)
+                self.condition.wait(timeout)
+
+    def run_job(self, job, version):
+        started = time.time()
+        late = started - job.next_run_time
+        if late > job.interval:
+            elastalert_logger.warning('Job %s started %.1f seconds after it was due' % (job.id, late))
+        try:
+            job.func(*job.args)
+        except Exception:
+            elastalert_logger.exception('Job %s raised an exception' % (job.id))
+        finally:
+            with self.condition:
+                job.cost = 0.7 * job.cost + 0.3 * (time.time() - started) if job.cost else time.time() - started
+                job.running = False
+                self.free_workers += 1
+                # The job may have been rescheduled while it ran
+                if job.version == version:
+                    # Runs missed while the job waited or ran are coalesced, keeping its phase
+                    missed = max(math.ceil((time.time() - job.next_run_time) / job.interval), 1) if job.interval else 1
+                    job.next_run_time += missed * job.interval
+                    job.version += 1
+                if not job.removed and not job.paused:
+                    self.push_waiting(job)
+                self.condition.notify()
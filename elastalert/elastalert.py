@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
 import argparse
+import collections
+import concurrent.futures
 import copy
 import datetime
+import functools
+import hashlib
+import heapq
+import itertools
 import json
 import logging
 import os
+import queue
 import random
 import signal
 import sys
@@ -12,10 +19,12 @@ import threading
 import time
 import timeit
 import traceback
+import uuid
 from email.mime.text import MIMEText
 from smtplib import SMTP
 from smtplib import SMTPException
 from socket import error
+from socket import gethostname
 import statsd
 
 
@@ -30,17 +39,50 @@ from elasticsearch.exceptions import NotFoundError
 from elasticsearch.exceptions import TransportError
 
 from elastalert import kibana
+from elastalert.alert_dispatcher import AlertDispatcher
 from elastalert.alerters.debug import DebugAlerter
 from elastalert.config import load_conf
+from elastalert.deadline_scheduler import DeadlineScheduler
 from elastalert.enhancements import DropMatchException
+from elastalert.hash_ring import HashRing
+from elastalert.index_catalog import IndexCatalog
 from elastalert.kibana_discover import generate_kibana_discover_url
+from elastalert.msearch import MultiSearchBatcher
 from elastalert.prometheus_wrapper import PrometheusWrapper
+from elastalert.query_plan import ENDTIME_PLACEHOLDER, QueryPlan, QueryTemplate, STARTTIME_PLACEHOLDER
 from elastalert.ruletypes import FlatlineRule
-from elastalert.util import (add_raw_postfix, cronite_datetime_to_timestamp, dt_to_ts, dt_to_unix, EAException,
-                             elastalert_logger, elasticsearch_client, format_index, lookup_es_key, parse_deadline,
-                             parse_duration, pretty_ts, replace_dots_in_field_names, seconds, set_es_key,
+from elastalert.serializer import get_serializer
+from elastalert.silence_cache import SilenceCache
+from elastalert.spool import Spool
+from elastalert.util import (add_raw_postfix, coarsen_index, cronite_datetime_to_timestamp, dt_to_ts, dt_to_unix, dt_to_unixms,
+                             EAException, elastalert_logger, elasticsearch_client, format_index, lookup_es_key, parse_deadline,
+                             parse_duration, pretty_ts, prune_es_client_registry, replace_dots_in_field_names, seconds, set_es_key,
                              should_scrolling_continue, total_seconds, ts_add, ts_now, ts_to_dt, unix_to_dt,
                              ts_utc_to_tz)
+from elastalert.worker_pool import rule_worker, WorkerPool
+from elastalert.writeback_buffer import WritebackBuffer
+
+
+# The parts of a search response which are read from rules with use_lean_fetch
+LEAN_FETCH_FILTER_PATH = ['_scroll_id', '_shards.failures', 'hits.total', 'hits.hits._id', 'hits.hits._index',
+                          'hits.hits._type', 'hits.hits._source', 'hits.hits.fields']
+
+# The number of pages of hits of a prefetched segment which may wait to be processed
+SEGMENT_PREFETCH_PAGES = 2
+
+# How far before the end of the previous run rules with ingest_timestamp_field query from, by default
+INGEST_TIMESTAMP_OVERLAP = datetime.timedelta(minutes=1)
+
+# The writeback documents which may be written with the bulk writeback buffer. Alerts, aggregates and silences are
+# written right away, so that a failed write is seen and the documents are visible to later queries. Checkpoints have
+# the _id of their rule, so that writing one again only replaces it
+BUFFERED_DOC_TYPES = ('elastalert_status', 'elastalert_error', 'elastalert_checkpoint')
+
+# The writeback documents which are kept in writeback_spool_dir if they cannot be written right away
+SPOOLED_DOC_TYPES = ('elastalert',)
+
+# How far before the latest silence loaded silences are loaded again from, for silences indexed out of order
+SILENCE_REFRESH_OVERLAP = datetime.timedelta(minutes=1)
 
 
 class ElastAlerter(object):
@@ -59,6 +101,10 @@ class ElastAlerter(object):
     thread_data = threading.local()
 
     def parse_args(self, args):
+        self.args = self.get_arg_parser().parse_args(args)
+
+    @staticmethod
+    def get_arg_parser():
         parser = argparse.ArgumentParser()
         parser.add_argument(
             '--config',
@@ -99,10 +145,15 @@ class ElastAlerter(object):
             help='Enable logging from Elasticsearch queries as curl command. Queries will be logged to file. Note that '
                  'this will incorrectly display localhost:9200 as the host/port')
         parser.add_argument('--prometheus_port', type=int, dest='prometheus_port', help='Enables Prometheus metrics on specified port.')
-        self.args = parser.parse_args(args)
+        return parser
 
-    def __init__(self, args):
+    def __init__(self, args, worker_index=None, rule_hashes_queue=None):
+        self.worker_index = worker_index
+        self.rule_hashes_queue = rule_hashes_queue
+        self.rule_hashes = None
         self.es_clients = {}
+        self.msearch_batchers = {}
+        self.msearch_batchers_lock = threading.Lock()
         self.parse_args(args)
         self.debug = self.args.debug
         self.verbose = self.args.verbose
@@ -131,12 +182,17 @@ class ElastAlerter(object):
 
         self.conf = load_conf(self.args)
         self.rules_loader = self.conf['rules_loader']
-        self.rules = self.rules_loader.load(self.conf, self.args)
+        self.worker_processes = self.conf.get('worker_processes', 1)
+        self.cluster_sharding = self.conf.get('cluster_sharding', False)
+        # Workers only load their own rule files, so that rule setup queries are split between them
+        rule_filter = self.owns_rule_file if self.worker_index is not None else None
+        self.rules = self.rules_loader.load(self.conf, self.args, rule_filter=rule_filter)
 
         print(len(self.rules), 'rules loaded')
 
         self.max_query_size = self.conf['max_query_size']
         self.scroll_keepalive = self.conf['scroll_keepalive']
+        self.index_catalog = IndexCatalog(self.conf.get('index_catalog_refresh_interval', 300))
         self.writeback_index = self.conf['writeback_index']
         self.run_every = self.conf['run_every']
         self.alert_time_limit = self.conf['alert_time_limit']
@@ -147,23 +203,34 @@ class ElastAlerter(object):
         self.smtp_host = self.conf.get('smtp_host', 'localhost')
         self.max_aggregation = self.conf.get('max_aggregation', 10000)
         self.buffer_time = self.conf['buffer_time']
-        self.silence_cache = {}
-        self.rule_hashes = self.rules_loader.get_hashes(self.conf, self.args.rule)
+        self.silence_cache = SilenceCache(max_size=self.conf.get('silence_cache_size', 100000),
+                                          ttl=self.conf.get('silence_cache_ttl', datetime.timedelta(days=1)))
+        # The latest @timestamp of the silences loaded into silence_cache, None until they are first loaded
+        self.silence_last_seen = None
+        # False once some silences could not be loaded, so that is_silenced has to query for the ones not in silence_cache
+        self.silences_complete = True
+        self.rule_hashes = self.get_rule_hashes()
         self.starttime = self.args.start
         self.disabled_rules = []
         self.replace_dots_in_field_names = self.conf.get('replace_dots_in_field_names', False)
         self.thread_data.alerts_sent = 0
         self.thread_data.num_hits = 0
         self.thread_data.num_dupes = 0
-        executors = {
-            'default': ThreadPoolExecutor(max_workers=self.conf.get('max_threads', 10)),
-        }
+        self.execution_mode = self.conf.get('execution_mode', 'threads')
         job_defaults = {
             'misfire_grace_time': self.conf.get('misfire_grace_time', 5),
             'coalesce': True,
             'max_instances': 1
         }
-        self.scheduler = BackgroundScheduler(executors=executors, job_defaults=job_defaults)
+        if self.execution_mode == 'threads':
+            executors = {
+                'default': ThreadPoolExecutor(max_workers=self.conf.get('max_threads', 10)),
+            }
+            self.scheduler = BackgroundScheduler(executors=executors, job_defaults=job_defaults)
+        elif self.execution_mode == 'deadline':
+            self.scheduler = DeadlineScheduler(max_workers=self.conf.get('max_threads', 10), lag_func=self.get_job_lag)
+        else:
+            raise EAException('execution_mode must be one of threads or deadline')
         self.string_multi_field_name = self.conf.get('string_multi_field_name', False)
         self.statsd_instance_tag = self.conf.get('statsd_instance_tag', '')
         self.statsd_host = self.conf.get('statsd_host', '')
@@ -174,17 +241,53 @@ class ElastAlerter(object):
         self.add_metadata_alert = self.conf.get('add_metadata_alert', False)
         self.prometheus_port = self.args.prometheus_port
         self.show_disabled_rules = self.conf.get('show_disabled_rules', True)
+        self.instance_id = self.conf.get('instance_id') or '%s-%s' % (gethostname(), os.getpid())
+        if self.worker_index is not None:
+            self.instance_id += '-%s' % (self.worker_index)
+        self.heartbeat_interval = self.conf.get('heartbeat_interval', 30)
+        self.heartbeat_timeout = self.conf.get('heartbeat_timeout', 90)
+        self.heartbeat_thread = None
+        self.heartbeat_stop = threading.Event()
+        self.use_rule_checkpoints = self.conf.get('use_rule_checkpoints', False)
+        self.write_status_history = self.conf.get('write_status_history', True) or not self.use_rule_checkpoints
+        # The checkpoints read at startup, by rule name, until each rule takes its own
+        self.checkpoints = {}
+        # The names of the rules found to have no checkpoint at startup
+        self.missing_checkpoints = set()
+        self.hash_ring = None
+        self.alert_dispatcher = None
+        if self.conf.get('alert_dispatch_workers'):
+            self.alert_dispatcher = AlertDispatcher(self.send_dispatched_alert,
+                                                    workers=self.conf['alert_dispatch_workers'],
+                                                    queue_size=self.conf.get('alert_dispatch_queue_size', 1000))
+        self.alert_dispatch_shutdown_timeout = self.conf.get('alert_dispatch_shutdown_timeout', 10)
 
         self.writeback_es = elasticsearch_client(self.conf)
+        self.writeback_buffer = None
+        if (self.conf.get('writeback_bulk_size') or self.conf.get('writeback_spool_dir')) and not self.debug:
+            spool = None
+            if self.conf.get('writeback_spool_dir'):
+                spool_dir = self.conf['writeback_spool_dir']
+                # Every worker process has its own spool
+                if self.worker_index is not None:
+                    spool_dir = os.path.join(spool_dir, 'worker-%s' % (self.worker_index))
+                spool = Spool(spool_dir,
+                              segment_size=self.conf.get('writeback_spool_segment_size', 16 * 1024 * 1024),
+                              max_size=self.conf.get('writeback_spool_max_size', 1024 * 1024 * 1024))
+            self.writeback_buffer = WritebackBuffer(self.writeback_es,
+                                                    bulk_size=self.conf.get('writeback_bulk_size', 500),
+                                                    flush_interval=self.conf.get('writeback_flush_interval', 5),
+                                                    max_retries=self.conf.get('writeback_max_retries', 3),
+                                                    spool=spool,
+                                                    serializer=get_serializer(self.conf.get('json_serializer')))
 
         remove = []
         for rule in self.rules:
             if 'is_enabled' in rule and not rule['is_enabled']:
                 self.disabled_rules.append(rule)
                 remove.append(rule)
-            elif not self.init_rule(rule):
-                remove.append(rule)
         list(map(self.rules.remove, remove))
+        self.rules = self.init_rules(self.rules)
 
         if self.args.silence:
             self.silence()
@@ -208,6 +311,37 @@ class ElastAlerter(object):
         else:
             return index
 
+    def resolve_index(self, rule, starttime, endtime):
+        """ Returns the index expression to query for a rule between starttime and endtime. With use_index_catalog,
+        the indices of a strftime index are reduced to those which exist, or replaced by wildcards per month or year
+        of the time range if there are more than index_catalog_max_indices of them. """
+        plan = rule.get('query_plan')
+        if plan is not None and plan.index is not None:
+            return plan.index
+        index = self.get_index(rule, starttime, endtime)
+        if not rule.get('use_index_catalog') or not rule.get('use_strftime_index'):
+            return index
+        pattern = self.get_index(rule)
+        entry = self.index_catalog.get(self.thread_data.current_es, self.get_cluster_key(rule), pattern)
+        if entry is None:
+            return index
+
+        # Indices for the days since the catalog was refreshed may have been created since
+        recent = set()
+        day = entry.refreshed_at
+        last_day = (endtime - endtime.utcoffset()).date()
+        while day.date() <= last_day:
+            recent.add(day.strftime(rule['index']))
+            day += datetime.timedelta(days=1)
+
+        indices = [name for name in index.split(',') if name in entry.indices or name in recent]
+        if not indices:
+            return index
+        max_indices = rule.get('index_catalog_max_indices', 100)
+        if len(indices) > max_indices:
+            return coarsen_index(rule['index'], indices, starttime, endtime, max_indices) or pattern
+        return ','.join(indices)
+
     @staticmethod
     def get_query(filters, starttime=None, endtime=None, sort=True, timestamp_field='@timestamp', to_ts_func=dt_to_ts, desc=False,
                   five=False):
@@ -252,11 +386,9 @@ class ElastAlerter(object):
                                                        'min_doc_count': rule.get('min_doc_count', 1)}}}
         return aggs_query
 
-    def get_aggregation_query(self, query, rule, query_key, terms_size, timestamp_field='@timestamp'):
-        """ Takes a query generated by get_query and outputs a aggregation query """
-        query_element = query['query']
-        if 'sort' in query_element:
-            query_element.pop('sort')
+    @staticmethod
+    def get_metric_aggs_element(rule, timestamp_field='@timestamp'):
+        """ Returns the metric aggregation of a rule, split into date_histogram buckets if bucket_interval is set. """
         metric_agg_element = rule['aggregation_query_element']
 
         bucket_interval_period = rule.get('bucket_interval_period')
@@ -273,6 +405,14 @@ class ElastAlerter(object):
                 aggs_element['interval_aggs']['date_histogram']['offset'] = '+%ss' % (rule['bucket_offset_delta'])
         else:
             aggs_element = metric_agg_element
+        return aggs_element
+
+    def get_aggregation_query(self, query, rule, query_key, terms_size, timestamp_field='@timestamp'):
+        """ Takes a query generated by get_query and outputs a aggregation query """
+        query_element = query['query']
+        if 'sort' in query_element:
+            query_element.pop('sort')
+        aggs_element = self.get_metric_aggs_element(rule, timestamp_field)
 
         if query_key is not None:
             for idx, key in reversed(list(enumerate(query_key.split(',')))):
@@ -356,6 +496,41 @@ class ElastAlerter(object):
 
         return processed_hits
 
+    def get_hits_query(self, rule, starttime, endtime, to_ts_func=None):
+        """ Returns the query used to download the documents of a rule between starttime and endtime.
+        If the rule has an ingest_timestamp_field, documents are selected by the time they were ingested,
+        but are still sorted by timestamp_field. """
+        ingest_timestamp_field = rule.get('ingest_timestamp_field')
+        if not ingest_timestamp_field:
+            return self.get_query(
+                rule['filter'],
+                starttime,
+                endtime,
+                timestamp_field=rule['timestamp_field'],
+                to_ts_func=to_ts_func or rule['dt_to_ts'],
+                five=rule['five'],
+            )
+        query = self.get_query(
+            rule['filter'],
+            starttime,
+            endtime,
+            sort=False,
+            timestamp_field=ingest_timestamp_field,
+            to_ts_func=to_ts_func or dt_to_ts,
+            five=rule['five'],
+        )
+        query['sort'] = [{rule['timestamp_field']: {'order': 'asc'}}]
+        return query
+
+    @staticmethod
+    def add_stored_fields(rule, query):
+        """ Requests the included fields as stored fields for rules with _source_enabled turned off. """
+        if not rule.get('_source_enabled'):
+            if rule['five']:
+                query['stored_fields'] = rule['include']
+            else:
+                query['fields'] = rule['include']
+
     def get_hits(self, rule, starttime, endtime, index, scroll=False):
         """ Query Elasticsearch for the given rule and return the results.
         :param rule: The rule configuration.
@@ -364,45 +539,46 @@ class ElastAlerter(object):
         :return: A list of hits, bounded by rule['max_query_size'] (or self.max_query_size).
         """
 
-        query = self.get_query(
-            rule['filter'],
-            starttime,
-            endtime,
-            timestamp_field=rule['timestamp_field'],
-            to_ts_func=rule['dt_to_ts'],
-            five=rule['five'],
-        )
+        plan = rule.get('query_plan')
+        includes = rule['include']
+        if plan is not None and plan.hits is not None and not rule.get('use_msearch_batching'):
+            query = plan.hits.render(starttime, endtime)
+            if plan.source_includes is not None:
+                includes = plan.source_includes
+        else:
+            query = self.get_hits_query(rule, starttime, endtime)
+            self.add_stored_fields(rule, query)
         if self.thread_data.current_es.is_atleastsixsix():
-            extra_args = {'_source_includes': rule['include']}
+            extra_args = {'_source_includes': includes}
         else:
-            extra_args = {'_source_include': rule['include']}
+            extra_args = {'_source_include': includes}
         scroll_keepalive = rule.get('scroll_keepalive', self.scroll_keepalive)
         if not rule.get('_source_enabled'):
-            if rule['five']:
-                query['stored_fields'] = rule['include']
-            else:
-                query['fields'] = rule['include']
             extra_args = {}
+        scroll_args = {}
+        if rule.get('use_lean_fetch'):
+            extra_args = self.get_lean_fetch_args(rule, extra_args)
+            scroll_args = {'filter_path': LEAN_FETCH_FILTER_PATH}
 
         try:
             if scroll:
-                res = self.thread_data.current_es.scroll(scroll_id=rule['scroll_id'], scroll=scroll_keepalive)
+                res = self.thread_data.current_es.scroll(scroll_id=rule['scroll_id'], scroll=scroll_keepalive, **scroll_args)
             else:
-                res = self.thread_data.current_es.search(
-                    scroll=scroll_keepalive,
-                    index=index,
-                    size=rule.get('max_query_size', self.max_query_size),
-                    body=query,
-                    ignore_unavailable=True,
-                    **extra_args
-                )
+                if rule.get('use_msearch_batching'):
+                    res = self.get_batched_hits(rule, index, query, extra_args)
+                else:
+                    res = self.thread_data.current_es.search(
+                        scroll=scroll_keepalive,
+                        index=index,
+                        size=rule.get('max_query_size', self.max_query_size),
+                        body=query,
+                        ignore_unavailable=True,
+                        **extra_args
+                    )
                 if '_scroll_id' in res:
                     rule['scroll_id'] = res['_scroll_id']
 
-                if self.thread_data.current_es.is_atleastseven():
-                    self.thread_data.total_hits = int(res['hits']['total']['value'])
-                else:
-                    self.thread_data.total_hits = int(res['hits']['total'])
+                self.thread_data.total_hits = self.get_total_hits(res)
 
             if len(res.get('_shards', {}).get('failures', [])) > 0:
                 try:
@@ -413,7 +589,8 @@ class ElastAlerter(object):
                     # Different versions of ES have this formatted in different ways. Fallback to str-ing the whole thing
                     raise ElasticsearchException(str(res['_shards']['failures']))
 
-            elastalert_logger.debug(str(res))
+            if elastalert_logger.isEnabledFor(logging.DEBUG):
+                elastalert_logger.debug(str(res))
         except ElasticsearchException as e:
             # Elasticsearch sometimes gives us GIGANTIC error messages
             # (so big that they will fill the entire terminal buffer)
@@ -421,8 +598,14 @@ class ElastAlerter(object):
                 e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
             self.handle_error('Error running query: %s' % (e), {'rule': rule['name'], 'query': query})
             return None
-        hits = res['hits']['hits']
+        # filter_path leaves out hits.hits when there are none
+        hits = res['hits'].get('hits', [])
         self.thread_data.num_hits += len(hits)
+        total = res['hits'].get('total')
+        if isinstance(total, dict) and total.get('relation') == 'gte':
+            # Hits were only counted up to a limit, keep scrolling for as long as pages are full
+            full_page = len(hits) >= rule.get('max_query_size', self.max_query_size)
+            self.thread_data.total_hits = self.thread_data.num_hits + (1 if full_page else 0)
         lt = rule.get('use_local_time')
         status_log = "Queried rule %s from %s to %s: %s / %s hits" % (
             rule['name'],
@@ -443,6 +626,83 @@ class ElastAlerter(object):
             rule['doc_type'] = hits[0]['_type']
         return hits
 
+    def get_lean_fetch_args(self, rule, extra_args):
+        """ Returns the search parameters of a rule with use_lean_fetch. The response is reduced to the keys
+        ElastAlert reads and hits are only counted as far as needed to know whether to scroll.
+        With use_docvalue_fields, the included fields are read from doc values instead of _source. """
+        extra_args = dict(extra_args, filter_path=LEAN_FETCH_FILTER_PATH)
+        if self.thread_data.current_es.is_atleastseven():
+            extra_args['track_total_hits'] = rule.get('max_query_size', self.max_query_size) + 1
+        if rule.get('use_docvalue_fields') and rule.get('_source_enabled'):
+            extra_args.pop('_source_includes', None)
+            extra_args.pop('_source_include', None)
+            extra_args['_source'] = False
+            extra_args['docvalue_fields'] = rule['include']
+        return extra_args
+
+    def get_total_hits(self, res):
+        """ Returns the total number of hits reported by a search response. """
+        if self.thread_data.current_es.is_atleastseven():
+            return int(res['hits']['total']['value'])
+        return int(res['hits']['total'])
+
+    @staticmethod
+    def get_cluster_key(rule):
+        """ Returns a key identifying the Elasticsearch cluster (and user) a rule queries. """
+        return (rule.get('es_host'), rule.get('es_port'), rule.get('es_url_prefix'), rule.get('es_username'))
+
+    def get_msearch_batcher(self, rule):
+        """ Returns the MultiSearchBatcher shared by all rules querying the same cluster as rule. """
+        key = self.get_cluster_key(rule)
+        with self.msearch_batchers_lock:
+            if key not in self.msearch_batchers:
+                self.msearch_batchers[key] = MultiSearchBatcher(
+                    self.thread_data.current_es,
+                    max_batch_size=rule.get('msearch_max_batch_size', self.conf.get('max_threads', 10)),
+                    batch_window=rule.get('msearch_batch_window', 0.5)
+                )
+            return self.msearch_batchers[key]
+
+    def get_batched_hits(self, rule, index, query, extra_args):
+        """ Runs the first page of a hits query through the cluster's multi search batch, with the search parameters
+        in extra_args moved into the body. If the results do not fit in a single page, carries on with a scroll query
+        for the hits from the timestamp of the last hit of the page on, and returns both pages as one response.
+        The hits of the page sharing that timestamp are fetched again and dropped as duplicates. """
+        size = rule.get('max_query_size', self.max_query_size)
+        body = dict(query, size=size)
+        search_args = dict(extra_args)
+        filter_path = search_args.pop('filter_path', None)
+        for key in ('_source_includes', '_source_include'):
+            if key in search_args:
+                body['_source'] = {'includes': search_args.pop(key)}
+        body.update(search_args)
+        res = self.get_msearch_batcher(rule).search(index, body, filter_path=filter_path, ignore_unavailable=True)
+        if self.get_total_hits(res) <= size or res.get('_shards', {}).get('failures'):
+            return res
+
+        elastalert_logger.info("Rule %s has more than %s hits, scrolling on from the last batched hit" % (rule['name'], size))
+        hits = res['hits'].get('hits', [])
+        last = self.process_hits(rule, [copy.deepcopy(hits[-1])])[0]
+        query = copy.deepcopy(query)
+        es_filters = query['query']['bool' if rule['five'] else 'filtered']
+        es_filters['filter']['bool']['must'].append(
+            {'range': {rule['timestamp_field']: {'gte': rule['dt_to_ts'](lookup_es_key(last, rule['timestamp_field']))}}})
+        more = self.thread_data.current_es.search(
+            scroll=rule.get('scroll_keepalive', self.scroll_keepalive),
+            index=index,
+            size=size,
+            body=query,
+            ignore_unavailable=True,
+            **extra_args
+        )
+        total = more['hits'].get('total')
+        if isinstance(total, dict):
+            total = dict(total, value=len(hits) + total['value'])
+        else:
+            total = len(hits) + total
+        more['hits'] = dict(more['hits'], total=total, hits=hits + more['hits'].get('hits', []))
+        return more
+
     def get_hits_count(self, rule, starttime, endtime, index):
         """ Query Elasticsearch for the count of results and returns a list of timestamps
         equal to the endtime. This allows the results to be passed to rules which expect
@@ -453,18 +713,29 @@ class ElastAlerter(object):
         :param endtime: The latest time to query.
         :return: A dictionary mapping timestamps to number of hits for that time period.
         """
-        query = self.get_query(
-            rule['filter'],
-            starttime,
-            endtime,
-            timestamp_field=rule['timestamp_field'],
-            sort=False,
-            to_ts_func=rule['dt_to_ts'],
-            five=rule['five']
-        )
+        plan = rule.get('query_plan')
+        if plan is not None and plan.count is not None and not rule.get('use_msearch_batching'):
+            query = plan.count.render(starttime, endtime)
+        else:
+            query = self.get_query(
+                rule['filter'],
+                starttime,
+                endtime,
+                timestamp_field=rule['timestamp_field'],
+                sort=False,
+                to_ts_func=rule['dt_to_ts'],
+                five=rule['five']
+            )
 
         try:
-            res = self.thread_data.current_es.count(index=index, doc_type=rule['doc_type'], body=query, ignore_unavailable=True)
+            if rule.get('use_msearch_batching'):
+                body = dict(query, size=0)
+                if self.thread_data.current_es.is_atleastseven():
+                    body['track_total_hits'] = True
+                res = self.get_msearch_batcher(rule).search(index, body, ignore_unavailable=True)
+                res = {'count': self.get_total_hits(res)}
+            else:
+                res = self.thread_data.current_es.count(index=index, doc_type=rule['doc_type'], body=query, ignore_unavailable=True)
         except ElasticsearchException as e:
             # Elasticsearch sometimes gives us GIGANTIC error messages
             # (so big that they will fill the entire terminal buffer)
@@ -480,7 +751,24 @@ class ElastAlerter(object):
         )
         return {endtime: res['count']}
 
-    def get_hits_terms(self, rule, starttime, endtime, index, key, qk=None, size=None):
+    def build_terms_query(self, rule, starttime, endtime, key, qk=None, size=None, to_ts_func=None):
+        """ Returns the terms query of a rule, optionally filtered to a single query key value. """
+        base_query = self.get_query(
+            self.get_terms_filter(rule, key, qk),
+            starttime,
+            endtime,
+            timestamp_field=rule['timestamp_field'],
+            sort=False,
+            to_ts_func=to_ts_func or rule['dt_to_ts'],
+            five=rule['five']
+        )
+        if size is None:
+            size = rule.get('terms_size', 50)
+        return self.get_terms_query(base_query, rule, size, key, rule['five'])
+
+    @staticmethod
+    def get_terms_filter(rule, key, qk=None):
+        """ Returns the filters of a rule, restricted to the query key value qk if it is given. """
         rule_filter = copy.copy(rule['filter'])
         if qk:
             qk_list = qk.split(",")
@@ -503,19 +791,14 @@ class ElastAlerter(object):
                     if rule.get('raw_count_keys', True) and not key.endswith(end):
                         key_with_postfix = add_raw_postfix(key_with_postfix, rule['five'])
                     rule_filter.extend([{'term': {key_with_postfix: qk_list[i]}}])
+        return rule_filter
 
-        base_query = self.get_query(
-            rule_filter,
-            starttime,
-            endtime,
-            timestamp_field=rule['timestamp_field'],
-            sort=False,
-            to_ts_func=rule['dt_to_ts'],
-            five=rule['five']
-        )
-        if size is None:
-            size = rule.get('terms_size', 50)
-        query = self.get_terms_query(base_query, rule, size, key, rule['five'])
+    def get_hits_terms(self, rule, starttime, endtime, index, key, qk=None, size=None):
+        plan = rule.get('query_plan')
+        if plan is not None and plan.terms is not None and not qk and size is None and key == rule.get('query_key'):
+            query = plan.terms.render(starttime, endtime)
+        else:
+            query = self.build_terms_query(rule, starttime, endtime, key, qk, size)
 
         try:
             if not rule['five']:
@@ -550,7 +833,8 @@ class ElastAlerter(object):
         )
         return {endtime: buckets}
 
-    def get_hits_aggregation(self, rule, starttime, endtime, index, query_key, term_size=None):
+    def build_aggregation_query(self, rule, starttime, endtime, query_key, term_size=None, to_ts_func=None):
+        """ Returns the metric aggregation query of a rule. """
         rule_filter = copy.copy(rule['filter'])
         base_query = self.get_query(
             rule_filter,
@@ -558,12 +842,19 @@ class ElastAlerter(object):
             endtime,
             timestamp_field=rule['timestamp_field'],
             sort=False,
-            to_ts_func=rule['dt_to_ts'],
+            to_ts_func=to_ts_func or rule['dt_to_ts'],
             five=rule['five']
         )
         if term_size is None:
             term_size = rule.get('terms_size', 50)
-        query = self.get_aggregation_query(base_query, rule, query_key, term_size, rule['timestamp_field'])
+        return self.get_aggregation_query(base_query, rule, query_key, term_size, rule['timestamp_field'])
+
+    def get_hits_aggregation(self, rule, starttime, endtime, index, query_key, term_size=None):
+        plan = rule.get('query_plan')
+        if plan is not None and plan.aggregation is not None and term_size is None and query_key == rule.get('query_key'):
+            query = plan.aggregation.render(starttime, endtime)
+        else:
+            query = self.build_aggregation_query(rule, starttime, endtime, query_key, term_size)
         try:
             if not rule['five']:
                 res = self.thread_data.current_es.deprecated_search(
@@ -601,8 +892,13 @@ class ElastAlerter(object):
             if event['_id'] in rule['processed_hits']:
                 continue
 
-            # Remember the new data's IDs
-            rule['processed_hits'][event['_id']] = lookup_es_key(event, rule['timestamp_field'])
+            # Remember the new data's IDs, with the time they were ingested if they are fetched again by ingest time
+            timestamp = lookup_es_key(event, rule['timestamp_field'])
+            if rule.get('ingest_timestamp_field'):
+                ingested = lookup_es_key(event, rule['ingest_timestamp_field'])
+                if ingested:
+                    timestamp = ts_to_dt(ingested)
+            rule['processed_hits'][event['_id']] = timestamp
             new_events.append(event)
 
         return new_events
@@ -612,6 +908,8 @@ class ElastAlerter(object):
         now = ts_now()
         remove = []
         buffer_time = rule.get('buffer_time', self.buffer_time)
+        if rule.get('ingest_timestamp_field'):
+            buffer_time = max(buffer_time, rule.get('ingest_timestamp_overlap', INGEST_TIMESTAMP_OVERLAP))
         if rule.get('query_delay'):
             buffer_time += rule['query_delay']
         for _id, timestamp in rule['processed_hits'].items():
@@ -640,13 +938,19 @@ class ElastAlerter(object):
         # Reset hit counter and query
         rule_inst = rule['type']
         rule['scrolling_cycle'] = rule.get('scrolling_cycle', 0) + 1
-        index = self.get_index(rule, start, end)
+        index = self.resolve_index(rule, start, end)
         if rule.get('use_count_query'):
             data = self.get_hits_count(rule, start, end, index)
         elif rule.get('use_terms_query'):
+            if self.use_composite_aggregation(rule):
+                return self.run_composite_terms_query(rule, start, end, index)
             data = self.get_hits_terms(rule, start, end, index, rule['query_key'])
         elif rule.get('aggregation_query_element'):
+            if self.use_composite_aggregation(rule) and rule.get('query_key'):
+                return self.run_composite_aggregation_query(rule, start, end, index)
             data = self.get_hits_aggregation(rule, start, end, index, rule.get('query_key', None))
+        elif self.use_point_in_time(rule):
+            return self.run_paged_query(rule, start, end, index)
         else:
             data = self.get_hits(rule, start, end, index, scroll)
             if data:
@@ -684,12 +988,252 @@ class ElastAlerter(object):
 
         return True
 
+    def use_composite_aggregation(self, rule):
+        """ Returns True if the rule's terms aggregations should be paged with composite aggregations,
+        which return the after_key to page with from Elasticsearch 6.3. """
+        return bool(rule.get('use_composite_aggregation')) and rule.get('five') and \
+            self.thread_data.current_es.is_atleastsixthree()
+
+    def get_composite_query(self, rule, starttime, endtime, rule_filter, fields, aggs=None):
+        """ Returns a query with a composite aggregation over fields, with sources named key0, key1, ... """
+        query = self.get_query(
+            rule_filter,
+            starttime,
+            endtime,
+            timestamp_field=rule['timestamp_field'],
+            sort=False,
+            to_ts_func=rule['dt_to_ts'],
+            five=rule['five']
+        )
+        sources = [{'key%s' % i: {'terms': {'field': field}}} for i, field in enumerate(fields)]
+        composite = {'composite': {'size': rule.get('composite_size', 1000), 'sources': sources}}
+        if aggs:
+            composite['aggs'] = aggs
+        query['aggs'] = {'composite_aggs': composite}
+        return query
+
+    def page_composite_aggregation(self, rule, index, query, handle_page, max_pages=None):
+        """ Runs a query built by get_composite_query, following after_key until every bucket has been read,
+        or max_pages pages if it is given, and passes the buckets of each page to handle_page as they arrive.
+
+        :return: The number of buckets read, or None if a query failed.
+        """
+        composite = query['aggs']['composite_aggs']['composite']
+        min_doc_count = rule.get('min_doc_count', 1)
+        num_buckets = 0
+        num_pages = 0
+        while True:
+            try:
+                res = self.thread_data.current_es.search(index=index, body=query, size=0, ignore_unavailable=True)
+            except ElasticsearchException as e:
+                if len(str(e)) > 1024:
+                    e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
+                self.handle_error('Error running composite aggregation query: %s' % (e), {'rule': rule['name'], 'query': query})
+                return None
+
+            aggregation = res.get('aggregations', {}).get('composite_aggs', {})
+            page = aggregation.get('buckets', [])
+            buckets = [bucket for bucket in page if bucket['doc_count'] >= min_doc_count]
+            if buckets:
+                handle_page(buckets)
+                num_buckets += len(buckets)
+            num_pages += 1
+            if len(page) < composite['size'] or 'after_key' not in aggregation:
+                return num_buckets
+            if num_pages == max_pages:
+                elastalert_logger.info('Stopped reading composite aggregation buckets of rule %s after %s pages' % (
+                    rule['name'], num_pages))
+                return num_buckets
+            composite['after'] = aggregation['after_key']
+
+    def run_composite_terms_query(self, rule, starttime, endtime, index):
+        """ Pages through every query_key bucket of a terms rule, passing each page to the RuleType as it arrives.
+        Returns True on success and False on failure. """
+        query = self.get_composite_query(rule, starttime, endtime, rule['filter'], [rule['query_key']])
+
+        def add_page(buckets):
+            rule['type'].add_terms_data({endtime: [{'key': bucket['key']['key0'], 'doc_count': bucket['doc_count']}
+                                                   for bucket in buckets]})
+
+        num_buckets = self.page_composite_aggregation(rule, index, query, add_page)
+        if num_buckets is None:
+            return False
+        self.thread_data.num_hits += num_buckets
+        lt = rule.get('use_local_time')
+        elastalert_logger.info(
+            'Queried rule %s from %s to %s: %s buckets' % (rule['name'], pretty_ts(starttime, lt), pretty_ts(endtime, lt), num_buckets)
+        )
+        return True
+
+    def run_composite_aggregation_query(self, rule, starttime, endtime, index):
+        """ Pages through every query_key bucket of a metric aggregation rule, passing each page to the RuleType
+        in the nested bucket_aggs format of get_aggregation_query. Returns True on success and False on failure. """
+        fields = rule['query_key'].split(',')
+        aggs = self.get_metric_aggs_element(rule, rule['timestamp_field'])
+        query = self.get_composite_query(rule, starttime, endtime, rule['filter'], fields, aggs)
+
+        def add_page(buckets):
+            self.thread_data.num_hits += sum(bucket['doc_count'] for bucket in buckets)
+            rule['type'].add_aggregation_data({endtime: self.nest_composite_buckets(buckets, len(fields))})
+
+        return self.page_composite_aggregation(rule, index, query, add_page) is not None
+
+    @staticmethod
+    def nest_composite_buckets(buckets, num_keys):
+        """ Converts composite aggregation buckets into the nested bucket_aggs terms buckets
+        get_aggregation_query produces for the same query_key fields. """
+        nested = []
+        for bucket in buckets:
+            level = nested
+            for i in range(num_keys - 1):
+                value = bucket['key']['key%s' % i]
+                if not level or level[-1]['key'] != value:
+                    level.append({'key': value, 'doc_count': 0, 'bucket_aggs': {'buckets': []}})
+                level[-1]['doc_count'] += bucket['doc_count']
+                level = level[-1]['bucket_aggs']['buckets']
+            leaf = dict(bucket, key=bucket['key']['key%s' % (num_keys - 1)])
+            level.append(leaf)
+        return {'bucket_aggs': {'buckets': nested}}
+
+    def get_composite_top_counts(self, rule, starttime, endtime, index, key, qk, number):
+        """ Returns the number most common values of key, counted over the buckets of the first composite_top_count_pages
+        pages of a composite aggregation, or None if a query failed. """
+        query = self.get_composite_query(rule, starttime, endtime, self.get_terms_filter(rule, key, qk), [key])
+        # A min heap of the number largest (count, index, value), the index breaks ties without comparing values
+        top_counts = []
+        seen = itertools.count()
+
+        def add_page(buckets):
+            for bucket in buckets:
+                count = (bucket['doc_count'], next(seen), bucket['key']['key0'])
+                if len(top_counts) < number:
+                    heapq.heappush(top_counts, count)
+                elif count[0] > top_counts[0][0]:
+                    heapq.heapreplace(top_counts, count)
+
+        max_pages = rule.get('composite_top_count_pages', 10)
+        if self.page_composite_aggregation(rule, index, query, add_page, max_pages=max_pages) is None:
+            return None
+        return dict((value, count) for count, _, value in sorted(top_counts, reverse=True))
+
+    def use_point_in_time(self, rule):
+        """ Returns True if the rule's hits should be paged with a point in time instead of scrolled. """
+        return bool(rule.get('use_point_in_time')) and self.thread_data.current_es.is_atleastseventen()
+
+    def run_paged_query(self, rule, start, end, index):
+        """ Query for the rule one page at a time using a point in time and search_after, passing
+        each page of results to the RuleType instance as it arrives.
+
+        :param rule: The rule configuration.
+        :param start: The earliest time to query.
+        :param end: The latest time to query.
+        :param index: The index expression to query.
+        Returns True on success and False on failure.
+        """
+        for data in self.get_point_in_time_pages(rule, start, end, index):
+            if data is None:
+                return False
+            if data:
+                old_len = len(data)
+                data = self.remove_duplicate_events(data, rule)
+                self.thread_data.num_dupes += old_len - len(data)
+                if data:
+                    rule['type'].add_data(data)
+        return True
+
+    def get_point_in_time_pages(self, rule, start, end, index):
+        """ Opens a point in time and yields each page of processed hits of the rule from it, or None if a query failed.
+        The point in time is closed once the last page has been read. """
+        keepalive = rule.get('scroll_keepalive', self.scroll_keepalive)
+        es = self.thread_data.current_es
+        try:
+            pit_id = es.open_point_in_time(index=index, keep_alive=keepalive, ignore_unavailable=True)['id']
+        except ElasticsearchException as e:
+            self.handle_error('Error opening point in time: %s' % (e), {'rule': rule['name'], 'index': index})
+            yield None
+            return
+
+        search_after = None
+        try:
+            while True:
+                data, pit_id, search_after = self.get_hits_page(rule, start, end, pit_id, search_after)
+                yield data
+                if data is None or search_after is None or not should_scrolling_continue(rule):
+                    break
+                rule['scrolling_cycle'] += 1
+        finally:
+            try:
+                es.close_point_in_time(body={'id': pit_id})
+            except ElasticsearchException:
+                pass
+
+    def get_hits_page(self, rule, starttime, endtime, pit_id, search_after=None):
+        """ Query one page of hits for the rule from a point in time, sorted by timestamp and _id.
+
+        :param rule: The rule configuration.
+        :param starttime: The earliest time to query.
+        :param endtime: The latest time to query.
+        :param pit_id: The id of the open point in time.
+        :param search_after: The sort values of the last hit of the previous page, or None for the first page.
+        :return: A tuple of the processed hits, the (possibly updated) point in time id and the sort values
+            to pass as search_after for the next page, which is None if this was the last page.
+            The hits are None if the query failed.
+        """
+        query = self.get_hits_query(rule, starttime, endtime)
+        size = rule.get('max_query_size', self.max_query_size)
+        query['sort'].append({'_id': {'order': 'asc'}})
+        query['pit'] = {'id': pit_id, 'keep_alive': rule.get('scroll_keepalive', self.scroll_keepalive)}
+        query['track_total_hits'] = False
+        if search_after is not None:
+            query['search_after'] = search_after
+        extra_args = {'_source_includes': rule['include']}
+        if not rule.get('_source_enabled'):
+            query['stored_fields'] = rule['include']
+            extra_args = {}
+
+        try:
+            res = self.thread_data.current_es.search(size=size, body=query, **extra_args)
+            if len(res.get('_shards', {}).get('failures', [])) > 0:
+                raise ElasticsearchException(str(res['_shards']['failures']))
+        except ElasticsearchException as e:
+            if len(str(e)) > 1024:
+                e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
+            self.handle_error('Error running query: %s' % (e), {'rule': rule['name'], 'query': query})
+            return None, pit_id, None
+
+        hits = res['hits']['hits']
+        self.thread_data.num_hits += len(hits)
+        next_search_after = hits[-1]['sort'] if len(hits) == size else None
+        lt = rule.get('use_local_time')
+        status_log = "Queried rule %s from %s to %s: %s / %s hits" % (
+            rule['name'],
+            pretty_ts(starttime, lt),
+            pretty_ts(endtime, lt),
+            self.thread_data.num_hits,
+            len(hits)
+        )
+        if next_search_after is not None:
+            elastalert_logger.info("%s (paging..)" % status_log)
+        else:
+            elastalert_logger.info(status_log)
+
+        hits = self.process_hits(rule, hits)
+        if 'doc_type' not in rule and len(hits):
+            rule['doc_type'] = hits[0].get('_type', '_doc')
+        return hits, res.get('pit_id', pit_id), next_search_after
+
     def get_starttime(self, rule):
         """ Query ES for the last time we ran this rule.
 
         :param rule: The rule configuration.
         :return: A timestamp or None.
         """
+        if self.use_rule_checkpoints:
+            checkpoint = self.get_checkpoint(rule)
+            if checkpoint is not None:
+                self.set_checkpoint_counters(rule, checkpoint)
+                return self.get_checkpoint_endtime(rule, checkpoint)
+
         sort = {'sort': {'@timestamp': {'order': 'desc'}}}
         query = {'filter': {'term': {'rule_name': '%s' % (rule['name'])}}}
         if self.writeback_es.is_atleastfive():
@@ -710,16 +1254,77 @@ class ElastAlerter(object):
                 res = self.writeback_es.deprecated_search(index=index, doc_type=doc_type,
                                                           size=1, body=query, _source_include=['endtime', 'rule_name'])
             if res['hits']['hits']:
-                endtime = ts_to_dt(res['hits']['hits'][0]['_source']['endtime'])
-
-                if ts_now() - endtime < self.old_query_limit:
-                    return endtime
-                else:
-                    elastalert_logger.info("Found expired previous run for %s at %s" % (rule['name'], endtime))
-                    return None
+                return self.get_checkpoint_endtime(rule, res['hits']['hits'][0]['_source'])
         except (ElasticsearchException, KeyError) as e:
             self.handle_error('Error querying for last run: %s' % (e), {'rule': rule['name']})
 
+    def get_checkpoint_endtime(self, rule, checkpoint):
+        """ Returns the endtime of the last run of a rule, from its checkpoint or status, or None if it is too old. """
+        endtime = ts_to_dt(checkpoint['endtime'])
+        if ts_now() - endtime < self.old_query_limit:
+            return endtime
+        elastalert_logger.info("Found expired previous run for %s at %s" % (rule['name'], endtime))
+        return None
+
+    @staticmethod
+    def get_checkpoint_id(rule):
+        """ Returns the _id of the checkpoint of a rule, a hash of its name. """
+        return hashlib.sha1(rule['name'].encode('utf-8')).hexdigest()
+
+    def load_checkpoints(self, rules):
+        """ Reads the checkpoints of rules with a single multi get. """
+        index = self.writeback_es.resolve_writeback_index(self.writeback_index, 'elastalert_checkpoint')
+        body = {'ids': [self.get_checkpoint_id(rule) for rule in rules]}
+        try:
+            if self.writeback_es.is_atleastsixtwo():
+                res = self.writeback_es.mget(index=index, body=body)
+            else:
+                res = self.writeback_es.mget(index=index, doc_type='elastalert_checkpoint', body=body)
+        except ElasticsearchException as e:
+            self.handle_error('Error reading rule checkpoints: %s' % (e))
+            return
+        found = set()
+        for doc in res['docs']:
+            if doc.get('found'):
+                self.checkpoints[doc['_source']['rule_name']] = doc['_source']
+                found.add(doc['_id'])
+        self.missing_checkpoints.update(rule['name'] for rule in rules if self.get_checkpoint_id(rule) not in found)
+
+    def get_checkpoint(self, rule):
+        """ Returns the checkpoint of a rule, read at startup or, the next times, from writeback_es, or None. """
+        if rule['name'] in self.checkpoints:
+            return self.checkpoints.pop(rule['name'])
+        if rule['name'] in self.missing_checkpoints:
+            self.missing_checkpoints.discard(rule['name'])
+            return None
+        index = self.writeback_es.resolve_writeback_index(self.writeback_index, 'elastalert_checkpoint')
+        try:
+            if self.writeback_es.is_atleastsixtwo():
+                return self.writeback_es.get(index=index, id=self.get_checkpoint_id(rule))['_source']
+            return self.writeback_es.get(index=index, doc_type='elastalert_checkpoint', id=self.get_checkpoint_id(rule))['_source']
+        except NotFoundError:
+            return None
+        except ElasticsearchException as e:
+            self.handle_error('Error reading checkpoint: %s' % (e), {'rule': rule['name']})
+            return None
+
+    @staticmethod
+    def set_checkpoint_counters(rule, checkpoint=None):
+        checkpoint = checkpoint or {}
+        rule['checkpoint_counters'] = {counter: checkpoint.get(counter, 0) for counter in ('runs', 'total_hits', 'total_matches')}
+
+    def write_checkpoint(self, rule, status):
+        """ Upserts the checkpoint of a rule, from the status of its last run and its counters. """
+        if 'checkpoint_counters' not in rule:
+            # The rule did not resume from its checkpoint, carry on from its counters
+            self.set_checkpoint_counters(rule, self.get_checkpoint(rule))
+        counters = rule['checkpoint_counters']
+        counters['runs'] += 1
+        counters['total_hits'] += status['hits']
+        counters['total_matches'] += status['matches']
+        body = dict(status, **counters)
+        self.writeback('elastalert_checkpoint', body, doc_id=self.get_checkpoint_id(rule))
+
     def set_starttime(self, rule, endtime):
         """ Given a rule and an endtime, sets the appropriate starttime for it. """
         # This means we are starting fresh
@@ -743,8 +1348,12 @@ class ElastAlerter(object):
                 buffer_delta = endtime - buffer_time
             else:
                 buffer_delta = endtime - rule['timeframe']
+            # Rules querying on ingest time only need documents ingested since the previous run. Documents ingested
+            # shortly before it may not have been searchable yet, so they are fetched again and duplicates are dropped
+            if rule.get('ingest_timestamp_field') and 'previous_endtime' in rule and not rule.get('aggregation_query_element'):
+                rule['starttime'] = rule['previous_endtime'] - rule.get('ingest_timestamp_overlap', INGEST_TIMESTAMP_OVERLAP)
             # If we started using a previous run, don't go past that
-            if 'minimum_starttime' in rule and rule['minimum_starttime'] > buffer_delta:
+            elif 'minimum_starttime' in rule and rule['minimum_starttime'] > buffer_delta:
                 rule['starttime'] = rule['minimum_starttime']
             # If buffer_time doesn't bring us past the previous endtime, use that instead
             elif 'previous_endtime' in rule and rule['previous_endtime'] < buffer_delta:
@@ -789,6 +1398,8 @@ class ElastAlerter(object):
         """ The segment size is either buffer_size for queries which can overlap or run_every for queries
         which must be strictly separate. This mimicks the query size for when ElastAlert is running continuously. """
         if not rule.get('use_count_query') and not rule.get('use_terms_query') and not rule.get('aggregation_query_element'):
+            if rule.get('adaptive_segment_size') and 'hit_density' in rule:
+                return self.get_adaptive_segment_size(rule)
             return rule.get('buffer_time', self.buffer_time)
         elif rule.get('aggregation_query_element'):
             if rule.get('use_run_every_query_size'):
@@ -798,6 +1409,256 @@ class ElastAlerter(object):
         else:
             return self.run_every
 
+    def get_adaptive_segment_size(self, rule):
+        """ Returns a segment size which is expected to hold at most 80% of max_query_size hits, based on the
+        hit density observed in previous runs, between the rule's run_every and old_query_limit. """
+        max_query_size = rule.get('max_query_size', self.max_query_size)
+        # The density of quiet rules decays towards 0 without reaching it, compare in seconds so it cannot overflow
+        if rule['hit_density'] * total_seconds(self.old_query_limit) <= 0.8 * max_query_size:
+            return max(rule.get('run_every', self.run_every), self.old_query_limit)
+        segment_size = datetime.timedelta(seconds=0.8 * max_query_size / rule['hit_density'])
+        return max(rule.get('run_every', self.run_every), segment_size)
+
+    @staticmethod
+    def update_hit_density(rule, hits, starttime, endtime):
+        """ Updates the moving average of the number of hits per second a rule has seen. """
+        seconds = total_seconds(endtime - starttime)
+        if seconds <= 0:
+            return
+        density = hits / seconds
+        if 'hit_density' in rule:
+            density = 0.7 * rule['hit_density'] + 0.3 * density
+        rule['hit_density'] = density
+
+    def use_histogram_backfill(self, rule, endtime, segment_size):
+        """ Returns True if a count or terms rule is backfilling more than one full segment and
+        use_date_histogram_backfill is set, so the segments can be counted with date_histogram queries. """
+        if not rule.get('use_date_histogram_backfill') or not rule.get('five'):
+            return False
+        if not rule.get('use_count_query') and not (rule.get('use_terms_query') and rule.get('query_key')):
+            return False
+        return endtime - rule['starttime'] > 2 * segment_size
+
+    def run_histogram_backfill(self, rule, endtime, segment_size):
+        """ Counts every full segment between the rule's starttime and endtime with date_histogram
+        aggregations, with a terms sub aggregation for terms rules, instead of one query per segment.
+        The buckets are passed to the RuleType one segment at a time, in order, exactly as if each
+        segment had been queried on its own.
+
+        :param rule: The rule configuration.
+        :param endtime: The latest timestamp to query.
+        :param segment_size: The size of each segment.
+        Returns True on success and False on failure.
+        """
+        num_segments = int(total_seconds(endtime - rule['starttime']) // total_seconds(segment_size))
+        if endtime - rule['starttime'] == num_segments * segment_size:
+            num_segments -= 1
+        # Keep each query under the default search.max_buckets
+        if rule.get('use_terms_query'):
+            chunk_size = max(1, 10000 // (rule.get('terms_size', 50) + 1))
+        else:
+            chunk_size = 10000
+        while num_segments > 0:
+            segments = min(num_segments, chunk_size)
+            counts = self.get_histogram_counts(rule, rule['starttime'], segment_size, segments)
+            if counts is None:
+                return False
+            for count in counts:
+                segment_end = rule['starttime'] + segment_size
+                if rule.get('use_count_query'):
+                    rule['type'].add_count_data({segment_end: count})
+                    self.thread_data.cumulative_hits += count
+                else:
+                    rule['type'].add_terms_data({segment_end: count})
+                    self.thread_data.cumulative_hits += len(count)
+                rule['starttime'] = segment_end
+                rule['type'].garbage_collect(segment_end)
+            num_segments -= segments
+        return True
+
+    def get_histogram_counts(self, rule, starttime, segment_size, num_segments):
+        """ Queries the counts, or the terms buckets for terms rules, of num_segments consecutive segments
+        starting at starttime with a single date_histogram aggregation.
+
+        :return: A list with the count or terms buckets of each segment, or None if the query failed.
+        """
+        endtime = starttime + segment_size * num_segments
+        start, end = starttime, endtime
+        if rule.get('query_timezone') != "":
+            start = ts_utc_to_tz(start, rule.get('query_timezone'))
+            end = ts_utc_to_tz(end, rule.get('query_timezone'))
+        query = self.get_query(
+            rule['filter'],
+            start,
+            end,
+            timestamp_field=rule['timestamp_field'],
+            sort=False,
+            to_ts_func=rule['dt_to_ts'],
+            five=rule['five']
+        )
+
+        # Buckets hold [key, key + interval) while segments hold (start, end], move them up by 1ms to match
+        interval_ms = int(total_seconds(segment_size) * 1000)
+        first_key = dt_to_unixms(starttime) + 1
+        histogram = {'field': rule['timestamp_field'],
+                     'interval': '%sms' % interval_ms,
+                     'offset': '+%sms' % (first_key % interval_ms),
+                     'min_doc_count': 0,
+                     'extended_bounds': {'min': first_key, 'max': dt_to_unixms(endtime)}}
+        query['aggs'] = {'segments': {'date_histogram': histogram}}
+        if rule.get('use_terms_query'):
+            query['aggs']['segments']['aggs'] = {'counts': {'terms': {'field': rule['query_key'],
+                                                                      'size': rule.get('terms_size', 50),
+                                                                      'min_doc_count': rule.get('min_doc_count', 1)}}}
+
+        index = self.resolve_index(rule, start, end)
+        try:
+            res = self.thread_data.current_es.search(index=index, body=query, size=0, ignore_unavailable=True)
+        except ElasticsearchException as e:
+            if len(str(e)) > 1024:
+                e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
+            self.handle_error('Error running date histogram query: %s' % (e), {'rule': rule['name'], 'query': query})
+            return None
+
+        counts = [[] if rule.get('use_terms_query') else 0] * num_segments
+        for bucket in res.get('aggregations', {}).get('segments', {}).get('buckets', []):
+            segment = (bucket['key'] - first_key) // interval_ms
+            if 0 <= segment < num_segments:
+                counts[segment] = bucket['counts']['buckets'] if rule.get('use_terms_query') else bucket['doc_count']
+        lt = rule.get('use_local_time')
+        elastalert_logger.info("Queried rule %s from %s to %s: %s segments" % (
+            rule['name'], pretty_ts(starttime, lt), pretty_ts(endtime, lt), num_segments))
+        return counts
+
+    def use_segment_prefetch(self, rule, endtime, segment_size):
+        """ Returns True if the rule is backfilling more than one full segment of a hits query
+        and segment_prefetch is set, so upcoming segments can be fetched concurrently. """
+        if not rule.get('segment_prefetch'):
+            return False
+        if rule.get('use_count_query') or rule.get('use_terms_query') or rule.get('aggregation_query_element'):
+            return False
+        return endtime - rule['starttime'] > 2 * segment_size
+
+    def run_prefetched_segments(self, rule, endtime, segment_size):
+        """ Runs every full segment between the rule's starttime and endtime, fetching the segment being processed
+        and up to segment_prefetch upcoming ones concurrently. Each segment is fetched a page at a time, and at most
+        SEGMENT_PREFETCH_PAGES pages of a segment wait to be processed. Pages are passed to the RuleType strictly
+        in timestamp order, exactly as if the segments had been queried one after another.
+
+        :param rule: The rule configuration.
+        :param endtime: The latest timestamp to query.
+        :param segment_size: The size of each segment.
+        Returns True on success and False on failure.
+        """
+        segments = []
+        segment_start = rule['starttime']
+        while endtime - segment_start > segment_size:
+            segments.append((segment_start, segment_start + segment_size))
+            segment_start += segment_size
+        segments = iter(segments)
+
+        es = self.thread_data.current_es
+        num_workers = rule['segment_prefetch']
+        # Set to stop fetching pages when the backfill is over
+        stop = threading.Event()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            prefetched = collections.deque()
+
+            def prefetch_next():
+                for segment_start, segment_end in itertools.islice(segments, 1):
+                    pages = queue.Queue(maxsize=SEGMENT_PREFETCH_PAGES)
+                    future = executor.submit(self.fetch_segment, rule, es, segment_start, segment_end, pages, stop)
+                    prefetched.append((segment_end, pages, future))
+
+            try:
+                for _ in range(num_workers):
+                    prefetch_next()
+
+                while prefetched:
+                    segment_end, pages, future = prefetched.popleft()
+                    # The segments already being fetched have a worker each, the next one starts once one is free
+                    prefetch_next()
+                    while True:
+                        data = pages.get()
+                        if data is None:
+                            break
+                        old_len = len(data)
+                        data = self.remove_duplicate_events(data, rule)
+                        self.thread_data.num_dupes += old_len - len(data)
+                        if data:
+                            rule['type'].add_data(data)
+                    num_hits = future.result()
+                    if num_hits is None:
+                        return False
+                    self.thread_data.cumulative_hits += num_hits
+                    rule['starttime'] = segment_end
+                    rule['type'].garbage_collect(segment_end)
+            finally:
+                stop.set()
+                for _, _, pending in prefetched:
+                    pending.cancel()
+
+        return True
+
+    def fetch_segment(self, rule, es, starttime, endtime, pages, stop):
+        """ Fetches the hits of one segment for run_prefetched_segments, scrolling, or paging from a point in time
+        with use_point_in_time, and puts each page of processed hits in the pages queue, followed by None.
+        Runs in a prefetch thread with its own hit counters, and keeps scroll state
+        on a copy of the rule so concurrent segments do not interfere.
+
+        :return: The number of hits, or None on failure.
+        """
+        self.thread_data.current_es = es
+        self.thread_data.num_hits = 0
+        self.thread_data.num_dupes = 0
+        self.thread_data.total_hits = 0
+        segment_rule = dict(rule, scrolling_cycle=1)
+        segment_rule.pop('scroll_id', None)
+
+        def put(page):
+            # Waits for the page to be taken, unless the backfill stopped
+            while not stop.is_set():
+                try:
+                    pages.put(page, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        if rule.get('query_timezone') != "":
+            starttime = ts_utc_to_tz(starttime, rule.get('query_timezone'))
+            endtime = ts_utc_to_tz(endtime, rule.get('query_timezone'))
+        index = self.resolve_index(rule, starttime, endtime)
+
+        try:
+            if self.use_point_in_time(rule):
+                for data in self.get_point_in_time_pages(segment_rule, starttime, endtime, index):
+                    if data is None or (data and not put(data)):
+                        return None
+            else:
+                data = self.get_hits(segment_rule, starttime, endtime, index)
+                while data is not None:
+                    if data and not put(data):
+                        return None
+                    if not (segment_rule.get('scroll_id') and self.thread_data.num_hits < self.thread_data.total_hits
+                            and should_scrolling_continue(segment_rule)):
+                        break
+                    segment_rule['scrolling_cycle'] += 1
+                    data = self.get_hits(segment_rule, starttime, endtime, index, scroll=True)
+                if data is None:
+                    return None
+        finally:
+            if 'scroll_id' in segment_rule:
+                try:
+                    es.clear_scroll(scroll_id=segment_rule['scroll_id'])
+                except NotFoundError:
+                    pass
+            put(None)
+
+        if 'doc_type' in segment_rule:
+            rule.setdefault('doc_type', segment_rule['doc_type'])
+        return self.thread_data.num_hits
+
     def get_query_key_value(self, rule, match):
         # get the value for the match's query_key (or none) to form the key used for the silence_cache.
         # Flatline ruletype sets "key" instead of the actual query_key
@@ -900,6 +1761,13 @@ class ElastAlerter(object):
         # Run the rule. If querying over a large time period, split it up into segments
         segment_size = self.get_segment_size(rule)
 
+        if self.use_segment_prefetch(rule, endtime, segment_size):
+            if not self.run_prefetched_segments(rule, endtime, segment_size):
+                return 0
+        elif self.use_histogram_backfill(rule, endtime, segment_size):
+            if not self.run_histogram_backfill(rule, endtime, segment_size):
+                return 0
+
         tmp_endtime = rule['starttime']
 
         while endtime - rule['starttime'] > segment_size:
@@ -962,7 +1830,7 @@ class ElastAlerter(object):
 
             # If no aggregation, alert immediately
             if not rule['aggregation']:
-                self.alert([match], rule)
+                self.dispatch_alert([match], rule)
                 continue
 
             # Add it as an aggregated match
@@ -971,6 +1839,10 @@ class ElastAlerter(object):
         # Mark this endtime for next run's start
         rule['previous_endtime'] = endtime
 
+        if rule.get('adaptive_segment_size'):
+            self.update_hit_density(rule, max(self.thread_data.num_hits, self.thread_data.cumulative_hits),
+                                    rule['original_starttime'], endtime)
+
         time_taken = time.time() - run_start
         # Write to ES that we've run this rule against this time period
         body = {'rule_name': rule['name'],
@@ -980,10 +1852,23 @@ class ElastAlerter(object):
                 'hits': max(self.thread_data.num_hits, self.thread_data.cumulative_hits),
                 '@timestamp': ts_now(),
                 'time_taken': time_taken}
-        self.writeback('elastalert_status', body)
+        if self.use_rule_checkpoints:
+            self.write_checkpoint(rule, dict(body))
+        if self.write_status_history:
+            self.writeback('elastalert_status', body)
 
         return num_matches
 
+    def init_rules(self, rules):
+        """ Initializes rules, startup_threads at a time, and returns the rules which were initialized, in order. """
+        startup_threads = self.conf.get('startup_threads', 1)
+        if startup_threads > 1 and len(rules) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=startup_threads) as executor:
+                initialized = list(executor.map(self.init_rule, rules))
+        else:
+            initialized = list(map(self.init_rule, rules))
+        return [rule for rule in initialized if rule]
+
     def init_rule(self, new_rule, new=True):
         ''' Copies some necessary non-config state from an exiting rule to a new rule. '''
         if not new and self.scheduler.get_job(job_id=new_rule['name']):
@@ -1042,22 +1927,87 @@ class ElastAlerter(object):
                            'processed_hits',
                            'starttime',
                            'minimum_starttime',
-                           'has_run_once']
+                           'has_run_once',
+                           'hit_density',
+                           'checkpoint_counters']
         for prop in copy_properties:
             if prop not in rule:
                 continue
             new_rule[prop] = rule[prop]
 
-        job = self.scheduler.add_job(self.handle_rule_execution, 'interval',
-                                     args=[new_rule],
-                                     seconds=new_rule['run_every'].total_seconds(),
-                                     id=new_rule['name'],
-                                     max_instances=1,
-                                     jitter=5)
-        job.modify(next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=random.randint(0, 15)))
+        if new_rule.get('use_query_plan'):
+            new_rule['query_plan'] = self.compile_query_plan(new_rule)
+
+        if new_rule.get('use_msearch_batching'):
+            # Batched rules start without jitter so that rules due in the same tick run (and query) together
+            job = self.scheduler.add_job(self.handle_rule_execution, 'interval',
+                                         args=[new_rule],
+                                         seconds=new_rule['run_every'].total_seconds(),
+                                         id=new_rule['name'],
+                                         max_instances=1)
+            job.modify(next_run_time=datetime.datetime.now())
+        elif self.execution_mode == 'deadline':
+            # The scheduler spreads the first runs of rules over run_every
+            self.scheduler.add_job(self.handle_rule_execution, 'interval',
+                                   args=[new_rule],
+                                   seconds=new_rule['run_every'].total_seconds(),
+                                   id=new_rule['name'])
+        else:
+            job = self.scheduler.add_job(self.handle_rule_execution, 'interval',
+                                         args=[new_rule],
+                                         seconds=new_rule['run_every'].total_seconds(),
+                                         id=new_rule['name'],
+                                         max_instances=1,
+                                         jitter=5)
+            job.modify(next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=random.randint(0, 15)))
 
         return new_rule
 
+    def compile_query_plan(self, rule):
+        """ Builds and serializes the queries a rule runs, once, so that each run only substitutes
+        its time range into the pre-serialized bodies. """
+        def keep_placeholder(ts):
+            return ts
+
+        start, end = STARTTIME_PLACEHOLDER, ENDTIME_PLACEHOLDER
+        plan = QueryPlan()
+        if not rule.get('use_strftime_index'):
+            plan.index = self.get_index(rule)
+        if rule.get('use_count_query'):
+            query = self.get_query(rule['filter'], start, end, timestamp_field=rule['timestamp_field'], sort=False,
+                                   to_ts_func=keep_placeholder, five=rule['five'])
+            plan.count = QueryTemplate(query, rule['dt_to_ts'])
+        elif rule.get('use_terms_query'):
+            query = self.build_terms_query(rule, start, end, rule.get('query_key'), to_ts_func=keep_placeholder)
+            plan.terms = QueryTemplate(query, rule['dt_to_ts'])
+        elif rule.get('aggregation_query_element'):
+            # The bucket offset of interval synced queries changes every run
+            if not rule.get('bucket_interval'):
+                query = self.build_aggregation_query(rule, start, end, rule.get('query_key'), to_ts_func=keep_placeholder)
+                plan.aggregation = QueryTemplate(query, rule['dt_to_ts'])
+        else:
+            query = self.get_hits_query(rule, start, end, to_ts_func=keep_placeholder)
+            self.add_stored_fields(rule, query)
+            if rule.get('_source_enabled'):
+                plan.source_includes = ','.join(rule['include'])
+            plan.hits = QueryTemplate(query, dt_to_ts if rule.get('ingest_timestamp_field') else rule['dt_to_ts'])
+        return plan
+
+    @staticmethod
+    def get_rule_lag(rule):
+        """ Returns the number of seconds the queries of a rule are behind: the time since the end of its last query,
+        less its query_delay. """
+        if not rule.get('previous_endtime'):
+            return 0
+        lag = ts_now() - rule['previous_endtime'] - rule.get('query_delay', datetime.timedelta())
+        return max(lag.total_seconds(), 0)
+
+    def get_job_lag(self, job):
+        """ Returns the lag of the rule a scheduler job runs, or 0 for the internal jobs. """
+        if not job.args:
+            return 0
+        return self.get_rule_lag(job.args[0])
+
     @staticmethod
     def modify_rule_for_ES5(new_rule):
         # Get ES version per rule
@@ -1077,10 +2027,135 @@ class ElastAlerter(object):
                 new_filters.append(es_filter)
         new_rule['filter'] = new_filters
 
+    def owns_rule_file(self, rule_file):
+        """ Returns True if the rule loaded from rule_file is run by this process. With cluster_sharding,
+        every worker process loads every rule and the hash ring assigns them. """
+        return self.worker_index is None or self.cluster_sharding or \
+            rule_worker(rule_file, self.worker_processes) == self.worker_index
+
+    def owns_rule(self, rule):
+        """ Returns True if this instance runs the rule. With cluster_sharding, rules are assigned to the live
+        instances by consistent hashing of their names, and the rules of other instances are kept on standby.
+        Until the live instances have been read, no rule is run with cluster_sharding. """
+        if self.hash_ring is None:
+            return not self.cluster_sharding
+        return self.hash_ring.get(rule['name']) == self.instance_id
+
+    def send_heartbeat(self):
+        """ Writes the heartbeat of this instance to the writeback index, replacing the previous one. """
+        body = {'instance_id': self.instance_id, 'hostname': gethostname(), '@timestamp': dt_to_ts(ts_now())}
+        try:
+            index = self.writeback_es.resolve_writeback_index(self.writeback_index, 'elastalert_heartbeat')
+            if self.writeback_es.is_atleastsixtwo():
+                self.writeback_es.index(index=index, id=self.instance_id, body=body)
+            else:
+                self.writeback_es.index(index=index, doc_type='elastalert_heartbeat', id=self.instance_id, body=body)
+        except ElasticsearchException as e:
+            elastalert_logger.exception("Error writing heartbeat to Elasticsearch: %s" % (e))
+
+    def remove_heartbeat(self):
+        """ Stops sending heartbeats and deletes the heartbeat of this instance, so that the other instances take over
+        its rules right away. """
+        self.heartbeat_stop.set()
+        if self.heartbeat_thread is not None and self.heartbeat_thread is not threading.current_thread():
+            self.heartbeat_thread.join(self.heartbeat_interval)
+        try:
+            index = self.writeback_es.resolve_writeback_index(self.writeback_index, 'elastalert_heartbeat')
+            if self.writeback_es.is_atleastsixtwo():
+                self.writeback_es.delete(index=index, id=self.instance_id)
+            else:
+                self.writeback_es.delete(index=index, doc_type='elastalert_heartbeat', id=self.instance_id)
+        except ElasticsearchException as e:
+            elastalert_logger.warning("Error deleting heartbeat from Elasticsearch: %s" % (e))
+
+    def get_live_instances(self):
+        """ Returns the ids of the instances with a heartbeat in the last heartbeat_timeout seconds,
+        or None if they could not be read. """
+        time_filter = {'range': {'@timestamp': {'gte': dt_to_ts(ts_now() - datetime.timedelta(seconds=self.heartbeat_timeout))}}}
+        if self.writeback_es.is_atleastfive():
+            query = {'query': {'bool': {'filter': time_filter}}}
+        else:
+            query = {'filter': time_filter}
+        try:
+            index = self.writeback_es.resolve_writeback_index(self.writeback_index, 'elastalert_heartbeat')
+            if self.writeback_es.is_atleastsixtwo():
+                res = self.writeback_es.search(index=index, body=query, size=1000)
+            else:
+                res = self.writeback_es.deprecated_search(index=index, doc_type='elastalert_heartbeat', body=query, size=1000)
+        except ElasticsearchException as e:
+            elastalert_logger.exception("Error reading heartbeats from Elasticsearch: %s" % (e))
+            return None
+        return set(hit['_source']['instance_id'] for hit in res['hits']['hits'])
+
+    def run_heartbeats(self):
+        """ Handles the heartbeat every heartbeat_interval seconds until remove_heartbeat. Heartbeats are sent from a
+        thread of their own, so that rules keeping every rule thread busy cannot delay them past heartbeat_timeout,
+        which would let the other instances take over the rules of this one while it still runs them. """
+        while not self.heartbeat_stop.wait(self.heartbeat_interval):
+            try:
+                self.handle_heartbeat()
+            except Exception:
+                elastalert_logger.exception('Error handling heartbeat')
+
+    def handle_heartbeat(self):
+        """ Sends the heartbeat of this instance and, if the live instances changed, rebuilds the hash ring.
+        Rules this instance takes over resume from the last endtime their previous owner wrote to its checkpoint
+        or to elastalert_status. Their state is reset by their next run, as they may still be running. """
+        self.send_heartbeat()
+        instances = self.get_live_instances()
+        if instances is None:
+            return
+        instances.add(self.instance_id)
+        if self.hash_ring is not None and instances == self.hash_ring.members:
+            return
+
+        first_ring = self.hash_ring is None
+        owned = set(rule['name'] for rule in self.rules if self.owns_rule(rule))
+        self.hash_ring = HashRing(instances)
+        num_owned = 0
+        for rule in self.rules:
+            if not self.owns_rule(rule):
+                continue
+            num_owned += 1
+            if not first_ring and rule['name'] not in owned:
+                elastalert_logger.info('Taking over rule %s' % (rule['name']))
+                rule['reset_state'] = True
+        elastalert_logger.info('%s ElastAlert instances are running, this instance runs %s of %s rules' % (
+            len(instances), num_owned, len(self.rules)))
+
+    def reset_rule_state(self, rule):
+        """ Forgets what a rule learned while this instance last ran it, when it takes the rule over from another
+        instance, so that it resumes from the checkpoint or status of the previous owner with a new RuleType. """
+        for key in ('starttime', 'previous_endtime', 'minimum_starttime', 'checkpoint_counters'):
+            rule.pop(key, None)
+        self.checkpoints.pop(rule['name'], None)
+        self.missing_checkpoints.discard(rule['name'])
+        rule['processed_hits'] = {}
+        rule['current_aggregate_id'] = {}
+        rule['aggregate_alert_time'] = {}
+        try:
+            rule['type'] = type(rule['type'])(rule, self.args)
+        except (KeyError, EAException) as e:
+            self.handle_error('Error resetting rule %s: %s' % (rule['name'], e), {'rule': rule['name']})
+
+    def get_rule_hashes(self):
+        """ Returns the hashes of the rule files run by this process. Worker processes don't read the rule files,
+        but use the latest hashes sent by their WorkerPool. """
+        if self.rule_hashes_queue is None or self.rule_hashes is None:
+            rule_hashes = self.rules_loader.get_hashes(self.conf, self.args.rule)
+        else:
+            rule_hashes = self.rule_hashes
+            while True:
+                try:
+                    rule_hashes = self.rule_hashes_queue.get_nowait()
+                except queue.Empty:
+                    break
+        return dict((rule_file, hash_value) for rule_file, hash_value in rule_hashes.items() if self.owns_rule_file(rule_file))
+
     def load_rule_changes(self):
         """ Using the modification times of rule config files, syncs the running rules
             to match the files in rules_folder by removing, adding or reloading rules. """
-        new_rule_hashes = self.rules_loader.get_hashes(self.conf, self.args.rule)
+        new_rule_hashes = self.get_rule_hashes()
 
         # Check each current rule for changes
         for rule_file, hash_value in self.rule_hashes.items():
@@ -1165,6 +2240,16 @@ class ElastAlerter(object):
                     self.rules.append(new_rule)
 
         self.rule_hashes = new_rule_hashes
+        self.prune_es_clients()
+
+    def prune_es_clients(self):
+        """ Drops the Elasticsearch clients of rules which are no longer loaded. """
+        rule_names = set(rule['name'] for rule in self.rules)
+        for name in list(self.es_clients):
+            if name not in rule_names:
+                self.es_clients.pop(name)
+        if self.conf.get('es_client_registry'):
+            prune_es_client_registry([self.conf] + self.rules)
 
     def start(self):
         """ Periodically go through each rule and run it """
@@ -1181,12 +2266,27 @@ class ElastAlerter(object):
         for rule in self.rules:
             rule['initial_starttime'] = self.starttime
         self.wait_until_responsive(timeout=self.args.timeout)
+        if self.writeback_buffer and self.writeback_buffer.spool is not None:
+            # Write the alerts spooled before a restart, so that they are found by handle_pending_alerts
+            self.writeback_buffer.flush()
+        self.load_silences()
         self.running = True
         elastalert_logger.info("Starting up")
         self.scheduler.add_job(self.handle_pending_alerts, 'interval',
                                seconds=self.run_every.total_seconds(), id='_internal_handle_pending_alerts')
         self.scheduler.add_job(self.handle_config_change, 'interval',
                                seconds=self.run_every.total_seconds(), id='_internal_handle_config_change')
+        if self.cluster_sharding:
+            self.handle_heartbeat()
+            if self.hash_ring is None:
+                elastalert_logger.warning('Could not read the live ElastAlert instances, rules will start once they are read')
+            self.heartbeat_thread = threading.Thread(target=self.run_heartbeats, name='elastalert-heartbeat', daemon=True)
+            self.heartbeat_thread.start()
+        if self.use_rule_checkpoints:
+            # Rules taken over later read their checkpoint then, as it was written by their previous owner
+            owned_rules = [rule for rule in self.rules if self.owns_rule(rule)]
+            if owned_rules:
+                self.load_checkpoints(owned_rules)
         self.scheduler.start()
         while self.running:
             next_run = datetime.datetime.utcnow() + self.run_every
@@ -1196,6 +2296,10 @@ class ElastAlerter(object):
                 endtime = ts_to_dt(self.args.end)
 
                 if next_run.replace(tzinfo=dateutil.tz.tzutc()) > endtime:
+                    if self.alert_dispatcher:
+                        self.alert_dispatcher.join()
+                    if self.writeback_buffer:
+                        self.writeback_buffer.shutdown()
                     exit(0)
 
             if next_run < datetime.datetime.utcnow():
@@ -1253,6 +2357,7 @@ class ElastAlerter(object):
         self.handle_config_change()
 
     def handle_pending_alerts(self):
+        self.load_silences()
         self.thread_data.alerts_sent = 0
         self.send_pending_alerts()
         elastalert_logger.info("Background alerts thread %s pending alerts sent at %s" % (self.thread_data.alerts_sent,
@@ -1264,6 +2369,11 @@ class ElastAlerter(object):
             elastalert_logger.info("Background configuration change check run at %s" % (pretty_ts(ts_now())))
 
     def handle_rule_execution(self, rule):
+        if not self.owns_rule(rule):
+            # Another instance runs this rule
+            return
+        if rule.pop('reset_state', False):
+            self.reset_rule_state(rule)
         self.thread_data.alerts_sent = 0
         next_run = datetime.datetime.utcnow() + rule['run_every']
         # Set endtime based on the rule's delay
@@ -1295,6 +2405,9 @@ class ElastAlerter(object):
         rule['has_run_once'] = True
         try:
             num_matches = self.run_rule(rule, endtime, rule.get('initial_starttime'))
+            if self.alert_dispatcher:
+                # Alerts are sent by the dispatch workers, count the ones sent since the last run
+                self.thread_data.alerts_sent += self.alert_dispatcher.pop_sent(rule['name'])
         except EAException as e:
             self.handle_error("Error running rule %s: %s" % (rule['name'], e), {'rule': rule['name']})
         except Exception as e:
@@ -1357,6 +2470,12 @@ class ElastAlerter(object):
     def stop(self):
         """ Stop an ElastAlert runner that's been started """
         self.running = False
+        if self.alert_dispatcher:
+            self.shutdown_alert_dispatcher()
+        if self.writeback_buffer:
+            self.writeback_buffer.shutdown()
+        if self.cluster_sharding:
+            self.remove_heartbeat()
 
     def get_disabled_rules(self):
         """ Return disabled rules """
@@ -1491,6 +2610,31 @@ class ElastAlerter(object):
             return None
         return filters
 
+    def dispatch_alert(self, matches, rule):
+        """ Sends an alert from the alert dispatch queue if alert_dispatch_workers is set, and right away otherwise. """
+        if self.alert_dispatcher is None:
+            return self.alert(matches, rule)
+        self.alert_dispatcher.dispatch(matches, rule, self.thread_data.current_es)
+
+    def send_dispatched_alert(self, matches, rule, current_es):
+        """ Sends an alert in an alert dispatch worker, querying top_count_keys with the client of the rule's run.
+        Returns the number of alerters which sent it. """
+        self.thread_data.current_es = current_es
+        self.thread_data.alerts_sent = 0
+        self.alert(matches, rule)
+        return self.thread_data.alerts_sent
+
+    def shutdown_alert_dispatcher(self, timeout=None):
+        """ Sends the alerts waiting in the alert dispatch queue. Those which are not sent within timeout seconds are written
+        as pending alerts, as their realert silence is already written, so that handle_pending_alerts sends them later. """
+        unsent = self.alert_dispatcher.shutdown(timeout)
+        if unsent:
+            elastalert_logger.warning('Writing %s queued alerts as pending alerts to be sent later' % (len(unsent)))
+        for matches, rule in unsent:
+            alert_time = ts_now()
+            for match in matches:
+                self.writeback('elastalert', self.get_alert_body(match, rule, False, alert_time))
+
     def alert(self, matches, rule, alert_time=None, retried=False):
         """ Wraps alerting, Kibana linking and enhancements in an exception handler """
         try:
@@ -1636,7 +2780,7 @@ class ElastAlerter(object):
             body['alert_exception'] = alert_exception
         return body
 
-    def writeback(self, doc_type, body, rule=None, match_body=None):
+    def writeback(self, doc_type, body, rule=None, match_body=None, doc_id=None):
         # ES 2.0 - 2.3 does not support dots in field names.
         if self.replace_dots_in_field_names:
             writeback_body = replace_dots_in_field_names(body)
@@ -1655,50 +2799,98 @@ class ElastAlerter(object):
         if '@timestamp' not in writeback_body:
             writeback_body['@timestamp'] = dt_to_ts(ts_now())
 
+        spool = self.writeback_buffer is not None and self.writeback_buffer.spool is not None and doc_type in SPOOLED_DOC_TYPES
+        if spool:
+            # The _id is set up front, so a write which reached Elasticsearch but failed is not duplicated by the spool
+            doc_id = doc_id or uuid.uuid4().hex
+        index = self.writeback_es.resolve_writeback_index(self.writeback_index, doc_type)
         try:
-            index = self.writeback_es.resolve_writeback_index(self.writeback_index, doc_type)
+            if self.writeback_buffer and doc_type in BUFFERED_DOC_TYPES:
+                doc_id = doc_id or uuid.uuid4().hex
+                self.writeback_buffer.add(index, doc_type, doc_id, body)
+                return {'_index': index, '_id': doc_id, 'result': 'buffered'}
+            # Documents with a given _id replace the last one
+            id_args = {'id': doc_id} if doc_id else {}
             if self.writeback_es.is_atleastsixtwo():
-                res = self.writeback_es.index(index=index, body=body)
+                res = self.writeback_es.index(index=index, body=body, **id_args)
             else:
-                res = self.writeback_es.index(index=index, doc_type=doc_type, body=body)
+                res = self.writeback_es.index(index=index, doc_type=doc_type, body=body, **id_args)
             return res
         except ElasticsearchException as e:
+            if spool:
+                elastalert_logger.warning("Error writing alert info to Elasticsearch, spooling it to be written later: %s" % (e))
+                self.writeback_buffer.add(index, doc_type, doc_id, body)
+                return {'_index': index, '_id': doc_id, 'result': 'spooled'}
             elastalert_logger.exception("Error writing alert info to Elasticsearch: %s" % (e))
 
     def find_recent_pending_alerts(self, time_limit):
         """ Queries writeback_es to find alerts that did not send
         and are newer than time_limit """
 
-        # XXX only fetches 1000 results. If limit is reached, next loop will catch them
-        # unless there is constantly more than 1000 alerts to send.
-
         # Fetch recent, unsent alerts that aren't part of an aggregate, earlier alerts first.
         inner_query = {'query_string': {'query': '!_exists_:aggregate_id AND alert_sent:false'}}
         time_filter = {'range': {'alert_time': {'from': dt_to_ts(ts_now() - time_limit),
                                                 'to': dt_to_ts(ts_now())}}}
-        sort = {'sort': {'alert_time': {'order': 'asc'}}}
+        sort = {'sort': [{'alert_time': {'order': 'asc'}}]}
         if self.writeback_es.is_atleastfive():
             query = {'query': {'bool': {'must': inner_query, 'filter': time_filter}}}
         else:
             query = {'query': inner_query, 'filter': time_filter}
         query.update(sort)
         try:
-            if self.writeback_es.is_atleastsixtwo():
-                res = self.writeback_es.search(index=self.writeback_index, body=query, size=1000)
-            else:
-                res = self.writeback_es.deprecated_search(index=self.writeback_index,
-                                                          doc_type='elastalert', body=query, size=1000)
-            if res['hits']['hits']:
-                return res['hits']['hits']
+            return self.search_writeback_pages(query, 1000)
         except ElasticsearchException as e:
             elastalert_logger.exception("Error finding recent pending alerts: %s %s" % (e, query))
         return []
 
+    def search_writeback_pages(self, query, size, limit=None, doc_type='elastalert'):
+        """ Returns the hits of a sorted query of the doc_type writeback index. With Elasticsearch 5 and later, every hit,
+        or the first limit, is fetched in pages of size hits with search_after, sorting by _id last to break ties.
+        Older versions only return the first page, of limit hits if it is given. """
+        if not self.writeback_es.is_atleastfive():
+            size = limit or size
+        else:
+            query['sort'] = query['sort'] + [{'_id': {'order': 'asc'}}]
+        index = self.writeback_es.resolve_writeback_index(self.writeback_index, doc_type)
+        hits = []
+        search_after = None
+        while True:
+            page_size = size if limit is None else min(size, limit - len(hits))
+            body = query if search_after is None else dict(query, search_after=search_after)
+            if self.writeback_es.is_atleastsixtwo():
+                res = self.writeback_es.search(index=index, body=body, size=page_size)
+            else:
+                res = self.writeback_es.deprecated_search(index=index, doc_type=doc_type, body=body, size=page_size)
+            page = res['hits']['hits']
+            hits += page
+            if not self.writeback_es.is_atleastfive() or len(page) < page_size or len(hits) == limit:
+                return hits
+            search_after = page[-1]['sort']
+
+    def delete_writeback_hits(self, hits):
+        """ Deletes hits of the elastalert writeback index with bulk requests """
+        for start in range(0, len(hits), 1000):
+            body = []
+            for hit in hits[start:start + 1000]:
+                action = {'_index': hit['_index'], '_id': hit['_id']}
+                if not self.writeback_es.is_atleastsixtwo():
+                    action['_type'] = hit.get('_type', 'elastalert')
+                body.append({'delete': action})
+            try:
+                res = self.writeback_es.bulk(body=body)
+            except ElasticsearchException as e:
+                self.handle_error("Failed to delete %d alerts: %s" % (len(body), e))
+                continue
+            for item in res.get('items', []):
+                if item['delete'].get('error'):
+                    self.handle_error("Failed to delete alert %s: %s" % (item['delete']['_id'], item['delete']['error']))
+
     def send_pending_alerts(self):
         pending_alerts = self.find_recent_pending_alerts(self.alert_time_limit)
-        for alert in pending_alerts:
-            _id = alert['_id']
-            alert = alert['_source']
+        sent_alerts = []
+        for hit in pending_alerts:
+            _id = hit['_id']
+            alert = hit['_source']
             try:
                 rule_name = alert.pop('rule_name')
                 alert_time = alert.pop('alert_time')
@@ -1714,6 +2906,9 @@ class ElastAlerter(object):
             else:
                 # Original rule is missing, keep alert for later if rule reappears
                 continue
+            if not self.owns_rule(rule):
+                # The instance running the rule sends its alerts
+                continue
 
             # Set current_es for top_count_keys query
             self.thread_data.current_es = elasticsearch_client(rule)
@@ -1737,14 +2932,11 @@ class ElastAlerter(object):
                             rule['current_aggregate_id'].pop(qk)
                             break
 
-                # Delete it from the index
-                try:
-                    if self.writeback_es.is_atleastsixtwo():
-                        self.writeback_es.delete(index=self.writeback_index, id=_id)
-                    else:
-                        self.writeback_es.delete(index=self.writeback_index, doc_type='elastalert', id=_id)
-                except ElasticsearchException:  # TODO: Give this a more relevant exception, try:except: is evil.
-                    self.handle_error("Failed to delete alert %s at %s" % (_id, alert_time))
+                sent_alerts.append(hit)
+
+        # Delete them from the index
+        if sent_alerts:
+            self.delete_writeback_hits(sent_alerts)
 
         # Send in memory aggregated alerts
         for rule in self.rules:
@@ -1768,22 +2960,12 @@ class ElastAlerter(object):
     def get_aggregated_matches(self, _id):
         """ Removes and returns all matches from writeback_es that have aggregate_id == _id """
 
-        # XXX if there are more than self.max_aggregation matches, you have big alerts and we will leave entries in ES.
-        query = {'query': {'query_string': {'query': 'aggregate_id:"%s"' % (_id)}}, 'sort': {'@timestamp': 'asc'}}
+        query = {'query': {'query_string': {'query': 'aggregate_id:"%s"' % (_id)}}, 'sort': [{'@timestamp': 'asc'}]}
         matches = []
         try:
-            if self.writeback_es.is_atleastsixtwo():
-                res = self.writeback_es.search(index=self.writeback_index, body=query,
-                                               size=self.max_aggregation)
-            else:
-                res = self.writeback_es.deprecated_search(index=self.writeback_index, doc_type='elastalert',
-                                                          body=query, size=self.max_aggregation)
-            for match in res['hits']['hits']:
-                matches.append(match['_source'])
-                if self.writeback_es.is_atleastsixtwo():
-                    self.writeback_es.delete(index=self.writeback_index, id=match['_id'])
-                else:
-                    self.writeback_es.delete(index=self.writeback_index, doc_type='elastalert', id=match['_id'])
+            hits = self.search_writeback_pages(query, min(self.max_aggregation, self.max_query_size), limit=self.max_aggregation)
+            matches = [hit['_source'] for hit in hits]
+            self.delete_writeback_hits(hits)
         except (KeyError, ElasticsearchException) as e:
             self.handle_error("Error fetching aggregated matches: %s" % (e), {'id': _id})
         return matches
@@ -1927,13 +3109,50 @@ class ElastAlerter(object):
         self.silence_cache[silence_cache_key] = (timestamp, exponent)
         return self.writeback('silence', body)
 
+    def load_silences(self):
+        """ Loads silences into silence_cache. The first time, every silence which has not ended, or ended less than
+        silence_cache_ttl ago so that exponential realert carries on from it, is loaded. Afterwards only the ones written
+        since the latest one loaded are, so that is_silenced only has to query for silences which could not be loaded
+        or held in silence_cache. """
+        if self.debug:
+            return
+        self.silence_cache.expire()
+        now = ts_now()
+        if self.silence_last_seen is None:
+            query = {'range': {'until': {'gt': dt_to_ts(now - (self.silence_cache.ttl or datetime.timedelta(0)))}}}
+        else:
+            query = {'range': {'@timestamp': {'gte': dt_to_ts(self.silence_last_seen - SILENCE_REFRESH_OVERLAP)}}}
+        if self.writeback_es.is_atleastfive():
+            query = {'query': {'bool': {'filter': query}}}
+        else:
+            query = {'filter': query}
+        query['sort'] = [{'@timestamp': {'order': 'asc'}}]
+        query['_source'] = ['rule_name', 'until', 'exponent', '@timestamp']
+
+        try:
+            hits = self.search_writeback_pages(query, 1000, doc_type='silence')
+        except ElasticsearchException as e:
+            self.handle_error("Error while loading alert silences: %s" % (e))
+            return
+        if not self.writeback_es.is_atleastfive() and len(hits) >= 1000:
+            # Only the first page is returned
+            self.silences_complete = False
+        last_seen = self.silence_last_seen or now
+        for hit in hits:
+            silence = hit['_source']
+            self.silence_cache.update_silence(silence['rule_name'], ts_to_dt(silence['until']), silence.get('exponent', 0))
+            if '@timestamp' in silence:
+                last_seen = max(last_seen, ts_to_dt(silence['@timestamp']))
+        self.silence_last_seen = last_seen
+
     def is_silenced(self, rule_name):
         """ Checks if rule_name is currently silenced. Returns false on exception. """
         if rule_name in self.silence_cache:
             if ts_now() < self.silence_cache[rule_name][0]:
                 return True
 
-        if self.debug:
+        # Once the silences are loaded, every one which is in effect is in silence_cache, unless some were left out
+        if self.debug or (self.silence_last_seen is not None and self.silences_complete and not self.silence_cache.dropped_active):
             return False
         query = {'term': {'rule_name': rule_name}}
         sort = {'sort': {'until': {'order': 'desc'}}}
@@ -2038,7 +3257,12 @@ class ElastAlerter(object):
         if not number:
             number = rule.get('top_count_number', 5)
         for key in keys:
-            index = self.get_index(rule, starttime, endtime)
+            index = self.resolve_index(rule, starttime, endtime)
+
+            if self.use_composite_aggregation(rule):
+                top_events_count = self.get_composite_top_counts(rule, starttime, endtime, index, key, qk, number) or {}
+                all_counts['top_events_%s' % (key)] = top_events_count
+                continue
 
             hits_terms = self.get_hits_terms(rule, starttime, endtime, index, key, qk, number)
             if hits_terms is None:
@@ -2086,17 +3310,51 @@ class ElastAlerter(object):
         return timestamp + wait, exponent
 
 
-def handle_signal(signal, frame):
-    elastalert_logger.info('SIGINT received, stopping ElastAlert...')
+def handle_signal(signal, frame, client=None):
+    elastalert_logger.info('Signal %s received, stopping ElastAlert...' % (signal))
+    if client is not None and client.alert_dispatcher:
+        # Queued alerts would be lost, and stay silenced by the realert silence already written for them
+        client.shutdown_alert_dispatcher(client.alert_dispatch_shutdown_timeout)
+    if client is not None and client.cluster_sharding:
+        # Let the other instances take over the rules of this one right away
+        client.remove_heartbeat()
     # use os._exit to exit immediately and avoid someone catching SystemExit
     os._exit(0)
 
 
+def handle_client_signals(client):
+    """ Stops on SIGINT and SIGTERM, sending the queued alerts and removing the heartbeat of client first. """
+    handler = functools.partial(handle_signal, client=client)
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
+
+
+def run_worker(args, worker_index, rule_hashes_queue):
+    """ Runs the rules of one process of a WorkerPool. Metrics are collected here and served by the pool. """
+    signal.signal(signal.SIGINT, handle_signal)
+    client = ElastAlerter(args, worker_index=worker_index, rule_hashes_queue=rule_hashes_queue)
+    handle_client_signals(client)
+
+    if client.prometheus_port and not client.debug:
+        PrometheusWrapper(client)
+
+    client.start()
+
+
 def main(args=None):
     signal.signal(signal.SIGINT, handle_signal)
     if not args:
         args = sys.argv[1:]
+
+    parsed_args = ElastAlerter.get_arg_parser().parse_args(args)
+    conf = load_conf(parsed_args)
+    if conf['worker_processes'] > 1 and not parsed_args.silence:
+        pool = WorkerPool(run_worker, args, parsed_args, conf)
+        pool.start()
+        return
+
     client = ElastAlerter(args)
+    handle_client_signals(client)
 
     if client.prometheus_port and not client.debug:
         p = PrometheusWrapper(client)
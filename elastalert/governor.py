@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import datetime
+import email.utils
+import logging
+import threading
+import time
+
+from elasticsearch import RequestsHttpConnection
+from elasticsearch.exceptions import ConnectionTimeout
+from elasticsearch.exceptions import TransportError
+
+# elastalert.util imports the client, which imports this module
+elastalert_logger = logging.getLogger('elastalert')
+
+# Responses which mean the cluster is overloaded
+OVERLOADED_STATUS_CODES = (429, 503)
+
+governors = {}
+governors_lock = threading.Lock()
+
+
+def get_governor(key, max_limit=10, latency_target=10):
+    """ Returns the ConcurrencyGovernor shared by every client of the cluster identified by key, creating it if needed. """
+    with governors_lock:
+        if key not in governors:
+            governors[key] = ConcurrencyGovernor(max_limit=max_limit, latency_target=latency_target)
+        return governors[key]
+
+
+def parse_retry_after(value):
+    """ Returns the number of seconds a Retry-After header, given in seconds or as an HTTP date, asks to wait, or None. """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+
+
+class ConcurrencyGovernor(object):
+    """ Limits the number of requests in flight to one cluster, adjusting the limit with additive increase,
+    multiplicative decrease: the limit grows by one for every limit requests answered within latency_target,
+    and is halved when a request times out, is rejected or is slower than latency_target.
+    Callers wait in acquire until a request may be sent.
+
+    :param max_limit: The highest and initial limit.
+    :param min_limit: The lowest limit.
+    :param latency_target: The number of seconds above which a response counts as a sign of overload.
+    """
+
+    def __init__(self, max_limit=10, min_limit=1, latency_target=10):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_target = latency_target
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.blocked_until = 0
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """ Waits until a request may be sent and counts it as in flight. """
+        with self.condition:
+            while True:
+                wait = self.blocked_until - time.time()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    break
+                self.condition.wait(wait if wait > 0 else None)
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def decrease(self, latency):
+        # Requests sent before the last decrease were already in flight at the old limit, so they don't decrease it again
+        now = time.time()
+        if now - self.last_decrease > latency:
+            self.limit = max(self.limit / 2, self.min_limit)
+            self.last_decrease = now
+            elastalert_logger.warning('Elasticsearch is overloaded, lowering the concurrency limit to %d' % (self.limit))
+
+    def on_response(self, status_code, latency, retry_after=None):
+        """ Adjusts the limit after a response, and blocks new requests for retry_after seconds if it is given. """
+        with self.condition:
+            if status_code in OVERLOADED_STATUS_CODES or latency > self.latency_target:
+                self.decrease(latency)
+                if status_code in OVERLOADED_STATUS_CODES:
+                    self.blocked_until = max(self.blocked_until, time.time() + (1 if retry_after is None else retry_after))
+            elif status_code < 500:
+                self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            self.condition.notify_all()
+
+    def on_timeout(self, timeout):
+        with self.condition:
+            self.decrease(timeout)
+
+
+class GovernedConnection(RequestsHttpConnection):
+    """ A connection which sends its requests through a ConcurrencyGovernor, and retries requests rejected
+    with 429 Too Many Requests up to max_rejection_retries times, after the delay the cluster asked for. """
+
+    def __init__(self, governor=None, max_rejection_retries=3, **kwargs):
+        super(GovernedConnection, self).__init__(**kwargs)
+        self.governor = governor
+        self.max_rejection_retries = max_rejection_retries
+        self.session.hooks['response'].append(self.observe_response)
+
+    def observe_response(self, response, *args, **kwargs):
+        self.governor.on_response(response.status_code, response.elapsed.total_seconds(),
+                                  parse_retry_after(response.headers.get('Retry-After')))
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        attempt = 0
+        while True:
+            self.governor.acquire()
+            try:
+                return super(GovernedConnection, self).perform_request(method, url, params, body, timeout, ignore, headers)
+            except ConnectionTimeout:
+                self.governor.on_timeout(timeout or self.timeout)
+                raise
+            except TransportError as e:
+                if e.status_code != 429 or attempt >= self.max_rejection_retries:
+                    raise
+                attempt += 1
+                elastalert_logger.warning('Request to %s was rejected by Elasticsearch, retrying (%d/%d)' % (
+                    self.host, attempt, self.max_rejection_retries))
+            finally:
+                self.governor.release()
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import bisect
+import hashlib
+
+
+def ring_hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """ A consistent hash ring, which assigns keys to members so that when a member joins or leaves,
+    only the keys of that member move.
+
+    :param members: The ids of the members.
+    :param virtual_nodes: The number of points each member has on the ring. More points spread keys more evenly.
+    """
+
+    def __init__(self, members, virtual_nodes=100):
+        self.members = frozenset(members)
+        points = sorted((ring_hash('%s-%s' % (member, i)), member) for member in self.members for i in range(virtual_nodes))
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    def get(self, key):
+        """ Returns the member which owns key, or None if the ring is empty. """
+        if not self.nodes:
+            return None
+        i = bisect.bisect(self.hashes, ring_hash(key)) % len(self.hashes)
+        return self.nodes[i]
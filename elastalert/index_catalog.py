@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from elasticsearch.exceptions import ElasticsearchException
+
+from elastalert.util import elastalert_logger
+from elastalert.util import ts_now
+
+
+class CatalogEntry(object):
+    """ The indices matching one pattern, as of refreshed_at """
+
+    def __init__(self, indices, refreshed_at):
+        self.indices = indices
+        self.refreshed_at = refreshed_at
+
+
+class IndexCatalog(object):
+    """ Caches the names of the indices which exist in each cluster, so that index lists built from
+    strftime index patterns can be reduced to the indices which actually exist.
+
+    :param refresh_interval: The number of seconds after which the indices of a pattern are listed again.
+    """
+
+    def __init__(self, refresh_interval=300):
+        self.refresh_interval = refresh_interval
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, es, cluster, pattern):
+        """ Returns the CatalogEntry of the indices matching pattern, listing them with the cat indices API
+        if they have not been listed within refresh_interval. Returns None if they could not be listed.
+
+        :param es: The client used to list the indices.
+        :param cluster: A key identifying the cluster es is connected to.
+        :param pattern: A wildcard index pattern.
+        """
+        key = (cluster, pattern)
+        now = ts_now()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and (now - entry.refreshed_at).total_seconds() < self.refresh_interval:
+            return entry
+
+        try:
+            res = es.cat.indices(index=pattern, h='index', format='json')
+        except ElasticsearchException as e:
+            elastalert_logger.warning('Could not list indices matching %s: %s' % (pattern, e))
+            return entry
+        entry = CatalogEntry(set(row['index'] for row in res), now)
+        with self.lock:
+            self.entries[key] = entry
+        return entry
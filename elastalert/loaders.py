@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import concurrent.futures
 import copy
 import datetime
 import hashlib
@@ -128,11 +129,12 @@ class RulesLoader(object):
 
         self.base_config = copy.deepcopy(conf)
 
-    def load(self, conf, args=None):
+    def load(self, conf, args=None, rule_filter=None):
         """
         Discover and load all the rules as defined in the conf and args.
         :param dict conf: Configuration dict
         :param dict args: Arguments dict
+        :param rule_filter: If given, only the rule files it returns True for are loaded
         :return: List of rules
         :rtype: list
         """
@@ -142,9 +144,23 @@ class RulesLoader(object):
         # Load each rule configuration file
         rules = []
         rule_files = self.get_names(conf, use_rule)
-        for rule_file in rule_files:
+        if rule_filter is not None:
+            rule_files = [rule_file for rule_file in rule_files if rule_filter(rule_file)]
+        startup_threads = conf.get('startup_threads', 1)
+        if startup_threads > 1 and len(rule_files) > 1:
+            # Rules are loaded at the same time, but checked and returned in order, so that errors are the same
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=startup_threads)
+            futures = [executor.submit(self.load_configuration, rule_file, conf, args) for rule_file in rule_files]
+            executor.shutdown(wait=False)
+        else:
+            futures = None
+
+        for i, rule_file in enumerate(rule_files):
             try:
-                rule = self.load_configuration(rule_file, conf, args)
+                if futures is not None:
+                    rule = futures[i].result()
+                else:
+                    rule = self.load_configuration(rule_file, conf, args)
                 # A rule failed to load, don't try to process it
                 if not rule:
                     elastalert_logger.error('Invalid rule file skipped: %s' % rule_file)
@@ -280,6 +296,8 @@ class RulesLoader(object):
                 rule['query_delay'] = datetime.timedelta(**rule['query_delay'])
             if 'buffer_time' in rule:
                 rule['buffer_time'] = datetime.timedelta(**rule['buffer_time'])
+            if 'ingest_timestamp_overlap' in rule:
+                rule['ingest_timestamp_overlap'] = datetime.timedelta(**rule['ingest_timestamp_overlap'])
             if 'run_every' in rule:
                 rule['run_every'] = datetime.timedelta(**rule['run_every'])
             if 'bucket_interval' in rule:
@@ -389,6 +407,8 @@ class RulesLoader(object):
             include += rule['compound_compare_key']
         if 'top_count_keys' in rule:
             include += rule['top_count_keys']
+        if 'ingest_timestamp_field' in rule:
+            include.append(rule['ingest_timestamp_field'])
         include.append(rule['timestamp_field'])
         rule['include'] = list(set(include))
 
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from elasticsearch.exceptions import TransportError
+
+
+class PendingSearch(object):
+    """ A single search request waiting to be sent as part of a multi search batch """
+
+    def __init__(self, header, body, filter_path=None):
+        self.header = header
+        self.body = body
+        self.filter_path = filter_path
+        self.response = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SearchBatch(object):
+    """ A group of pending searches which will be sent together in one _msearch request """
+
+    def __init__(self):
+        self.requests = []
+        self.full = threading.Event()
+
+
+class MultiSearchBatcher(object):
+    """ Coalesces searches issued concurrently by rules running against the same cluster
+    into a single _msearch request.
+
+    The first thread to submit a search into an empty batch becomes the batch leader. It waits
+    for up to batch_window seconds, or until max_batch_size searches have been queued, and then
+    sends the whole batch. Every other thread blocks until its own response has been received.
+
+    :param es: The :class:`ElasticSearchClient` used to send the _msearch requests.
+    :param max_batch_size: The maximum number of searches sent in one _msearch request.
+    :param batch_window: The maximum time in seconds to wait for other searches to join a batch.
+    """
+
+    def __init__(self, es, max_batch_size=10, batch_window=0.5):
+        self.es = es
+        self.max_batch_size = max(1, max_batch_size)
+        self.batch_window = batch_window
+        self.lock = threading.Lock()
+        self.batch = None
+
+    def search(self, index, body, filter_path=None, **header):
+        """ Queue a search and block until its response is available.
+
+        :param index: The index expression to search.
+        :param body: The search body, including size and _source filtering.
+        :param filter_path: The filter_path of the search. It is only applied if every search in the batch has the same one.
+        :param header: Additional _msearch header parameters, such as ignore_unavailable.
+        :return: The search response, in the same format as returned by search().
+        """
+        header['index'] = index
+        pending = PendingSearch(header, body, filter_path)
+        with self.lock:
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = self.batch = SearchBatch()
+            batch.requests.append(pending)
+            if len(batch.requests) >= self.max_batch_size:
+                # Close the batch so the next search starts a new one
+                self.batch = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.batch_window)
+            with self.lock:
+                if self.batch is batch:
+                    self.batch = None
+            self.send(batch.requests)
+        else:
+            pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+        return pending.response
+
+    def send(self, requests):
+        """ Send a list of pending searches as one _msearch request and hand each response back. """
+        try:
+            body = []
+            for request in requests:
+                body.append(request.header)
+                body.append(request.body)
+            filter_path = self.get_filter_path(requests)
+            if filter_path:
+                res = self.es.msearch(body=body, filter_path=filter_path)
+            else:
+                res = self.es.msearch(body=body)
+            for request, response in zip(requests, res['responses']):
+                if 'error' in response:
+                    error = response['error']
+                    error_type = error.get('type', 'N/A') if isinstance(error, dict) else error
+                    request.error = TransportError(response.get('status', 'N/A'), error_type, error)
+                else:
+                    request.response = response
+        except Exception as e:
+            for request in requests:
+                request.error = e
+        finally:
+            for request in requests:
+                if request.response is None and request.error is None:
+                    request.error = TransportError('N/A', 'Missing response in _msearch result')
+                request.done.set()
+
+    @staticmethod
+    def get_filter_path(requests):
+        """ Returns the filter_path of an _msearch request, which applies to the responses of every search in it,
+        or None unless all of the searches have the same filter_path. """
+        filter_paths = set(tuple(request.filter_path or ()) for request in requests)
+        if len(filter_paths) != 1 or not requests[0].filter_path:
+            return None
+        return ['responses.%s' % path for path in requests[0].filter_path] + ['responses.error', 'responses.status']
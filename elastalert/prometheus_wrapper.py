@@ -9,6 +9,8 @@ class PrometheusWrapper:
         self.prometheus_port = client.prometheus_port
         self.run_rule = client.run_rule
         self.writeback = client.writeback
+        # Rule runs are counted from their checkpoints if they have no status documents
+        self.run_doc_type = 'elastalert_status' if client.write_status_history else 'elastalert_checkpoint'
 
         client.run_rule = self.metrics_run_rule
         client.writeback = self.metrics_writeback
@@ -22,6 +24,9 @@ class PrometheusWrapper:
         self.prom_alerts_not_sent = prometheus_client.Counter('elastalert_alerts_not_sent', 'Number of alerts not sent', ['rule_name'])
         self.prom_errors = prometheus_client.Counter('elastalert_errors', 'Number of errors for rule')
         self.prom_alerts_silenced = prometheus_client.Counter('elastalert_alerts_silenced', 'Number of silenced alerts', ['rule_name'])
+        self.prom_warmup_progress = prometheus_client.Gauge('elastalert_warmup_progress',
+                                                            'Share of the existing terms collected for new_term rule',
+                                                            ['rule_name'])
 
     def start(self):
         prometheus_client.start_http_server(self.prometheus_port)
@@ -30,15 +35,17 @@ class PrometheusWrapper:
         """ Increment counter every time rule is run """
         try:
             self.prom_scrapes.labels(rule['name']).inc()
+            if hasattr(rule['type'], 'warmup_progress'):
+                self.prom_warmup_progress.labels(rule['name']).set(rule['type'].warmup_progress)
         finally:
             return self.run_rule(rule, endtime, starttime)
 
-    def metrics_writeback(self, doc_type, body):
+    def metrics_writeback(self, doc_type, body, rule=None, match_body=None, doc_id=None):
         """ Update various prometheus metrics accoording to the doc_type """
 
-        res = self.writeback(doc_type, body)
+        res = self.writeback(doc_type, body, rule, match_body, doc_id)
         try:
-            if doc_type == 'elastalert_status':
+            if doc_type == self.run_doc_type:
                 self.prom_hits.labels(body['rule_name']).inc(int(body['hits']))
                 self.prom_matches.labels(body['rule_name']).inc(int(body['matches']))
                 self.prom_time_taken.labels(body['rule_name']).inc(float(body['time_taken']))
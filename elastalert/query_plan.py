@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import json
+import re
+
+from elasticsearch.serializer import JSONSerializer
+
+STARTTIME_PLACEHOLDER = '__elastalert_query_starttime__'
+ENDTIME_PLACEHOLDER = '__elastalert_query_endtime__'
+
+serializer = JSONSerializer()
+
+
+class QueryTemplate(object):
+    """ A query body which has been serialized to JSON once, with placeholders for the time range.
+
+    :param query: The query dictionary, built with STARTTIME_PLACEHOLDER and ENDTIME_PLACEHOLDER
+        in place of the start and end timestamps.
+    :param to_ts_func: The function used to convert datetimes into the timestamps of the range filter.
+    """
+
+    placeholder_re = re.compile('"(%s|%s)"' % (STARTTIME_PLACEHOLDER, ENDTIME_PLACEHOLDER))
+
+    def __init__(self, query, to_ts_func):
+        self.to_ts_func = to_ts_func
+        # Alternating fixed JSON fragments and placeholder names
+        self.parts = self.placeholder_re.split(serializer.dumps(query))
+
+    def render(self, starttime, endtime):
+        """ Returns the serialized query body for the given time range. """
+        values = {
+            STARTTIME_PLACEHOLDER: json.dumps(self.to_ts_func(starttime)),
+            ENDTIME_PLACEHOLDER: json.dumps(self.to_ts_func(endtime)),
+        }
+        body = self.parts[:]
+        for i in range(1, len(body), 2):
+            body[i] = values[body[i]]
+        return ''.join(body)
+
+
+class QueryPlan(object):
+    """ The queries of a rule, compiled once when the rule is initialized so that each run only has to
+    substitute its time range. Any query which is not part of the plan is built as usual.
+
+    :param index: The index expression of the rule, or None if it depends on the time range.
+    :param source_includes: The comma separated _source includes of downloaded documents, or None.
+    :param hits: The QueryTemplate used to download documents.
+    :param count: The QueryTemplate used for count queries.
+    :param terms: The QueryTemplate used for terms queries without a query key filter.
+    :param aggregation: The QueryTemplate used for metric aggregation queries.
+    """
+
+    def __init__(self, index=None, source_includes=None, hits=None, count=None, terms=None, aggregation=None):
+        self.index = index
+        self.source_includes = source_includes
+        self.hits = hits
+        self.count = count
+        self.terms = terms
+        self.aggregation = aggregation
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
+import collections
 import copy
 import datetime
+import math
 import sys
+import threading
 
 from sortedcontainers import SortedKeyList as sortedlist
 
@@ -671,12 +674,76 @@ class NewTermsRule(RuleType):
                 if self.rules.get('use_keyword_postfix', True):
                     elastalert_logger.warn('Warning: If query_key is a non-keyword field, you must set '
                                            'use_keyword_postfix to false, or add .keyword/.raw to your query_key.')
+        self.warmup_progress = 0.0
+        self.warmup_error = None
+        self.warmup_buffer = collections.deque()
+        self.warmup_buffer_size = self.rules.get('terms_warmup_buffer_size', 100)
+        self.warmup_args = args
+        self.warmup_lock = threading.Lock()
+        if self.rules.get('terms_background_warmup'):
+            # Data queried while the existing terms are collected is held back until they all are
+            self.warming = True
+            self.es = elasticsearch_client(self.rules)
+            threading.Thread(target=self.warm_up, args=(args,), name='elastalert-new-terms-%s' % (self.rules.get('name')),
+                             daemon=True).start()
+            return
+        self.warming = False
         try:
             self.get_all_terms(args)
         except Exception as e:
             # Refuse to start if we cannot get existing terms
             raise EAException('Error searching for existing terms: %s' % (repr(e))).with_traceback(sys.exc_info()[2])
 
+    def warm_up(self, args):
+        """ Collects the existing terms in the background. """
+        elastalert_logger.info('Collecting existing terms for rule %s in the background' % (self.rules.get('name')))
+        try:
+            self.get_all_terms(args)
+        except Exception as e:
+            elastalert_logger.exception('Error searching for existing terms for rule %s' % (self.rules.get('name')))
+            self.warmup_error = e
+        else:
+            elastalert_logger.info('Collected existing terms for rule %s' % (self.rules.get('name')))
+        with self.warmup_lock:
+            self.warming = False
+
+    def hold_back(self, method, data):
+        """ Returns True if the data was held back because the existing terms are still being collected.
+        Otherwise, first processes the data which was held back. """
+        with self.warmup_lock:
+            if self.warming:
+                self.buffer_held_back(method, data)
+                return True
+        if self.warmup_error is not None:
+            # The background collection failed, so collect the existing terms before anything is checked against them
+            try:
+                self.get_all_terms(self.warmup_args)
+            except Exception as e:
+                with self.warmup_lock:
+                    self.buffer_held_back(method, data)
+                raise EAException('Error searching for existing terms: %s' % (repr(e))).with_traceback(sys.exc_info()[2])
+            self.warmup_error = None
+            elastalert_logger.info('Collected existing terms for rule %s' % (self.rules.get('name')))
+        with self.warmup_lock:
+            held_back, self.warmup_buffer = self.warmup_buffer, collections.deque()
+        for held_back_method, held_back_data in held_back:
+            held_back_method(held_back_data)
+        return False
+
+    def buffer_held_back(self, method, data):
+        """ Holds back data, dropping the oldest once more than terms_warmup_buffer_size batches are held back.
+        Must be called with warmup_lock held. """
+        if method is None:
+            return
+        self.warmup_buffer.append((method, data))
+        while len(self.warmup_buffer) > self.warmup_buffer_size:
+            self.warmup_buffer.popleft()
+            elastalert_logger.warning('Too much data held back for rule %s while collecting existing terms, dropping the oldest'
+                                      % (self.rules.get('name')))
+
+    def garbage_collect(self, timestamp):
+        self.hold_back(None, None)
+
     def get_all_terms(self, args):
         """ Performs a terms aggregation for each field to get every existing term. """
         self.es = elasticsearch_client(self.rules)
@@ -691,6 +758,8 @@ class NewTermsRule(RuleType):
             end = ts_now()
         start = end - window_size
         step = datetime.timedelta(**self.rules.get('window_step_size', {'days': 1}))
+        total_steps = len(self.fields) * max(math.ceil(total_seconds(end - start) / total_seconds(step)), 1)
+        steps = 0
 
         for field in self.fields:
             tmp_start = start
@@ -733,6 +802,8 @@ class NewTermsRule(RuleType):
                 else:
                     index = self.rules['index']
                 res = self.es.search(body=query, index=index, ignore_unavailable=True, timeout='50s')
+                steps += 1
+                self.warmup_progress = min(steps / total_steps, 1.0)
                 if 'aggregations' in res:
                     buckets = res['aggregations']['filtered']['values']['buckets']
                     if type(field) == list:
@@ -771,6 +842,7 @@ class NewTermsRule(RuleType):
                     continue
                 self.seen_values[key] = list(set(values))
                 elastalert_logger.info('Found %s unique values for %s' % (len(set(values)), key))
+        self.warmup_progress = 1.0
 
     def flatten_aggregation_hierarchy(self, root, hierarchy_tuple=()):
         """ For nested aggregations, the results come back in the following format:
@@ -876,6 +948,8 @@ class NewTermsRule(RuleType):
         return results
 
     def add_data(self, data):
+        if self.hold_back(self.add_data, data):
+            return
         for document in data:
             for field in self.fields:
                 value = ()
@@ -903,6 +977,8 @@ class NewTermsRule(RuleType):
 
     def add_terms_data(self, terms):
         # With terms query, len(self.fields) is always 1 and the 0'th entry is always a string
+        if self.hold_back(self.add_terms_data, terms):
+            return
         field = self.fields[0]
         for timestamp, buckets in terms.items():
             for bucket in buckets:
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import decimal
+import uuid
+
+from elasticsearch.exceptions import ImproperlyConfigured
+from elasticsearch.serializer import JSONSerializer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_default(obj):
+    """ Encodes the values the json module can't: dates and times as ISO8601 strings, decimals and UUIDs. """
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    elif isinstance(obj, decimal.Decimal):
+        return float(obj)
+    elif isinstance(obj, uuid.UUID):
+        return str(obj)
+    raise TypeError("Unable to serialize %r (type: %s)" % (obj, type(obj)))
+
+
+class StdlibSerializer(JSONSerializer):
+    """ The default serializer of elasticsearch-py, encoding any value with an isoformat method natively. """
+
+    def default(self, data):
+        return json_default(data)
+
+
+class OrjsonSerializer(StdlibSerializer):
+    """ Serializes request bodies and parses responses with orjson, which encodes datetimes natively.
+    Falls back to the json module for values orjson does not support, such as integers over 64 bits. """
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return super(OrjsonSerializer, self).loads(s)
+
+    def dumps(self, data):
+        if isinstance(data, str):
+            return data
+        try:
+            return orjson.dumps(data, default=json_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        except TypeError:
+            return super(OrjsonSerializer, self).dumps(data)
+
+
+def get_serializer(name='json'):
+    """ Returns the serializer named by the json_serializer setting.
+
+    :param name: ``json``, the default, or ``orjson``.
+    """
+    if name in (None, 'json'):
+        return StdlibSerializer()
+    elif name == 'orjson':
+        if orjson is None:
+            raise ImproperlyConfigured('json_serializer is set to orjson, but orjson is not installed')
+        return OrjsonSerializer()
+    raise ImproperlyConfigured('Unknown json_serializer %s' % name)
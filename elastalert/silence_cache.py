@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import collections.abc
+import threading
+
+from elastalert.util import elastalert_logger
+from elastalert.util import ts_now
+
+
+class SilenceCache(collections.abc.MutableMapping):
+    """ Maps silence keys to their (until, exponent), holding at most max_size keys.
+    Keys are kept in the order they were last set in. Once there are too many, the keys whose silence has ended are
+    dropped, and if there are still too many, the ones set least recently. Once a silence still in effect was dropped,
+    dropped_active is set, as the cache no longer holds every silence. expire drops the keys whose until is more than
+    ttl in the past, which are only kept so that exponential realert can carry on from their exponent.
+
+    :param max_size: The number of keys which may be held.
+    :param ttl: The timedelta for which keys are held once their until has passed.
+    """
+
+    def __init__(self, max_size=100000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.silences = collections.OrderedDict()
+        self.dropped_active = False
+        # The earliest until of the keys once none had ended, to only look for ended ones after it
+        self.next_end = None
+        self.lock = threading.Lock()
+
+    def __getitem__(self, key):
+        return self.silences[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.silences[key] = value
+            self.silences.move_to_end(key)
+            if len(self.silences) > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """ Drops the keys whose silence has ended, then the ones set least recently, until at most max_size are held.
+        Must be called with lock held. """
+        now = ts_now()
+        if self.next_end is None or self.next_end <= now:
+            ended = [key for key, (until, _) in self.silences.items() if until <= now]
+            for key in ended:
+                del self.silences[key]
+            self.next_end = min((until for until, _ in self.silences.values()), default=None)
+        while len(self.silences) > self.max_size:
+            dropped, (until, _) = self.silences.popitem(last=False)
+            self.dropped_active = True
+            elastalert_logger.warning('Silence cache is full, dropping silence of %s until %s' % (dropped, until))
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.silences[key]
+
+    def __iter__(self):
+        return iter(list(self.silences))
+
+    def __len__(self):
+        return len(self.silences)
+
+    def update_silence(self, key, until, exponent):
+        """ Sets the silence of key unless it already has one which lasts longer. """
+        if key not in self.silences or self.silences[key][0] < until:
+            self[key] = (until, exponent)
+
+    def expire(self):
+        """ Drops the keys whose until is more than ttl in the past. Returns the number of keys dropped. """
+        if self.ttl is None:
+            return 0
+        cutoff = ts_now() - self.ttl
+        with self.lock:
+            expired = [key for key, (until, _) in self.silences.items() if until < cutoff]
+            for key in expired:
+                del self.silences[key]
+        return len(expired)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from elastalert.util import elastalert_logger
+
+# Each record is its length and CRC32 followed by its bytes
+RECORD_HEADER = struct.Struct('>II')
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.spool'
+
+
+class Spool(object):
+    """ An append-only queue of records kept in segment files in a directory, which survives restarts.
+    Records are appended to the newest segment, which is closed once it holds segment_size bytes,
+    and read back from the closed segments, oldest first, with a memory map.
+    Once the segments take more than max_size bytes, the oldest are deleted.
+
+    :param directory: The directory of the segment files, created if it does not exist.
+    :param segment_size: The number of bytes after which a segment is closed.
+    :param max_size: The number of bytes the segments may take.
+    """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, max_size=1024 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # sequence number: size of the segments on disk, oldest first
+        self.segments = {}
+        for name in sorted(os.listdir(directory)):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                seq = int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+                self.segments[seq] = os.path.getsize(self.get_path(seq))
+        # Segments left from before a restart are closed, new records go to a new one
+        self.current_seq = max(self.segments, default=0) + 1
+        self.current = None
+
+    def get_path(self, seq):
+        return os.path.join(self.directory, '%s%020d%s' % (SEGMENT_PREFIX, seq, SEGMENT_SUFFIX))
+
+    @property
+    def size(self):
+        return sum(self.segments.values())
+
+    def append(self, record):
+        """ Appends a record, given as bytes. """
+        with self.lock:
+            if self.current is None:
+                self.current = open(self.get_path(self.current_seq), 'ab')
+                self.segments[self.current_seq] = 0
+            self.current.write(RECORD_HEADER.pack(len(record), zlib.crc32(record)) + record)
+            self.current.flush()
+            self.segments[self.current_seq] += RECORD_HEADER.size + len(record)
+            if self.segments[self.current_seq] >= self.segment_size:
+                self.close_segment()
+            self.evict()
+
+    def close_segment(self):
+        if self.current is not None:
+            os.fsync(self.current.fileno())
+            self.current.close()
+            self.current = None
+            self.current_seq += 1
+
+    def evict(self):
+        """ Deletes the oldest segments until the segments take at most max_size bytes. """
+        while self.size > self.max_size and len(self.segments) > 1:
+            seq = min(self.segments)
+            if seq == self.current_seq:
+                break
+            elastalert_logger.warning('Spool %s is full, dropping its oldest segment' % (self.directory))
+            self.remove(seq)
+
+    def remove(self, seq):
+        self.segments.pop(seq, None)
+        try:
+            os.remove(self.get_path(seq))
+        except FileNotFoundError:
+            pass
+
+    def closed_segments(self):
+        """ Closes the segment being written, and returns the sequence numbers of the segments, oldest first. """
+        with self.lock:
+            if self.current is not None and self.segments[self.current_seq]:
+                self.close_segment()
+            return sorted(seq for seq in self.segments if self.current is None or seq != self.current_seq)
+
+    def read_segment(self, seq):
+        """ Returns the records of a segment, stopping at the first one which is incomplete or corrupt. """
+        records = []
+        path = self.get_path(seq)
+        try:
+            with open(path, 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return records
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    offset = 0
+                    while offset + RECORD_HEADER.size <= len(data):
+                        length, checksum = RECORD_HEADER.unpack_from(data, offset)
+                        start = offset + RECORD_HEADER.size
+                        record = data[start:start + length]
+                        if len(record) < length or zlib.crc32(record) != checksum:
+                            elastalert_logger.error('Spool segment %s is corrupt after %d records' % (path, len(records)))
+                            break
+                        records.append(record)
+                        offset = start + length
+        except FileNotFoundError:
+            pass
+        return records
+
+    def drain(self, write):
+        """ Calls write with the records of each closed segment, oldest first, deleting the segment if it returns True.
+        Stops at the first segment write fails for. Returns the number of segments drained. """
+        drained = 0
+        for seq in self.closed_segments():
+            records = self.read_segment(seq)
+            if records and not write(records):
+                break
+            with self.lock:
+                self.remove(seq)
+            drained += 1
+        return drained
+
+    def close(self):
+        with self.lock:
+            if self.current is not None:
+                self.close_segment()
@@ -5,6 +5,7 @@ import logging
 import os
 import re
 import sys
+import threading
 
 import dateutil.parser
 import pytz
@@ -246,6 +247,36 @@ def format_index(index, start, end, add_extra=False):
     return ','.join(indices)
 
 
+def coarsen_index(index, indices, start, end, max_indices):
+    """ Takes an index, specified using strftime format, and the names of the indices to query between start and end,
+    and replaces them with one wildcard per month, or else per year, such as logstash-2015.01.* for logstash-%Y.%m.%d.
+    Returns a comma separated list of at most max_indices names, or None if even the wildcards per year are more. """
+    start -= start.utcoffset()
+    end -= end.utcoffset()
+    wildcard_format = index
+    # The strftime directives of periods shorter than a month, and then of months
+    for directives in (('%d', '%j', '%a', '%A', '%w', '%u', '%U', '%W', '%V', '%H', '%I', '%p', '%M', '%S', '%f'),
+                       ('%m', '%b', '%B')):
+        for directive in directives:
+            wildcard_format = wildcard_format.replace(directive, '*')
+        # Wildcards only separated by punctuation, such as *.* for %m.%d, are merged
+        wildcard_format = re.sub(r'\*(?:[^\w%]*\*)+', '*', wildcard_format)
+        # Indices outside of the time range, such as with search_extra_index, are kept as they are
+        unmatched = set(indices)
+        wildcards = set()
+        day = start
+        while day.date() <= end.date():
+            name = day.strftime(index)
+            if name in indices:
+                unmatched.discard(name)
+                wildcards.add(day.strftime(wildcard_format))
+            day += datetime.timedelta(days=1)
+        wildcards |= unmatched
+        if len(wildcards) <= max_indices:
+            return ','.join(sorted(wildcards))
+    return None
+
+
 class EAException(Exception):
     pass
 
@@ -319,9 +350,45 @@ def replace_dots_in_field_names(document):
     return document
 
 
+# Clients shared by every rule connecting to the same cluster with es_client_registry, by get_es_client_key
+es_client_registry = {}
+es_client_registry_lock = threading.Lock()
+
+
+def get_es_client_key(es_conn_conf):
+    """ Returns a hashable key identifying the cluster, credentials and connection settings of an es_conn_config """
+    normalized = dict(es_conn_conf)
+    normalized['es_host'] = str(normalized['es_host']).strip().lower()
+    normalized['es_url_prefix'] = normalized['es_url_prefix'].strip('/')
+    return tuple(sorted((key, repr(value)) for key, value in normalized.items()))
+
+
 def elasticsearch_client(conf):
-    """ returns an :class:`ElasticSearchClient` instance configured using an es_conn_config """
+    """ returns an :class:`ElasticSearchClient` instance configured using an es_conn_config.
+    With es_client_registry, every call with the same connection settings returns the same client. """
     es_conn_conf = build_es_conn_config(conf)
+    if not conf.get('es_client_registry'):
+        return create_elasticsearch_client(es_conn_conf)
+
+    key = get_es_client_key(es_conn_conf)
+    with es_client_registry_lock:
+        client = es_client_registry.get(key)
+        if client is None:
+            client = create_elasticsearch_client(es_conn_conf)
+            es_client_registry[key] = client
+    return client
+
+
+def prune_es_client_registry(confs):
+    """ Removes the clients of the registry which none of the given rule or global configurations connect with """
+    keys = set(get_es_client_key(build_es_conn_config(conf)) for conf in confs)
+    with es_client_registry_lock:
+        for key in list(es_client_registry):
+            if key not in keys:
+                es_client_registry.pop(key)
+
+
+def create_elasticsearch_client(es_conn_conf):
     auth = Auth()
     es_conn_conf['http_auth'] = auth(host=es_conn_conf['es_host'],
                                      username=None if es_conn_conf['es_bearer'] else es_conn_conf['es_username'],
@@ -358,6 +425,12 @@ def build_es_conn_config(conf):
     parsed_conf['es_conn_timeout'] = conf.get('es_conn_timeout', 20)
     parsed_conf['send_get_body_as'] = conf.get('es_send_get_body_as', 'GET')
     parsed_conf['ssl_show_warn'] = conf.get('ssl_show_warn', True)
+    parsed_conf['json_serializer'] = conf.get('json_serializer', 'json')
+    parsed_conf['es_concurrency_governor'] = conf.get('es_concurrency_governor', False)
+    parsed_conf['es_max_concurrency'] = conf.get('es_max_concurrency', conf.get('max_threads', 10))
+    parsed_conf['es_target_latency'] = conf.get('es_target_latency', 10)
+    parsed_conf['es_max_rejection_retries'] = conf.get('es_max_rejection_retries', 3)
+    parsed_conf['es_pool_maxsize'] = conf.get('es_pool_maxsize', conf.get('max_threads', 10))
 
     if os.environ.get('ES_USERNAME'):
         parsed_conf['es_username'] = os.environ.get('ES_USERNAME')
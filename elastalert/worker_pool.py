@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import signal
+import tempfile
+import time
+import zlib
+
+from elastalert.util import elastalert_logger
+
+
+def rule_worker(rule_file, worker_processes):
+    """ Returns the index of the worker process which runs the rule loaded from rule_file. """
+    return zlib.crc32(rule_file.encode('utf-8')) % worker_processes
+
+
+class WorkerPool(object):
+    """ Runs the rules in worker_processes processes. Each worker is an ElastAlerter, started with
+    target(args, index, rule_hashes_queue), which runs the rule files rule_worker assigns to its index.
+
+    The pool watches the rule files and sends the new hashes to every worker when they change,
+    restarts workers which exit, and serves the Prometheus metrics of all the workers.
+
+    :param target: The function run in each worker process.
+    :param args: The command line arguments, passed to every worker.
+    :param parsed_args: The parsed command line arguments.
+    :param conf: The global configuration.
+    """
+
+    def __init__(self, target, args, parsed_args, conf):
+        self.target = target
+        self.args = args
+        self.parsed_args = parsed_args
+        self.conf = conf
+        self.rules_loader = conf['rules_loader']
+        self.worker_processes = conf['worker_processes']
+        self.run_every = conf['run_every']
+        self.restart_delay = conf.get('worker_restart_delay', 10)
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = [None] * self.worker_processes
+        self.queues = [None] * self.worker_processes
+        self.started_at = [0] * self.worker_processes
+        self.exited = set()
+        self.rule_hashes = {}
+        self.metrics_dir = None
+        self.running = False
+
+    def start_worker(self, index):
+        self.queues[index] = self.context.Queue()
+        worker = self.context.Process(target=self.target, args=(self.args, index, self.queues[index]),
+                                      name='elastalert-worker-%s' % index)
+        worker.start()
+        self.workers[index] = worker
+        self.started_at[index] = time.time()
+        elastalert_logger.info('Started worker %s with pid %s' % (index, worker.pid))
+
+    def start_metrics(self, port):
+        """ Serves the metrics the workers write to a shared directory with prometheus_client's multiprocess mode.
+        The directory has to be set before the workers import prometheus_client. """
+        import prometheus_client
+        from prometheus_client import multiprocess
+
+        self.metrics_dir = tempfile.mkdtemp(prefix='elastalert-metrics-')
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = self.metrics_dir
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=self.metrics_dir)
+        prometheus_client.start_http_server(port, registry=registry)
+
+    def check_rule_changes(self):
+        """ Sends the rule file hashes to every worker if any rule file was added, changed or removed. """
+        new_rule_hashes = self.rules_loader.get_hashes(self.conf, self.parsed_args.rule)
+        if new_rule_hashes == self.rule_hashes:
+            return
+        self.rule_hashes = new_rule_hashes
+        for queue in self.queues:
+            if queue is not None:
+                queue.put(new_rule_hashes)
+
+    def handle_exited_workers(self):
+        """ Restarts each worker which has exited, unless it was started less than restart_delay seconds ago.
+        Returns the number of seconds until the next of those workers may be restarted, or None. """
+        next_restart = None
+        for index, worker in enumerate(self.workers):
+            if worker.is_alive():
+                continue
+            if index not in self.exited:
+                self.exited.add(index)
+                elastalert_logger.error('Worker %s with pid %s exited with code %s' % (index, worker.pid, worker.exitcode))
+            wait = self.started_at[index] + self.restart_delay - time.time()
+            if wait > 0:
+                next_restart = wait if next_restart is None else min(next_restart, wait)
+                continue
+            self.exited.discard(index)
+            if self.metrics_dir:
+                from prometheus_client import multiprocess
+                multiprocess.mark_process_dead(worker.pid, self.metrics_dir)
+            self.start_worker(index)
+        return next_restart
+
+    def start(self):
+        """ Starts the workers and supervises them until stop is called """
+        signal.signal(signal.SIGINT, self.handle_signal)
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        prometheus_port = self.parsed_args.prometheus_port
+        if prometheus_port and not self.parsed_args.debug:
+            self.start_metrics(prometheus_port)
+
+        self.rule_hashes = self.rules_loader.get_hashes(self.conf, self.parsed_args.rule)
+        for index in range(self.worker_processes):
+            self.start_worker(index)
+
+        self.running = True
+        next_check = time.time() + self.run_every.total_seconds()
+        next_restart = None
+        while self.running:
+            timeout = next_check - time.time()
+            if next_restart is not None:
+                timeout = min(timeout, next_restart)
+            multiprocessing.connection.wait([worker.sentinel for worker in self.workers if worker.is_alive()],
+                                            max(timeout, 0))
+            if not self.running:
+                break
+            if time.time() >= next_check:
+                if not self.parsed_args.pin_rules:
+                    self.check_rule_changes()
+                next_check = time.time() + self.run_every.total_seconds()
+            next_restart = self.handle_exited_workers()
+
+    def handle_signal(self, signum, frame):
+        elastalert_logger.info('Signal %s received, stopping workers...' % signum)
+        self.stop()
+
+    def stop(self):
+        """ Stops the workers """
+        self.running = False
+        for worker in self.workers:
+            if worker is not None and worker.is_alive():
+                worker.terminate()
+        for worker in self.workers:
+            if worker is not None:
+                worker.join()
+        if self.metrics_dir:
+            shutil.rmtree(self.metrics_dir, ignore_errors=True)
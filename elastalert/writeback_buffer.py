@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from elasticsearch.exceptions import ElasticsearchException
+
+from elastalert.serializer import get_serializer
+from elastalert.util import elastalert_logger
+
+
+class WritebackBuffer(object):
+    """ Collects writeback documents by index and writes them with bulk requests from a background thread,
+    once bulk_size documents are waiting or flush_interval seconds have passed since the last flush.
+    Documents are given their _id when they are added, so that callers can refer to them before they are written.
+    With a spool, documents are kept in it instead of in memory until they are written, and documents which
+    could not be written stay in it to be written with the next flush.
+
+    :param es: The writeback Elasticsearch client.
+    :param bulk_size: The number of documents which triggers a flush.
+    :param flush_interval: The number of seconds documents may wait before they are flushed.
+    :param max_retries: The number of times a failed bulk request, or rejected documents, are sent again.
+    :param spool: The :class:`~elastalert.spool.Spool` to keep documents in.
+    """
+
+    def __init__(self, es, bulk_size=500, flush_interval=5, max_retries=3, spool=None, serializer=None):
+        self.es = es
+        self.bulk_size = bulk_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.spool = spool
+        self.serializer = serializer or get_serializer()
+        # index: [(doc_type, _id, body)]
+        self.documents = {}
+        self.count = 0
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='elastalert-writeback', daemon=True)
+        self.thread.start()
+
+    def add(self, index, doc_type, doc_id, body):
+        if self.spool is not None:
+            record = {'index': index, 'doc_type': doc_type, '_id': doc_id, 'body': body}
+            self.spool.append(self.serializer.dumps(record).encode('utf-8'))
+        with self.condition:
+            if self.spool is None:
+                self.documents.setdefault(index, []).append((doc_type, doc_id, body))
+            self.count += 1
+            if self.count >= self.bulk_size:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.running and self.count < self.bulk_size:
+                    self.condition.wait(self.flush_interval)
+                running = self.running
+            try:
+                self.flush()
+            except Exception:
+                elastalert_logger.exception('Error writing writeback documents')
+            if not running:
+                return
+
+    def flush(self):
+        """ Writes every waiting document. """
+        with self.condition:
+            documents, self.documents = self.documents, {}
+            self.count = 0
+        # Flushes from the background thread and from shutdown don't interleave
+        with self.flush_lock:
+            self.write_documents(documents)
+            if self.spool is not None:
+                self.spool.drain(self.write_records)
+
+    def write_records(self, records):
+        """ Writes the documents of spool records. Returns True if none of them need to be written again. """
+        documents = {}
+        for record in records:
+            record = self.serializer.loads(bytes(record).decode('utf-8'))
+            documents.setdefault(record['index'], []).append((record['doc_type'], record['_id'], record['body']))
+        return self.write_documents(documents)
+
+    def write_documents(self, documents):
+        written = True
+        for index, docs in documents.items():
+            for start in range(0, len(docs), self.bulk_size):
+                written = self.write(index, docs[start:start + self.bulk_size]) and written
+        return written
+
+    def write(self, index, docs):
+        """ Writes docs to index with bulk requests. Returns False if some were not written after max_retries retries. """
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(min(2 ** attempt, 30))
+            try:
+                include_type = not self.es.is_atleastsixtwo()
+                body = []
+                for doc_type, doc_id, doc in docs:
+                    action = {'_id': doc_id}
+                    if include_type:
+                        action['_type'] = doc_type
+                    body.append({'index': action})
+                    body.append(doc)
+                res = self.es.bulk(body=body, index=index)
+            except ElasticsearchException as e:
+                elastalert_logger.warning('Error writing %d documents to %s: %s' % (len(docs), index, e))
+                continue
+
+            # Rejected documents are sent again, other failures will not go away
+            retry = []
+            for doc, item in zip(docs, res.get('items', [])):
+                result = list(item.values())[0]
+                if result.get('status', 200) == 429:
+                    retry.append(doc)
+                elif result.get('error'):
+                    elastalert_logger.error('Error writing document %s to %s: %s' % (doc[1], index, result['error']))
+            if not retry:
+                return True
+            docs = retry
+        elastalert_logger.error('Gave up writing %d documents to %s after %d retries' % (len(docs), index, self.max_retries))
+        return False
+
+    def shutdown(self):
+        """ Writes every waiting document and stops the background thread. """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        if self.spool is not None:
+            self.spool.close()
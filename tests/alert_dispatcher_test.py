@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import mock
+
+from elastalert.alert_dispatcher import AlertDispatcher
+
+
+def test_alert_dispatcher_sends_in_workers():
+    sent = []
+    threads = set()
+
+    def send(matches, rule, current_es):
+        sent.append((matches, rule['name'], current_es))
+        threads.add(threading.current_thread().name)
+    dispatcher = AlertDispatcher(send, workers=2)
+    for i in range(10):
+        dispatcher.dispatch([{'i': i}], {'name': 'rule'}, 'es')
+    dispatcher.join()
+
+    assert sorted(match[0]['i'] for match, _, _ in sent) == list(range(10))
+    assert all(current_es == 'es' for _, _, current_es in sent)
+    assert threading.current_thread().name not in threads
+    dispatcher.shutdown()
+    assert dispatcher.threads == []
+
+
+def test_alert_dispatcher_waits_when_full():
+    release = threading.Event()
+    dispatcher = AlertDispatcher(lambda matches, rule, current_es: release.wait(5), workers=1, queue_size=1)
+    dispatcher.dispatch([{}], {'name': 'rule'})
+    # Wait for the worker to take the first alert
+    while dispatcher.queue.qsize():
+        pass
+    dispatcher.dispatch([{}], {'name': 'rule'})
+
+    queued = threading.Event()
+
+    def dispatch():
+        dispatcher.dispatch([{}], {'name': 'rule'})
+        queued.set()
+    with mock.patch('elastalert.alert_dispatcher.elastalert_logger') as logger:
+        threading.Thread(target=dispatch, daemon=True).start()
+        assert not queued.wait(0.1)
+        assert logger.warning.called
+        release.set()
+        assert queued.wait(5)
+    dispatcher.shutdown()
+
+
+def test_alert_dispatcher_survives_errors():
+    sent = []
+
+    def send(matches, rule, current_es):
+        if not sent:
+            sent.append(None)
+            raise Exception('boom')
+        sent.append(matches)
+    dispatcher = AlertDispatcher(send, workers=1)
+    dispatcher.dispatch([{'a': 1}], {'name': 'rule'})
+    dispatcher.dispatch([{'b': 2}], {'name': 'rule'})
+    dispatcher.join()
+    assert sent == [None, [{'b': 2}]]
+    dispatcher.shutdown()
+
+
+def test_alert_dispatcher_shutdown_timeout():
+    release = threading.Event()
+    dispatcher = AlertDispatcher(lambda matches, rule, current_es: release.wait(5), workers=1)
+    for i in range(3):
+        dispatcher.dispatch([{'i': i}], {'name': 'rule'})
+    # The first alert is being sent, the others are returned once the timeout has passed
+    unsent = dispatcher.shutdown(timeout=0.1)
+    release.set()
+    assert [matches[0]['i'] for matches, _ in unsent] == [1, 2]
@@ -2,7 +2,10 @@
 import copy
 import datetime
 import json
+import queue
+import signal
 import threading
+import time
 
 import elasticsearch
 import mock
@@ -10,16 +13,22 @@ import pytest
 from elasticsearch.exceptions import ConnectionError
 from elasticsearch.exceptions import ElasticsearchException
 
+from elastalert.alert_dispatcher import AlertDispatcher
+from elastalert.elastalert import handle_client_signals
+from elastalert.elastalert import LEAN_FETCH_FILTER_PATH
 from elastalert.enhancements import BaseEnhancement
 from elastalert.enhancements import DropMatchException
 from elastalert.kibana import dashboard_temp
+from elastalert.spool import Spool
 from elastalert.util import dt_to_ts
 from elastalert.util import dt_to_unix
 from elastalert.util import dt_to_unixms
 from elastalert.util import EAException
+from elastalert.util import total_seconds
 from elastalert.util import ts_now
 from elastalert.util import ts_to_dt
 from elastalert.util import unix_to_dt
+from elastalert.writeback_buffer import WritebackBuffer
 
 START_TIMESTAMP = '2014-09-26T12:34:45Z'
 END_TIMESTAMP = '2014-09-27T12:34:45Z'
@@ -112,6 +121,93 @@ def test_query_sixsix(ea_sixsix):
         size=ea_sixsix.rules[0]['max_query_size'], scroll=ea_sixsix.conf['scroll_keepalive'])
 
 
+def test_query_ingest_timestamp_field(ea):
+    ea.rules[0]['ingest_timestamp_field'] = 'event.ingested'
+    ea.thread_data.current_es.search.return_value = {'hits': {'total': 0, 'hits': []}}
+    ea.run_query(ea.rules[0], START, END)
+    ea.thread_data.current_es.search.assert_called_with(body={
+        'query': {'filtered': {
+            'filter': {'bool': {'must': [{'range': {'event.ingested': {'lte': END_TIMESTAMP, 'gt': START_TIMESTAMP}}}]}}}},
+        'sort': [{'@timestamp': {'order': 'asc'}}]}, index='idx', _source_include=['@timestamp'],
+        ignore_unavailable=True,
+        size=ea.rules[0]['max_query_size'], scroll=ea.conf['scroll_keepalive'])
+
+
+def test_query_plan(ea):
+    rule = ea.rules[0]
+    rule['use_query_plan'] = True
+    rule['filter'] = [{'term': {'user': 'qlo'}}]
+
+    # Documents
+    rule['include'] = ['@timestamp', 'user']
+    rule['query_plan'] = ea.compile_query_plan(rule)
+    ea.thread_data.current_es.search.return_value = {'hits': {'total': 0, 'hits': []}}
+    ea.run_query(rule, START, END)
+    search_args = ea.thread_data.current_es.search.call_args[1]
+    assert json.loads(search_args['body']) == ea.get_hits_query(rule, START, END)
+    assert search_args['index'] == 'idx'
+    assert search_args['_source_include'] == '@timestamp,user'
+
+    # Counts
+    rule['use_count_query'] = True
+    rule['doc_type'] = 'doctype'
+    rule['query_plan'] = ea.compile_query_plan(rule)
+    ea.thread_data.current_es.count = mock.Mock(return_value={'count': 5})
+    ea.run_query(rule, START, END)
+    body = ea.thread_data.current_es.count.call_args[1]['body']
+    assert json.loads(body) == ea.get_query(rule['filter'], START, END, sort=False, to_ts_func=rule['dt_to_ts'])
+
+    # Terms
+    rule.pop('use_count_query')
+    rule['use_terms_query'] = True
+    rule['query_key'] = 'username'
+    rule['query_plan'] = ea.compile_query_plan(rule)
+    ea.thread_data.current_es.deprecated_search.return_value = {'hits': {'total': 0, 'hits': []}}
+    ea.run_query(rule, START, END)
+    body = ea.thread_data.current_es.deprecated_search.call_args[1]['body']
+    assert json.loads(body) == ea.build_terms_query(rule, START, END, 'username')
+
+
+def test_query_lean_fetch(ea):
+    rule = ea.rules[0]
+    rule['use_lean_fetch'] = True
+    rule['max_query_size'] = 2
+    rule['max_scrolling_count'] = 0
+    es = ea.thread_data.current_es
+    es.is_atleastseven.return_value = True
+    es.scroll = mock.Mock()
+    es.clear_scroll = mock.Mock()
+    pages = [generate_hits([START_TIMESTAMP, START_TIMESTAMP]), generate_hits([END_TIMESTAMP, END_TIMESTAMP]),
+             generate_hits([END_TIMESTAMP])]
+    for i, page in enumerate(pages):
+        page['_scroll_id'] = 'scroll%s' % i
+        page['hits']['total'] = {'value': 3, 'relation': 'gte'}
+        for hit in page['hits']['hits']:
+            hit['_id'] += '_%s' % i
+    es.search.return_value = pages[0]
+    es.scroll.side_effect = pages[1:]
+
+    assert ea.run_query(rule, START, END)
+
+    search_args = es.search.call_args[1]
+    assert search_args['filter_path'] == LEAN_FETCH_FILTER_PATH
+    assert search_args['track_total_hits'] == 3
+    assert search_args['_source_include'] == ['@timestamp']
+    # Scrolling goes on past the counted total until a page is not full
+    assert es.scroll.call_count == 2
+    assert es.scroll.call_args[1]['filter_path'] == LEAN_FETCH_FILTER_PATH
+    assert ea.thread_data.num_hits == 5
+
+    # Doc values instead of _source, and no hits.hits in the filtered response
+    rule['use_docvalue_fields'] = True
+    es.search.return_value = {'hits': {'total': {'value': 0, 'relation': 'eq'}}}
+    assert ea.run_query(rule, START, END)
+    search_args = es.search.call_args[1]
+    assert search_args['_source'] is False
+    assert search_args['docvalue_fields'] == ['@timestamp']
+    assert '_source_include' not in search_args
+
+
 def test_query_with_fields(ea):
     ea.rules[0]['_source_enabled'] = False
     ea.thread_data.current_es.search.return_value = {'hits': {'total': 0, 'hits': []}}
@@ -805,6 +901,167 @@ def test_query_segmenting_reset_num_hits(ea):
     assert mock_run_query.call_count > 1
 
 
+def test_query_segment_prefetch(ea):
+    start_time = ts_to_dt('2014-09-26T00:00:00Z')
+    end_time = ts_to_dt('2014-09-26T12:00:00Z')
+    ea.rules[0]['buffer_time'] = datetime.timedelta(hours=1)
+    ea.rules[0]['segment_prefetch'] = 3
+
+    def get_hits(rule, start, end, index, scroll=False):
+        # Later segments return first, they must still be processed in order
+        time.sleep(0.01 * (12 - start.hour) / 12)
+        ea.thread_data.num_hits += 1
+        return [{'@timestamp': start, '_id': dt_to_ts(start)}]
+
+    with mock.patch('elastalert.elastalert.elasticsearch_client'), \
+            mock.patch.object(ea, 'get_hits', side_effect=get_hits) as mock_hits, \
+            mock.patch.object(ea.rules[0]['type'], 'garbage_collect') as mock_gc:
+        ea.run_rule(ea.rules[0], end_time, start_time)
+
+    assert mock_hits.call_count == 12
+    expected_starts = [start_time + datetime.timedelta(hours=i) for i in range(12)]
+    added = [call[0][0][0]['@timestamp'] for call in ea.rules[0]['type'].add_data.call_args_list]
+    assert added == expected_starts
+    assert [call[0][0] for call in mock_gc.call_args_list] == expected_starts[1:] + [end_time]
+    assert ea.writeback_es.index.call_args_list[-1][1]['body']['hits'] == 12
+
+
+def test_query_segment_prefetch_pages(ea):
+    start_time = ts_to_dt('2014-09-26T00:00:00Z')
+    end_time = ts_to_dt('2014-09-26T04:00:00Z')
+    rule = ea.rules[0]
+    rule['buffer_time'] = datetime.timedelta(hours=1)
+    rule['max_scrolling_count'] = 0
+    rule['segment_prefetch'] = 1
+
+    def get_hits(rule, start, end, index, scroll=False):
+        # Each segment has three pages of one hit
+        page = rule['scrolling_cycle']
+        ea.thread_data.total_hits = 3
+        ea.thread_data.num_hits += 1
+        rule['scroll_id'] = 'scroll'
+        return [{'@timestamp': start, '_id': '%s-%s' % (dt_to_ts(start), page)}]
+
+    with mock.patch('elastalert.elastalert.elasticsearch_client'), \
+            mock.patch.object(ea, 'get_hits', side_effect=get_hits):
+        ea.run_rule(rule, end_time, start_time)
+
+    # Pages are passed to the rule one at a time, in order
+    added = [call[0][0][0]['_id'] for call in rule['type'].add_data.call_args_list]
+    assert added == ['%s-%s' % (dt_to_ts(start_time + datetime.timedelta(hours=i)), page) for i in range(4) for page in (1, 2, 3)]
+
+
+def test_query_segment_prefetch_point_in_time(ea):
+    start_time = ts_to_dt('2014-09-26T00:00:00Z')
+    end_time = ts_to_dt('2014-09-26T04:00:00Z')
+    rule = ea.rules[0]
+    rule['buffer_time'] = datetime.timedelta(hours=1)
+    rule['max_scrolling_count'] = 0
+    rule['segment_prefetch'] = 2
+    rule['use_point_in_time'] = True
+    es = ea.thread_data.current_es
+    es.is_atleastseventen.return_value = True
+    es.open_point_in_time = mock.Mock(return_value={'id': 'pit'})
+    es.close_point_in_time = mock.Mock()
+
+    def get_hits_page(rule, start, end, pit_id, search_after=None):
+        ea.thread_data.num_hits += 1
+        page = 0 if search_after is None else 1
+        return [{'@timestamp': start, '_id': '%s-%s' % (dt_to_ts(start), page)}], pit_id, None if page else [page]
+
+    with mock.patch('elastalert.elastalert.elasticsearch_client', return_value=es), \
+            mock.patch.object(ea, 'get_hits_page', side_effect=get_hits_page), \
+            mock.patch.object(ea, 'get_hits') as mock_hits:
+        ea.run_rule(rule, end_time, start_time)
+
+    assert not mock_hits.called
+    added = [call[0][0][0]['_id'] for call in rule['type'].add_data.call_args_list]
+    assert added == ['%s-%s' % (dt_to_ts(start_time + datetime.timedelta(hours=i)), page) for i in range(4) for page in (0, 1)]
+    assert es.open_point_in_time.call_count == es.close_point_in_time.call_count == 4
+
+
+def test_date_histogram_backfill(ea):
+    rule = ea.rules[0]
+    rule['use_count_query'] = True
+    rule['use_date_histogram_backfill'] = True
+    rule['five'] = True
+    rule['doc_type'] = 'doctype'
+    ea.run_every = datetime.timedelta(hours=1)
+    start_ms = dt_to_unixms(START)
+    hour_ms = 3600 * 1000
+    es = mock.Mock()
+    es.search.return_value = {'aggregations': {'segments': {'buckets': [
+        {'key': start_ms + 1, 'doc_count': 5},
+        {'key': start_ms + 1 + 2 * hour_ms, 'doc_count': 7}]}}}
+
+    with mock.patch('elastalert.elastalert.elasticsearch_client', return_value=es), \
+            mock.patch.object(ea, 'get_hits_count', return_value={END: 3}) as mock_count:
+        ea.run_rule(rule, END, START)
+
+    # One histogram for the first 23 hours and a count query for the last one
+    assert es.search.call_count == 1
+    query = es.search.call_args[1]['body']
+    histogram = query['aggs']['segments']['date_histogram']
+    assert histogram['interval'] == '%sms' % hour_ms
+    assert histogram['offset'] == '+%sms' % ((start_ms + 1) % hour_ms)
+    assert histogram['extended_bounds'] == {'min': start_ms + 1, 'max': start_ms + 23 * hour_ms}
+    mock_count.assert_called_once_with(rule, START + datetime.timedelta(hours=23), END, 'idx')
+
+    counts = [call[0][0] for call in rule['type'].add_count_data.call_args_list]
+    assert len(counts) == 24
+    assert counts[0] == {START + datetime.timedelta(hours=1): 5}
+    assert counts[1] == {START + datetime.timedelta(hours=2): 0}
+    assert counts[2] == {START + datetime.timedelta(hours=3): 7}
+    assert counts[-1] == {END: 3}
+    assert ea.writeback_es.index.call_args_list[-1][1]['body']['hits'] == 12
+
+
+def test_adaptive_segment_size(ea):
+    rule = ea.rules[0]
+    rule['adaptive_segment_size'] = True
+    rule['max_query_size'] = 1000
+    rule['run_every'] = datetime.timedelta(minutes=1)
+    ea.old_query_limit = datetime.timedelta(days=1)
+
+    # No runs yet
+    assert ea.get_segment_size(rule) == ea.buffer_time
+
+    # 10 hits per second
+    def run_query(rule, start, end):
+        ea.thread_data.num_hits += int(total_seconds(end - start) * 10)
+        return True
+
+    with mock.patch('elastalert.elastalert.elasticsearch_client'), \
+            mock.patch.object(ea, 'run_query', side_effect=run_query):
+        ea.run_rule(rule, START + datetime.timedelta(hours=1), START)
+    assert rule['hit_density'] == 10
+    assert ea.get_segment_size(rule) == datetime.timedelta(seconds=80)
+
+    # Densities are averaged over runs
+    ea.update_hit_density(rule, 360000, START, START + datetime.timedelta(hours=1))
+    assert rule['hit_density'] == 37
+    # Segments are at least run_every long
+    assert ea.get_segment_size(rule) == datetime.timedelta(minutes=1)
+
+    # Sparse rules use segments up to old_query_limit
+    rule['hit_density'] = 0.001
+    assert ea.get_segment_size(rule) == datetime.timedelta(days=1)
+    rule['hit_density'] = 0
+    assert ea.get_segment_size(rule) == datetime.timedelta(days=1)
+
+
+def test_adaptive_segment_size_empty_runs(ea):
+    rule = ea.rules[0]
+    rule['adaptive_segment_size'] = True
+    ea.old_query_limit = datetime.timedelta(days=1)
+    ea.update_hit_density(rule, 1, START, START + datetime.timedelta(minutes=45))
+    # The density of a long run of empty segments gets too small for a timedelta of max_query_size hits
+    for _ in range(1000):
+        ea.update_hit_density(rule, 0, START, START + datetime.timedelta(minutes=45))
+    assert rule['hit_density'] > 0
+    assert ea.get_segment_size(rule) == datetime.timedelta(days=1)
+
+
 def test_query_segmenting(ea):
     # buffer_time segments with normal queries
     ea.rules[0]['buffer_time'] = datetime.timedelta(minutes=53)
@@ -944,6 +1201,51 @@ def test_set_starttime(ea):
     assert ea.rules[0]['starttime'] == end - datetime.timedelta(days=3)
 
 
+def test_set_starttime_ingest_timestamp_field(ea):
+    end = ts_to_dt('2014-10-10T10:10:10')
+    ea.rules[0]['ingest_timestamp_field'] = 'event.ingested'
+
+    # First run uses buffer_time
+    with mock.patch.object(ea, 'get_starttime') as mock_gs:
+        mock_gs.return_value = None
+        ea.set_starttime(ea.rules[0], end)
+    assert ea.rules[0]['starttime'] == end - ea.buffer_time
+
+    # Later runs only fetch what was ingested since the previous run, less the overlap
+    ea.rules[0]['previous_endtime'] = end - datetime.timedelta(minutes=5)
+    ea.set_starttime(ea.rules[0], end)
+    assert ea.rules[0]['starttime'] == end - datetime.timedelta(minutes=6)
+    ea.rules[0]['ingest_timestamp_overlap'] = datetime.timedelta(seconds=10)
+    ea.set_starttime(ea.rules[0], end)
+    assert ea.rules[0]['starttime'] == end - datetime.timedelta(minutes=5, seconds=10)
+
+    # After a restart, the last run is read from elastalert_status
+    ea.rules[0].pop('starttime')
+    ea.rules[0].pop('previous_endtime')
+    with mock.patch.object(ea, 'get_starttime') as mock_gs:
+        mock_gs.return_value = end - datetime.timedelta(minutes=1)
+        ea.set_starttime(ea.rules[0], end)
+    assert ea.rules[0]['starttime'] == end - datetime.timedelta(minutes=1)
+
+
+def test_remove_duplicate_events_ingest_timestamp_field(ea):
+    rule = ea.rules[0]
+    rule['ingest_timestamp_field'] = 'event.ingested'
+    rule['buffer_time'] = datetime.timedelta(minutes=1)
+    rule['ingest_timestamp_overlap'] = datetime.timedelta(minutes=10)
+    now = ts_now()
+    # An event from long ago which was only just ingested
+    event = {'_id': 'late', '@timestamp': now - datetime.timedelta(days=1), 'event': {'ingested': dt_to_ts(now)}}
+    assert ea.remove_duplicate_events([event], rule) == [event]
+
+    # It is remembered as long as it may be fetched again by the overlap
+    ea.remove_old_events(rule)
+    assert ea.remove_duplicate_events([event], rule) == []
+    with mock.patch('elastalert.elastalert.ts_now', return_value=now + datetime.timedelta(minutes=11)):
+        ea.remove_old_events(rule)
+    assert ea.remove_duplicate_events([event], rule) == [event]
+
+
 def test_kibana_dashboard(ea):
     match = {'@timestamp': '2014-10-11T00:00:00'}
     mock_es = mock.Mock()
@@ -1090,6 +1392,37 @@ def test_strf_index(ea):
     assert ea.get_index(ea.rules[0]) == 'logstash-*-stuff'
 
 
+def test_resolve_index_with_index_catalog(ea):
+    ea.rules[0]['index'] = 'logstash-%Y.%m.%d'
+    ea.rules[0]['use_strftime_index'] = True
+    ea.rules[0]['use_index_catalog'] = True
+    ea.thread_data.current_es.cat = mock.Mock()
+    ea.thread_data.current_es.cat.indices.return_value = [{'index': 'logstash-2015.01.02'}, {'index': 'logstash-2015.01.05'}]
+    start = ts_to_dt('2015-01-01T12:00:00Z')
+    end = ts_to_dt('2015-01-05T12:00:00Z')
+
+    with mock.patch('elastalert.index_catalog.ts_now', return_value=ts_to_dt('2015-01-06T00:00:00Z')):
+        # Only the indices which exist are queried
+        assert set(ea.resolve_index(ea.rules[0], start, end).split(',')) == {'logstash-2015.01.02', 'logstash-2015.01.05'}
+        # The catalog is cached
+        ea.resolve_index(ea.rules[0], start, end)
+    ea.thread_data.current_es.cat.indices.assert_called_once_with(index='logstash-*', h='index', format='json')
+
+    # Indices of days after the catalog was refreshed are kept
+    end = ts_to_dt('2015-01-07T12:00:00Z')
+    with mock.patch('elastalert.index_catalog.ts_now', return_value=ts_to_dt('2015-01-06T00:01:00Z')):
+        assert set(ea.resolve_index(ea.rules[0], start, end).split(',')) == {
+            'logstash-2015.01.02', 'logstash-2015.01.05', 'logstash-2015.01.06', 'logstash-2015.01.07'}
+
+        # Too many indices are queried with a wildcard per month of the time range
+        ea.rules[0]['index_catalog_max_indices'] = 3
+        assert ea.resolve_index(ea.rules[0], start, end) == 'logstash-2015.01.*'
+
+        # The wildcard of the whole index is only queried if there are too many months and years
+        ea.rules[0]['index_catalog_max_indices'] = 0
+        assert ea.resolve_index(ea.rules[0], start, end) == 'logstash-*'
+
+
 def test_count_keys(ea):
     ea.rules[0]['timeframe'] = datetime.timedelta(minutes=60)
     ea.rules[0]['top_count_keys'] = ['this', 'that']
@@ -1378,3 +1711,607 @@ def test_query_with_blacklist_filter_es_five(ea_sixsix):
     ea_sixsix.init_rule(new_rule, True)
     assert 'username:"xudan1" OR username:"xudan12" OR username:"aa1"' in new_rule['filter'][-1]['query_string'][
         'query']
+
+
+def test_query_msearch_batching(ea):
+    ea.rules[0]['use_msearch_batching'] = True
+    ea.thread_data.current_es.msearch = mock.Mock(return_value={'responses': [{'hits': {'total': 0, 'hits': []}}]})
+    ea.run_query(ea.rules[0], START, END)
+    ea.thread_data.current_es.msearch.assert_called_with(body=[
+        {'index': 'idx', 'ignore_unavailable': True},
+        {'query': {'filtered': {
+            'filter': {'bool': {'must': [{'range': {'@timestamp': {'lte': END_TIMESTAMP, 'gt': START_TIMESTAMP}}}]}}}},
+         'sort': [{'@timestamp': {'order': 'asc'}}], 'size': ea.rules[0]['max_query_size'],
+         '_source': {'includes': ['@timestamp']}}])
+    assert not ea.thread_data.current_es.search.called
+
+
+def test_query_msearch_batching_scrolls_on(ea):
+    rule = ea.rules[0]
+    rule['use_msearch_batching'] = True
+    rule['max_query_size'] = 1
+    rule['max_scrolling_count'] = 0
+    es = ea.thread_data.current_es
+    es.scroll = mock.Mock(return_value=generate_hits([END_TIMESTAMP]))
+    es.clear_scroll = mock.Mock()
+    first_page = generate_hits([START_TIMESTAMP])
+    first_page['hits']['total'] = 3
+    es.msearch = mock.Mock(return_value={'responses': [first_page]})
+    # The hit of the batched page is fetched again as it has the timestamp the scroll query starts from
+    more = dict(generate_hits([START_TIMESTAMP, END_TIMESTAMP]), _scroll_id='scroll')
+    more['hits']['total'] = 3
+    es.search.return_value = more
+
+    with mock.patch.object(rule['type'], 'add_data') as add_data:
+        assert ea.run_query(rule, START, END)
+
+    assert es.msearch.call_count == 1
+    # The batched query is not run again, the scroll query only asks for the hits from the last batched one on
+    assert es.search.call_count == 1
+    must = es.search.call_args[1]['body']['query']['filtered']['filter']['bool']['must']
+    assert must[-1] == {'range': {'@timestamp': {'gte': START_TIMESTAMP}}}
+    assert [hit['_id'] for hit in add_data.call_args_list[0][0][0]] == ['id0', 'id1']
+    es.scroll.assert_called_once_with(scroll_id='scroll', scroll=ea.scroll_keepalive)
+
+
+def test_query_msearch_batching_lean_fetch(ea):
+    rule = ea.rules[0]
+    rule['use_msearch_batching'] = True
+    rule['use_lean_fetch'] = True
+    rule['use_docvalue_fields'] = True
+    es = ea.thread_data.current_es
+    es.is_atleastseven.return_value = True
+    es.msearch = mock.Mock(return_value={'responses': [{'hits': {'total': {'value': 0, 'relation': 'eq'}}}]})
+    assert ea.run_query(rule, START, END)
+    body = es.msearch.call_args[1]['body'][1]
+    assert body['track_total_hits'] == rule['max_query_size'] + 1
+    assert body['docvalue_fields'] == ['@timestamp']
+    assert body['_source'] is False
+    assert es.msearch.call_args[1]['filter_path'] == ['responses.%s' % path for path in LEAN_FETCH_FILTER_PATH] + \
+        ['responses.error', 'responses.status']
+
+
+def test_query_point_in_time(ea):
+    ea.rules[0]['use_point_in_time'] = True
+    ea.rules[0]['max_query_size'] = 2
+    ea.rules[0]['max_scrolling_count'] = 0
+    ea.thread_data.current_es.is_atleastseventen.return_value = True
+    ea.thread_data.current_es.open_point_in_time = mock.Mock(return_value={'id': 'pit1'})
+    ea.thread_data.current_es.close_point_in_time = mock.Mock()
+    pages = []
+    for timestamps in [[START_TIMESTAMP, START_TIMESTAMP], [END_TIMESTAMP]]:
+        page = generate_hits(timestamps)
+        for hit in page['hits']['hits']:
+            hit['_id'] += '_%s' % len(pages)
+            hit['sort'] = [hit['_source']['@timestamp'], hit['_id']]
+        page['pit_id'] = 'pit%s' % (len(pages) + 2)
+        pages.append(page)
+    ea.thread_data.current_es.search.side_effect = pages
+
+    assert ea.run_query(ea.rules[0], START, END)
+
+    assert ea.thread_data.current_es.search.call_count == 2
+    first_page, second_page = [call[1]['body'] for call in ea.thread_data.current_es.search.call_args_list]
+    assert first_page['pit'] == {'id': 'pit1', 'keep_alive': '30s'}
+    assert first_page['sort'] == [{'@timestamp': {'order': 'asc'}}, {'_id': {'order': 'asc'}}]
+    assert 'search_after' not in first_page
+    assert second_page['pit']['id'] == 'pit2'
+    assert second_page['search_after'] == [START_TIMESTAMP, 'id1_0']
+    # Each page is passed to the rule as it arrives
+    assert ea.rules[0]['type'].add_data.call_count == 2
+    ea.thread_data.current_es.close_point_in_time.assert_called_once_with(body={'id': 'pit3'})
+
+
+def test_query_composite_aggregation(ea):
+    rule = ea.rules[0]
+    rule['use_terms_query'] = True
+    rule['query_key'] = 'username'
+    rule['use_composite_aggregation'] = True
+    rule['composite_size'] = 2
+    rule['five'] = True
+    es = ea.thread_data.current_es
+    es.is_atleastsixtwo.return_value = True
+    es.is_atleastsixthree.return_value = True
+    pages = [
+        {'aggregations': {'composite_aggs': {'after_key': {'key0': 'b'}, 'buckets': [
+            {'key': {'key0': 'a'}, 'doc_count': 3}, {'key': {'key0': 'b'}, 'doc_count': 1}]}}},
+        {'aggregations': {'composite_aggs': {'after_key': {'key0': 'c'}, 'buckets': [
+            {'key': {'key0': 'c'}, 'doc_count': 5}]}}},
+    ]
+    bodies = []
+
+    def search(**kwargs):
+        bodies.append(copy.deepcopy(kwargs['body']))
+        return pages[len(bodies) - 1]
+    es.search.side_effect = search
+
+    assert ea.run_query(rule, START, END)
+
+    # A short page ends the paging even though it has an after_key
+    assert len(bodies) == 2
+    composite = bodies[0]['aggs']['composite_aggs']['composite']
+    assert composite['size'] == 2
+    assert composite['sources'] == [{'key0': {'terms': {'field': 'username'}}}]
+    assert 'after' not in composite
+    assert bodies[1]['aggs']['composite_aggs']['composite']['after'] == {'key0': 'b'}
+    assert rule['type'].add_terms_data.call_args_list == [
+        mock.call({END: [{'key': 'a', 'doc_count': 3}, {'key': 'b', 'doc_count': 1}]}),
+        mock.call({END: [{'key': 'c', 'doc_count': 5}]}),
+    ]
+    assert ea.thread_data.num_hits == 3
+
+    # Top counts keep the largest buckets of every page
+    rule['top_count_keys'] = ['username']
+    bodies[:] = []
+    counts = ea.get_top_counts(rule, START, END, ['username'], number=2)
+    assert counts == {'top_events_username': {'c': 5, 'a': 3}}
+
+    # Top counts only read composite_top_count_pages pages
+    rule['composite_top_count_pages'] = 1
+    bodies[:] = []
+    counts = ea.get_top_counts(rule, START, END, ['username'], number=2)
+    assert len(bodies) == 1
+    assert counts == {'top_events_username': {'a': 3, 'b': 1}}
+
+    # Elasticsearch 6.2 does not return after_key, terms aggregations are used instead
+    es.is_atleastsixthree.return_value = False
+    assert not ea.use_composite_aggregation(rule)
+
+
+def test_nest_composite_buckets(ea):
+    buckets = [
+        {'key': {'key0': 'a', 'key1': 'x'}, 'doc_count': 2, 'metric_cpu_avg': {'value': 1}},
+        {'key': {'key0': 'a', 'key1': 'y'}, 'doc_count': 3, 'metric_cpu_avg': {'value': 2}},
+        {'key': {'key0': 'b', 'key1': 'x'}, 'doc_count': 1, 'metric_cpu_avg': {'value': 3}},
+    ]
+    assert ea.nest_composite_buckets(buckets, 2) == {'bucket_aggs': {'buckets': [
+        {'key': 'a', 'doc_count': 5, 'bucket_aggs': {'buckets': [
+            {'key': 'x', 'doc_count': 2, 'metric_cpu_avg': {'value': 1}},
+            {'key': 'y', 'doc_count': 3, 'metric_cpu_avg': {'value': 2}}]}},
+        {'key': 'b', 'doc_count': 1, 'bucket_aggs': {'buckets': [
+            {'key': 'x', 'doc_count': 1, 'metric_cpu_avg': {'value': 3}}]}},
+    ]}}
+
+
+def test_worker_owns_rule_files(ea):
+    ea.worker_processes = 2
+    ea.worker_index = 1
+    ea.rule_hashes_queue = mock.Mock()
+    ea.rule_hashes = {}
+    ea.rules_loader.get_hashes.reset_mock()
+    rule_files = ['rules/rule%s.yaml' % i for i in range(10)]
+    owned = [rule_file for rule_file in rule_files if ea.owns_rule_file(rule_file)]
+    assert owned and len(owned) < len(rule_files)
+
+    # The hashes come from the pool, not from the rules loader
+    ea.rule_hashes_queue.get_nowait.side_effect = [dict.fromkeys(rule_files, 'old'), dict.fromkeys(rule_files, 'new'),
+                                                   queue.Empty]
+    assert ea.get_rule_hashes() == dict.fromkeys(owned, 'new')
+    assert not ea.rules_loader.get_hashes.called
+
+    # Nothing new was sent
+    ea.rule_hashes = dict.fromkeys(owned, 'new')
+    ea.rule_hashes_queue.get_nowait.side_effect = queue.Empty
+    assert ea.get_rule_hashes() == dict.fromkeys(owned, 'new')
+
+
+def test_cluster_sharding(ea):
+    ea.cluster_sharding = True
+    ea.instance_id = 'a'
+    rules = [dict(ea.rules[0], name='rule%s' % i) for i in range(20)]
+    ea.rules = rules
+    ea.writeback_es.deprecated_search.return_value = {'hits': {'hits': [{'_source': {'instance_id': 'b'}}]}}
+
+    ea.handle_heartbeat()
+
+    heartbeat = ea.writeback_es.index.call_args[1]
+    assert heartbeat['doc_type'] == 'elastalert_heartbeat'
+    assert heartbeat['id'] == 'a'
+    assert heartbeat['body']['instance_id'] == 'a'
+    assert ea.hash_ring.members == {'a', 'b'}
+    owned = [rule for rule in rules if ea.owns_rule(rule)]
+    standby = [rule for rule in rules if not ea.owns_rule(rule)]
+    assert owned and standby
+
+    # Rules of other instances are not run
+    with mock.patch.object(ea, 'run_rule') as run_rule:
+        ea.handle_rule_execution(standby[0])
+    assert not run_rule.called
+
+    # When b stops, its rules are taken over and resume from their elastalert_status checkpoints,
+    # without what this instance learned when it last ran them
+    rule_type = rules[0]['type']
+    for rule in rules:
+        rule['previous_endtime'] = END
+        rule['original_starttime'] = START
+        rule['processed_hits'] = {'old': END}
+    ea.writeback_es.deprecated_search.return_value = {'hits': {'hits': []}}
+    ea.handle_heartbeat()
+    assert ea.hash_ring.members == {'a'}
+    assert all(ea.owns_rule(rule) for rule in rules)
+    # The rules are reset by their next run, as they could still be running
+    assert all(rule['type'] is rule_type for rule in rules)
+    with mock.patch.object(ea, 'run_rule', return_value=0):
+        for rule in rules:
+            ea.handle_rule_execution(rule)
+    assert all('previous_endtime' not in rule and rule['processed_hits'] == {} for rule in standby)
+    assert all(rule['type'] is not rule_type for rule in standby)
+    assert all(rule['previous_endtime'] == END and rule['type'] is rule_type for rule in owned)
+
+    ea.stop()
+    assert ea.writeback_es.delete.call_args[1] == {'index': 'wb', 'doc_type': 'elastalert_heartbeat', 'id': 'a'}
+
+
+def test_get_rule_lag(ea):
+    rule = ea.rules[0]
+    assert ea.get_rule_lag(rule) == 0
+    rule['previous_endtime'] = START
+    rule['query_delay'] = datetime.timedelta(minutes=10)
+    with mock.patch('elastalert.elastalert.ts_now', return_value=START + datetime.timedelta(minutes=15)):
+        assert ea.get_rule_lag(rule) == 300
+        assert ea.get_job_lag(mock.Mock(args=[rule])) == 300
+        assert ea.get_job_lag(mock.Mock(args=[])) == 0
+
+
+def test_alert_dispatch_workers(ea):
+    ea.alert_dispatcher = mock.Mock()
+    hits = generate_hits([START_TIMESTAMP, END_TIMESTAMP])
+    ea.thread_data.current_es.search.return_value = hits
+    ea.rules[0]['type'].matches = [{'@timestamp': END}]
+    with mock.patch('elastalert.elastalert.elasticsearch_client', return_value=ea.thread_data.current_es):
+        ea.run_rule(ea.rules[0], END, START)
+
+    # The alert is queued instead of being sent by the rule
+    assert not ea.rules[0]['alert'][0].alert.called
+    matches, rule, current_es = ea.alert_dispatcher.dispatch.call_args[0]
+    assert rule is ea.rules[0]
+    assert current_es is ea.thread_data.current_es
+    assert matches[0]['@timestamp'] == END
+
+    # The worker sends it with the rule's client
+    other_es = mock.Mock()
+    worker_es = []
+
+    def send():
+        ea.send_dispatched_alert(matches, rule, other_es)
+        worker_es.append(ea.thread_data.current_es)
+    thread = threading.Thread(target=send)
+    thread.start()
+    thread.join()
+    assert ea.rules[0]['alert'][0].alert.call_count == 1
+    assert worker_es == [other_es]
+    assert ea.thread_data.current_es is current_es
+
+
+def test_alert_dispatch_workers_alerts_sent(ea):
+    ea.alert_dispatcher = AlertDispatcher(ea.send_dispatched_alert, workers=1)
+    ea.statsd = mock.Mock()
+    ea.rules[0]['type'].matches = [{'@timestamp': END}]
+    ea.thread_data.current_es.search.return_value = generate_hits([START_TIMESTAMP])
+    with mock.patch('elastalert.elastalert.elasticsearch_client', return_value=ea.thread_data.current_es):
+        ea.handle_rule_execution(ea.rules[0])
+        ea.alert_dispatcher.join()
+        ea.rules[0]['type'].matches = []
+        ea.handle_rule_execution(ea.rules[0])
+    ea.alert_dispatcher.shutdown()
+
+    # The alert sent by the worker is counted by the next run of the rule
+    alerts_sent = [call[0][1] for call in ea.statsd.gauge.call_args_list if call[0][0] == 'query.alerts_sent']
+    assert sum(alerts_sent) == 1
+    assert ea.alert_dispatcher.pop_sent(ea.rules[0]['name']) == 0
+
+
+def test_handle_signal_writes_queued_alerts(ea):
+    release = threading.Event()
+    ea.alert_dispatcher = AlertDispatcher(lambda matches, rule, current_es: release.wait(5), workers=1)
+    ea.alert_dispatch_shutdown_timeout = 0.1
+    ea.alert_dispatcher.dispatch([{'@timestamp': END, 'n': 1}], ea.rules[0])
+    ea.alert_dispatcher.dispatch([{'@timestamp': END, 'n': 2}], ea.rules[0])
+    with mock.patch('os._exit') as mock_exit, mock.patch('signal.signal') as mock_signal:
+        handle_client_signals(ea)
+        mock_signal.call_args[0][1](signal.SIGTERM, None)
+    release.set()
+    mock_exit.assert_called_once_with(0)
+
+    # The alert which could not be sent in time is left as a pending alert
+    assert ea.writeback_es.index.call_count == 1
+    body = ea.writeback_es.index.call_args[1]['body']
+    assert body['match_body']['n'] == 2
+    assert body['alert_sent'] is False
+    assert body['rule_name'] == ea.rules[0]['name']
+
+
+def test_init_rules_startup_threads(ea):
+    ea.conf['startup_threads'] = 4
+    rules = [dict(copy.deepcopy(ea.rules[0]), name='rule%s' % i) for i in range(10)]
+
+    def init_rule(rule):
+        return rule if rule['name'] != 'rule3' else False
+    with mock.patch.object(ea, 'init_rule', side_effect=init_rule) as mock_init:
+        initialized = ea.init_rules(rules)
+    assert mock_init.call_count == 10
+    assert [rule['name'] for rule in initialized] == ['rule%s' % i for i in range(10) if i != 3]
+
+
+def test_writeback_buffer(ea):
+    ea.writeback_buffer = mock.Mock()
+    res = ea.writeback('elastalert_status', {'rule_name': 'testrule'})
+    index, doc_type, doc_id, body = ea.writeback_buffer.add.call_args[0]
+    assert (index, doc_type) == ('wb', 'elastalert_status')
+    assert res['_id'] == doc_id
+    assert body['rule_name'] == 'testrule'
+    assert not ea.writeback_es.index.called
+
+    # Checkpoints are buffered with the _id of their rule, so that a checkpoint written again replaces it
+    ea.writeback('elastalert_checkpoint', {'rule_name': 'testrule'}, doc_id='checkpoint')
+    assert ea.writeback_buffer.add.call_args[0][1:3] == ('elastalert_checkpoint', 'checkpoint')
+
+    # Alerts, aggregates and silences are written right away, and failures are returned
+    for doc_type in ('elastalert', 'silence'):
+        ea.writeback(doc_type, {'rule_name': 'testrule'})
+    assert ea.writeback_es.index.call_count == 2
+    assert ea.writeback_buffer.add.call_count == 2
+    ea.writeback_es.index.side_effect = ConnectionError('N/A', 'ES is down', None)
+    ea.writeback_buffer.spool = None
+    assert ea.writeback('elastalert', {'rule_name': 'testrule'}) is None
+
+
+def test_writeback_spool_alerts(ea, tmpdir):
+    ea.writeback_buffer = WritebackBuffer(ea.writeback_es, flush_interval=3600, spool=Spool(str(tmpdir)))
+    ea.writeback_es.index.side_effect = ConnectionError('N/A', 'ES is down', None)
+    ea.rules[0]['agg_matches'] = []
+    ea.rules[0]['aggregate_alert_time'] = {}
+    ea.rules[0]['current_aggregate_id'] = {}
+    ea.rules[0]['aggregation'] = datetime.timedelta(minutes=10)
+
+    # Aggregated matches which cannot be written are spooled, with the _id they were tried with
+    ea.add_aggregated_alert({'@timestamp': START, 'n': 1}, ea.rules[0])
+    agg_id = ea.writeback_es.index.call_args[1]['id']
+    ea.add_aggregated_alert({'@timestamp': START, 'n': 2}, ea.rules[0])
+    assert ea.rules[0]['current_aggregate_id'] == {None: agg_id}
+    assert ea.rules[0]['agg_matches'] == []
+    ea.writeback_buffer.shutdown()
+
+    # They are written when ElastAlert starts again
+    ea.writeback_es.bulk.return_value = {'items': []}
+    ea.writeback_buffer = WritebackBuffer(ea.writeback_es, flush_interval=3600, spool=Spool(str(tmpdir)))
+    with mock.patch.object(ea, 'wait_until_responsive'), mock.patch.object(ea, 'load_silences'), \
+            mock.patch.object(ea, 'run_all_rules'), mock.patch.object(ea, 'sleep_for', side_effect=lambda duration: ea.stop()):
+        ea.start()
+    body = ea.writeback_es.bulk.call_args[1]['body']
+    assert body[0] == {'index': {'_id': agg_id, '_type': 'elastalert'}}
+    assert body[3]['aggregate_id'] == agg_id
+    assert [doc['match_body']['n'] for doc in body[1::2]] == [1, 2]
+    ea.writeback_buffer.shutdown()
+
+
+def test_get_aggregated_matches_pages(ea):
+    ea.writeback_es.is_atleastfive.return_value = True
+    ea.writeback_es.is_atleastsixtwo.return_value = True
+    ea.max_query_size = 2
+    ea.max_aggregation = 5
+    hits = [{'_id': str(i), '_index': 'wb', '_source': {'match_body': {'i': i}}, 'sort': [i, str(i)]} for i in range(6)]
+    ea.writeback_es.search.side_effect = [{'hits': {'hits': hits[0:2]}}, {'hits': {'hits': hits[2:4]}},
+                                          {'hits': {'hits': hits[4:5]}}]
+
+    matches = ea.get_aggregated_matches('ABCD')
+    assert [match['match_body']['i'] for match in matches] == list(range(5))
+
+    # Pages after the first continue from the last hit, and the last page only fetches up to max_aggregation
+    calls = ea.writeback_es.search.call_args_list
+    assert [call[1]['size'] for call in calls] == [2, 2, 1]
+    assert 'search_after' not in calls[0][1]['body']
+    assert calls[1][1]['body']['search_after'] == [1, '1']
+    assert calls[2][1]['body']['search_after'] == [3, '3']
+    assert calls[0][1]['body']['sort'] == [{'@timestamp': 'asc'}, {'_id': {'order': 'asc'}}]
+
+    # The matches are deleted with one bulk request
+    assert not ea.writeback_es.delete.called
+    assert ea.writeback_es.bulk.call_count == 1
+    assert ea.writeback_es.bulk.call_args[1]['body'] == [{'delete': {'_index': 'wb', '_id': str(i)}} for i in range(5)]
+
+
+def test_send_pending_alerts_bulk_delete(ea):
+    ea.rules[0].pop('aggregation')
+    pending_alerts = [{'_id': 'A%d' % i, '_index': 'wb', '_type': 'elastalert',
+                       '_source': {'match_body': {'foo': 'bar'}, 'rule_name': ea.rules[0]['name'],
+                                   'alert_time': START_TIMESTAMP, '@timestamp': START_TIMESTAMP}} for i in range(3)]
+    ea.writeback_es.deprecated_search.side_effect = [{'hits': {'hits': pending_alerts}}] + [{'hits': {'hits': []}}] * 3
+    ea.writeback_es.bulk.return_value = {'items': [{'delete': {'_id': 'A1', 'status': 500, 'error': 'failed'}}]}
+    with mock.patch.object(ea, 'handle_error') as handle_error:
+        ea.send_pending_alerts()
+
+    assert ea.rules[0]['alert'][0].alert.call_count == 3
+    assert not ea.writeback_es.delete.called
+    assert ea.writeback_es.bulk.call_args[1]['body'] == [{'delete': {'_index': 'wb', '_id': 'A%d' % i, '_type': 'elastalert'}}
+                                                         for i in range(3)]
+    assert 'A1' in handle_error.call_args[0][0]
+
+
+def test_rule_checkpoints(ea):
+    ea.use_rule_checkpoints = True
+    ea.write_status_history = False
+    rule = ea.rules[0]
+    checkpoint_id = ea.get_checkpoint_id(rule)
+    endtime = ts_now() - datetime.timedelta(minutes=5)
+    checkpoint = {'rule_name': rule['name'], 'endtime': dt_to_ts(endtime), 'runs': 3, 'total_hits': 10, 'total_matches': 1}
+    ea.writeback_es.mget = mock.Mock(return_value={'docs': [{'_id': checkpoint_id, 'found': True, '_source': checkpoint},
+                                                            {'_id': 'other', 'found': False}]})
+    ea.load_checkpoints(ea.rules)
+    assert ea.writeback_es.mget.call_args[1] == {'index': 'wb', 'doc_type': 'elastalert_checkpoint',
+                                                 'body': {'ids': [checkpoint_id]}}
+
+    # The rule resumes from its checkpoint without searching the status index
+    assert ea.get_starttime(rule) == ts_to_dt(dt_to_ts(endtime))
+    assert not ea.writeback_es.deprecated_search.called
+
+    # Runs replace the checkpoint instead of adding status documents
+    ea.thread_data.current_es.search.return_value = {'hits': {'total': 0, 'hits': []}}
+    rule['starttime'] = START
+    with mock.patch('elastalert.elastalert.elasticsearch_client'):
+        ea.run_rule(rule, END, START)
+    assert ea.writeback_es.index.call_count == 1
+    call = ea.writeback_es.index.call_args[1]
+    assert call['id'] == checkpoint_id
+    assert call['doc_type'] == 'elastalert_checkpoint'
+    assert call['body']['endtime'] == END_TIMESTAMP
+    assert (call['body']['runs'], call['body']['total_hits'], call['body']['total_matches']) == (4, 10, 1)
+
+    # Later, the checkpoint is read again, and a missing checkpoint falls back to elastalert_status
+    ea.writeback_es.get = mock.Mock(side_effect=elasticsearch.exceptions.NotFoundError(404, 'not found'))
+    ea.writeback_es.deprecated_search.return_value = {'hits': {'hits': []}}
+    assert ea.get_starttime(rule) is None
+    assert ea.writeback_es.get.call_args[1]['id'] == checkpoint_id
+    assert ea.writeback_es.deprecated_search.called
+
+
+def test_rule_checkpoints_missing(ea):
+    ea.use_rule_checkpoints = True
+    rule = ea.rules[0]
+    ea.writeback_es.mget = mock.Mock(return_value={'docs': [{'_id': ea.get_checkpoint_id(rule), 'found': False}]})
+    ea.writeback_es.get = mock.Mock()
+    ea.load_checkpoints(ea.rules)
+
+    # A rule found to have no checkpoint at startup does not read it again for its first checkpoint
+    ea.write_checkpoint(rule, {'endtime': END_TIMESTAMP, 'hits': 3, 'matches': 1})
+    assert not ea.writeback_es.get.called
+    body = ea.writeback_es.index.call_args[1]['body']
+    assert (body['runs'], body['total_hits'], body['total_matches']) == (1, 3, 1)
+
+
+def test_load_silences(ea):
+    until = ts_now() + datetime.timedelta(hours=1)
+    written = ts_now() - datetime.timedelta(minutes=5)
+    hit = {'_source': {'rule_name': 'anytest.qlo', 'until': dt_to_ts(until), 'exponent': 2, '@timestamp': dt_to_ts(written)}}
+    ea.writeback_es.deprecated_search.return_value = {'hits': {'hits': [hit]}}
+    ea.load_silences()
+    query = ea.writeback_es.deprecated_search.call_args[1]['body']
+    # Silences which ended within silence_cache_ttl are loaded for their exponent
+    assert ts_to_dt(query['filter']['range']['until']['gt']) < ts_now() - ea.silence_cache.ttl + datetime.timedelta(minutes=1)
+    assert ea.silence_cache['anytest.qlo'] == (ts_to_dt(dt_to_ts(until)), 2)
+
+    # Lookups no longer query Elasticsearch
+    ea.writeback_es.deprecated_search.reset_mock()
+    assert ea.is_silenced('anytest.qlo')
+    assert not ea.is_silenced('anytest.other')
+    assert not ea.writeback_es.deprecated_search.called
+
+    # Refreshes only load silences written since the last one loaded
+    ea.writeback_es.deprecated_search.return_value = {'hits': {'hits': []}}
+    ea.handle_pending_alerts()
+    query = ea.writeback_es.deprecated_search.call_args_list[0][1]['body']
+    assert list(query['filter']['range']) == ['@timestamp']
+    assert ts_to_dt(query['filter']['range']['@timestamp']['gte']) > written
+    assert ea.is_silenced('anytest.qlo')
+
+    # Once a silence in effect was dropped from the cache, lookups of the missing ones query Elasticsearch again
+    ea.writeback_es.deprecated_search.reset_mock()
+    ea.silence_cache.dropped_active = True
+    assert not ea.is_silenced('anytest.other')
+    assert ea.writeback_es.deprecated_search.called
+
+
+def test_load_silences_first_page(ea):
+    # Before Elasticsearch 5 only the first page of silences is loaded
+    hits = [{'_source': {'rule_name': 'rule%s' % i, 'until': dt_to_ts(ts_now() + datetime.timedelta(hours=1))}} for i in range(1000)]
+    ea.writeback_es.deprecated_search.return_value = {'hits': {'hits': hits}}
+    ea.load_silences()
+    ea.writeback_es.deprecated_search.reset_mock()
+    ea.writeback_es.deprecated_search.return_value = {'hits': {'hits': []}}
+    assert not ea.is_silenced('rule1000')
+    assert ea.writeback_es.deprecated_search.called
+
+
+def test_rule_checkpoints_cluster_sharding(ea):
+    ea.use_rule_checkpoints = True
+    ea.cluster_sharding = True
+    ea.instance_id = 'a'
+    rules = [dict(ea.rules[0], name='rule%s' % i) for i in range(20)]
+    ea.rules = rules
+    instances = [{'_source': {'instance_id': 'b'}}]
+
+    def deprecated_search(doc_type, **kwargs):
+        return {'hits': {'hits': instances if doc_type == 'elastalert_heartbeat' else []}}
+    ea.writeback_es.deprecated_search.side_effect = deprecated_search
+    ea.writeback_es.mget = mock.Mock(return_value={'docs': []})
+    ea.writeback_es.get = mock.Mock(return_value={'_source': {'rule_name': 'x', 'endtime': END_TIMESTAMP, 'runs': 5,
+                                                              'total_hits': 7, 'total_matches': 2}})
+    with mock.patch.object(ea, 'sleep_for', side_effect=lambda duration: ea.stop()):
+        ea.start()
+    owned = [rule for rule in rules if ea.owns_rule(rule)]
+    standby = [rule for rule in rules if not ea.owns_rule(rule)]
+    assert owned and standby
+
+    # Only the checkpoints of owned rules are read at startup
+    assert ea.writeback_es.mget.call_count == 1
+    ids = ea.writeback_es.mget.call_args[1]['body']['ids']
+    assert ids == [ea.get_checkpoint_id(rule) for rule in owned]
+
+    # A rule which is taken over forgets what it read before and reads its checkpoint again
+    ea.checkpoints[standby[0]['name']] = {'rule_name': standby[0]['name'], 'endtime': START_TIMESTAMP}
+    standby[0]['checkpoint_counters'] = {'runs': 1, 'total_hits': 0, 'total_matches': 0}
+    instances = []
+    ea.handle_heartbeat()
+    standby[0]['original_starttime'] = START
+    with mock.patch.object(ea, 'run_rule', return_value=0):
+        ea.handle_rule_execution(standby[0])
+    assert standby[0]['name'] not in ea.checkpoints
+    assert 'checkpoint_counters' not in standby[0]
+
+    # Counters carry on from the stored checkpoint
+    ea.write_checkpoint(standby[0], {'endtime': END_TIMESTAMP, 'hits': 3, 'matches': 1})
+    assert ea.writeback_es.get.call_args[1]['id'] == ea.get_checkpoint_id(standby[0])
+    body = ea.writeback_es.index.call_args[1]['body']
+    assert (body['runs'], body['total_hits'], body['total_matches']) == (6, 10, 3)
+
+
+def test_cluster_sharding_fails_closed(ea):
+    ea.cluster_sharding = True
+    ea.instance_id = 'a'
+    ea.writeback_es.deprecated_search.side_effect = ConnectionError('N/A', 'ES is down', None)
+    ea.handle_heartbeat()
+
+    # No rule runs until the live instances are known
+    assert ea.hash_ring is None
+    assert not ea.owns_rule(ea.rules[0])
+    with mock.patch.object(ea, 'run_rule') as run_rule:
+        ea.handle_rule_execution(ea.rules[0])
+    assert not run_rule.called
+
+    ea.writeback_es.deprecated_search.side_effect = None
+    ea.writeback_es.deprecated_search.return_value = {'hits': {'hits': []}}
+    ea.handle_heartbeat()
+    assert ea.owns_rule(ea.rules[0])
+
+
+def test_heartbeat_thread(ea):
+    ea.cluster_sharding = True
+    ea.instance_id = 'a'
+    ea.heartbeat_interval = 0.01
+    ea.writeback_es.deprecated_search.return_value = {'hits': {'hits': []}}
+
+    def sleep_for(duration):
+        time.sleep(0.3)
+        ea.stop()
+    with mock.patch.object(ea, 'handle_heartbeat', wraps=ea.handle_heartbeat) as handle_heartbeat, \
+            mock.patch.object(ea, 'wait_until_responsive'), mock.patch.object(ea, 'load_silences'), \
+            mock.patch.object(ea, 'run_all_rules'), mock.patch.object(ea, 'sleep_for', side_effect=sleep_for):
+        ea.start()
+    # Heartbeats are sent from a thread of their own instead of a rule thread, until the heartbeat is removed
+    assert ea.heartbeat_thread.name == 'elastalert-heartbeat'
+    assert not ea.heartbeat_thread.is_alive()
+    assert ea.handle_heartbeat not in [call[0][0] for call in ea.scheduler.add_job.call_args_list]
+    assert handle_heartbeat.call_count > 2
+    assert ea.writeback_es.delete.call_args[1]['id'] == 'a'
+
+
+def test_handle_signal_removes_heartbeat(ea):
+    ea.cluster_sharding = True
+    ea.instance_id = 'a'
+    with mock.patch('os._exit') as mock_exit, mock.patch('signal.signal') as mock_signal:
+        handle_client_signals(ea)
+        handler = mock_signal.call_args[0][1]
+        handler(signal.SIGTERM, None)
+    assert [call[0][0] for call in mock_signal.call_args_list] == [signal.SIGINT, signal.SIGTERM]
+    assert ea.writeback_es.delete.call_args[1] == {'index': 'wb', 'doc_type': 'elastalert_heartbeat', 'id': 'a'}
+    mock_exit.assert_called_once_with(0)
@@ -67,6 +67,7 @@ class mock_es_client(object):
         self.create = mock.Mock()
         self.index = mock.Mock()
         self.delete = mock.Mock()
+        self.bulk = mock.Mock(return_value={'items': []})
         self.info = mock.Mock(return_value={'status': 200, 'name': 'foo', 'version': {'number': '2.0'}})
         self.ping = mock.Mock(return_value=True)
         self.indices = mock_es_indices_client()
@@ -74,8 +75,10 @@ class mock_es_client(object):
         self.is_atleastfive = mock.Mock(return_value=False)
         self.is_atleastsix = mock.Mock(return_value=False)
         self.is_atleastsixtwo = mock.Mock(return_value=False)
+        self.is_atleastsixthree = mock.Mock(return_value=False)
         self.is_atleastsixsix = mock.Mock(return_value=False)
         self.is_atleastseven = mock.Mock(return_value=False)
+        self.is_atleastseventen = mock.Mock(return_value=False)
         self.resolve_writeback_index = mock.Mock(return_value=writeback_index)
 
 
@@ -89,6 +92,7 @@ class mock_es_sixsix_client(object):
         self.create = mock.Mock()
         self.index = mock.Mock()
         self.delete = mock.Mock()
+        self.bulk = mock.Mock(return_value={'items': []})
         self.info = mock.Mock(return_value={'status': 200, 'name': 'foo', 'version': {'number': '6.6.0'}})
         self.ping = mock.Mock(return_value=True)
         self.indices = mock_es_indices_client()
@@ -96,8 +100,10 @@ class mock_es_sixsix_client(object):
         self.is_atleastfive = mock.Mock(return_value=True)
         self.is_atleastsix = mock.Mock(return_value=True)
         self.is_atleastsixtwo = mock.Mock(return_value=False)
+        self.is_atleastsixthree = mock.Mock(return_value=False)
         self.is_atleastsixsix = mock.Mock(return_value=True)
         self.is_atleastseven = mock.Mock(return_value=False)
+        self.is_atleastseventen = mock.Mock(return_value=False)
 
         def writeback_index_side_effect(index, doc_type):
             if doc_type == 'silence':
@@ -108,6 +114,10 @@ class mock_es_sixsix_client(object):
                 return index + '_status'
             elif doc_type == 'elastalert_error':
                 return index + '_error'
+            elif doc_type == 'elastalert_heartbeat':
+                return index + '_heartbeat'
+            elif doc_type == 'elastalert_checkpoint':
+                return index + '_checkpoint'
             return index
 
         self.resolve_writeback_index = mock.Mock(side_effect=writeback_index_side_effect)
@@ -122,7 +132,7 @@ class mock_rule_loader(object):
 
 
 class mock_ruletype(object):
-    def __init__(self):
+    def __init__(self, rules=None, args=None):
         self.add_data = mock.Mock()
         self.add_count_data = mock.Mock()
         self.add_terms_data = mock.Mock()
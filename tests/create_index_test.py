@@ -7,7 +7,9 @@ import elastalert.create_index
 
 es_mappings = [
     'elastalert',
+    'elastalert_checkpoint',
     'elastalert_error',
+    'elastalert_heartbeat',
     'elastalert_status',
     'past_elastalert',
     'silence'
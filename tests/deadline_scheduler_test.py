@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import datetime
+import threading
+
+import mock
+
+from elastalert.deadline_scheduler import DeadlineScheduler
+
+
+def test_deadline_scheduler_spreads_phases():
+    scheduler = DeadlineScheduler()
+    with mock.patch('elastalert.deadline_scheduler.time.time', return_value=1000):
+        jobs = [scheduler.add_job(mock.Mock(), 'interval', id='rule%s' % i, seconds=60) for i in range(120)]
+    run_times = [job.next_run_time for job in jobs]
+    assert all(1000 <= run_time < 1060 for run_time in run_times)
+    # Every 10 second slice of the interval gets some of the rules
+    assert set(int((run_time - 1000) // 10) for run_time in run_times) == set(range(6))
+
+    # The phase of a rule doesn't change when it is added again
+    with mock.patch('elastalert.deadline_scheduler.time.time', return_value=1000):
+        assert DeadlineScheduler().add_job(mock.Mock(), 'interval', id='rule0', seconds=60).next_run_time == run_times[0]
+
+
+def test_deadline_scheduler_runs_rules_furthest_behind_first():
+    lags = {'a': 0, 'b': 300, 'c': 60}
+    scheduler = DeadlineScheduler(lag_func=lambda job: lags[job.id])
+    for job_id in ['a', 'b', 'c']:
+        scheduler.add_job(mock.Mock(), 'interval', id=job_id, seconds=60, next_run_time=100)
+    scheduler.add_job(mock.Mock(), 'interval', id='later', seconds=60, next_run_time=200)
+    scheduler.pause_job('c')
+
+    assert scheduler.release_jobs(150) == 200
+    assert [scheduler.pop_ready_job().id for _ in range(2)] == ['b', 'a']
+    assert scheduler.pop_ready_job() is None
+
+
+def test_deadline_scheduler_coalesces_missed_runs():
+    scheduler = DeadlineScheduler()
+    job = scheduler.add_job(mock.Mock(), 'interval', args=['rule'], id='a', seconds=10, next_run_time=100)
+    job.running = True
+    scheduler.free_workers -= 1
+    with mock.patch('elastalert.deadline_scheduler.time.time', return_value=135):
+        scheduler.run_job(job, job.version)
+    job.func.assert_called_once_with('rule')
+    assert job.next_run_time == 140
+    assert not job.running
+    assert scheduler.free_workers == scheduler.max_workers
+
+    # A job rescheduled while it ran keeps its new time
+    def pause_rule(rule):
+        job.modify(next_run_time=datetime.datetime.fromtimestamp(500))
+    job.func = pause_rule
+    job.running = True
+    scheduler.run_job(job, job.version)
+    assert job.next_run_time == 500
+
+
+def test_deadline_scheduler_start():
+    scheduler = DeadlineScheduler(max_workers=2)
+    ran = threading.Event()
+    calls = []
+
+    def func():
+        calls.append(1)
+        if len(calls) == 2:
+            ran.set()
+    scheduler.add_job(func, 'interval', id='a', seconds=0.01)
+    scheduler.start()
+    try:
+        assert ran.wait(5)
+    finally:
+        scheduler.shutdown()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import mock
+import pytest
+from elasticsearch.exceptions import ConnectionTimeout
+from elasticsearch.exceptions import TransportError
+
+from elastalert.governor import ConcurrencyGovernor
+from elastalert.governor import get_governor
+from elastalert.governor import GovernedConnection
+from elastalert.governor import parse_retry_after
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('5') == 5
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    assert parse_retry_after('soon') is None
+
+
+def test_governor_aimd():
+    governor = ConcurrencyGovernor(max_limit=8, latency_target=5)
+    with mock.patch('elastalert.governor.time.time', return_value=100):
+        governor.on_response(200, 10)
+        assert governor.limit == 4
+        # Responses to requests sent before the decrease don't decrease the limit again
+        governor.on_response(429, 10)
+        assert governor.limit == 4
+    with mock.patch('elastalert.governor.time.time', return_value=200):
+        governor.on_timeout(20)
+        assert governor.limit == 2
+    for _ in range(2):
+        governor.on_response(200, 1)
+    assert 2.5 < governor.limit < 3
+    for _ in range(100):
+        governor.on_response(200, 1)
+    assert governor.limit == 8
+
+
+def test_governor_limits_requests_in_flight():
+    governor = ConcurrencyGovernor(max_limit=1)
+    governor.acquire()
+    acquired = threading.Event()
+
+    def acquire():
+        governor.acquire()
+        acquired.set()
+    threading.Thread(target=acquire, daemon=True).start()
+    assert not acquired.wait(0.1)
+    governor.release()
+    assert acquired.wait(5)
+
+
+def test_governor_honours_retry_after():
+    governor = ConcurrencyGovernor()
+    with mock.patch('elastalert.governor.time.time', return_value=100):
+        governor.on_response(429, 0.1, retry_after=30)
+    assert governor.blocked_until == 130
+    with mock.patch('elastalert.governor.time.time', side_effect=[110, 130]), \
+            mock.patch.object(governor.condition, 'wait') as wait:
+        governor.acquire()
+    wait.assert_called_once_with(20)
+
+
+def test_get_governor_is_shared_by_host():
+    assert get_governor(('es', 9200, '')) is get_governor(('es', 9200, ''))
+    assert get_governor(('es', 9200, '')) is not get_governor(('other', 9200, ''))
+
+
+def test_governed_connection_retries_rejections():
+    governor = ConcurrencyGovernor()
+    connection = GovernedConnection(governor=governor, max_rejection_retries=2, host='es', port=9200)
+    rejected = TransportError(429, 'es_rejected_execution_exception')
+    with mock.patch('elasticsearch.RequestsHttpConnection.perform_request', side_effect=[rejected, (200, {}, '{}')]) as request:
+        assert connection.perform_request('GET', '/_search') == (200, {}, '{}')
+    assert request.call_count == 2
+    assert governor.in_flight == 0
+
+    with mock.patch('elasticsearch.RequestsHttpConnection.perform_request', side_effect=rejected):
+        with pytest.raises(TransportError):
+            connection.perform_request('GET', '/_search')
+    with mock.patch('elasticsearch.RequestsHttpConnection.perform_request', side_effect=ConnectionTimeout('TIMEOUT', 'timed out', None)):
+        with pytest.raises(ConnectionTimeout):
+            connection.perform_request('GET', '/_search')
+    assert governor.limit == 5
+    assert governor.in_flight == 0
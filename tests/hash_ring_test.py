@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from elastalert.hash_ring import HashRing
+
+
+def test_hash_ring_empty():
+    assert HashRing([]).get('rule') is None
+
+
+def test_hash_ring_spreads_keys():
+    ring = HashRing(['a', 'b', 'c'])
+    owners = [ring.get('rule%s' % i) for i in range(3000)]
+    for member in ['a', 'b', 'c']:
+        assert 700 < owners.count(member) < 1300
+    assert owners == [HashRing(['c', 'b', 'a']).get('rule%s' % i) for i in range(3000)]
+
+
+def test_hash_ring_minimal_churn():
+    keys = ['rule%s' % i for i in range(3000)]
+    ring = HashRing(['a', 'b', 'c'])
+    bigger = HashRing(['a', 'b', 'c', 'd'])
+    for key in keys:
+        # Only keys taken over by the new member move
+        assert bigger.get(key) in (ring.get(key), 'd')
+
+    smaller = HashRing(['a', 'c'])
+    for key in keys:
+        if ring.get(key) != 'b':
+            assert smaller.get(key) == ring.get(key)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import mock
+from elasticsearch.exceptions import TransportError
+
+from elastalert.index_catalog import IndexCatalog
+from elastalert.util import ts_to_dt
+
+
+def test_index_catalog_refresh():
+    es = mock.Mock()
+    es.cat.indices.return_value = [{'index': 'logstash-2015.01.02'}]
+    catalog = IndexCatalog(refresh_interval=60)
+    now = ts_to_dt('2015-01-02T00:00:00Z')
+
+    with mock.patch('elastalert.index_catalog.ts_now', return_value=now):
+        entry = catalog.get(es, 'cluster', 'logstash-*')
+        assert entry.indices == {'logstash-2015.01.02'}
+        assert entry.refreshed_at == now
+        assert catalog.get(es, 'cluster', 'logstash-*') is entry
+        # Each cluster has its own catalog
+        catalog.get(es, 'other', 'logstash-*')
+    assert es.cat.indices.call_count == 2
+
+    es.cat.indices.return_value = [{'index': 'logstash-2015.01.02'}, {'index': 'logstash-2015.01.03'}]
+    with mock.patch('elastalert.index_catalog.ts_now', return_value=now + datetime.timedelta(seconds=61)):
+        entry = catalog.get(es, 'cluster', 'logstash-*')
+    assert entry.indices == {'logstash-2015.01.02', 'logstash-2015.01.03'}
+    assert es.cat.indices.call_count == 3
+
+
+def test_index_catalog_error():
+    es = mock.Mock()
+    es.cat.indices.side_effect = TransportError(500, 'error')
+    catalog = IndexCatalog(refresh_interval=60)
+
+    assert catalog.get(es, 'cluster', 'logstash-*') is None
+
+    # A stale catalog is used until the indices can be listed again
+    es.cat.indices.side_effect = None
+    es.cat.indices.return_value = [{'index': 'logstash-2015.01.02'}]
+    with mock.patch('elastalert.index_catalog.ts_now', return_value=ts_to_dt('2015-01-02T00:00:00Z')):
+        entry = catalog.get(es, 'cluster', 'logstash-*')
+    es.cat.indices.side_effect = TransportError(500, 'error')
+    assert catalog.get(es, 'cluster', 'logstash-*') is entry
@@ -235,6 +235,40 @@ def test_load_rules():
                 assert rules['rules'][0]['include'].count('comparekey') == 1
 
 
+def test_load_rules_startup_threads():
+    test_config_copy = copy.deepcopy(test_config)
+    test_config_copy['startup_threads'] = 4
+    rule_files = ['rule%d.yaml' % i for i in range(10)]
+
+    def load_configuration(rule_file, conf, args=None):
+        return {'name': rule_file[:-5], 'rule_file': rule_file}
+
+    rules_loader = FileRulesLoader(test_config_copy)
+    with mock.patch.object(rules_loader, 'get_names', return_value=rule_files):
+        with mock.patch.object(rules_loader, 'load_configuration', side_effect=load_configuration):
+            rules = rules_loader.load(test_config_copy)
+    assert [rule['rule_file'] for rule in rules] == rule_files
+
+    # Duplicates are still found
+    with mock.patch.object(rules_loader, 'get_names', return_value=rule_files):
+        with mock.patch.object(rules_loader, 'load_configuration', return_value={'name': 'duplicate'}):
+            with pytest.raises(EAException) as e:
+                rules_loader.load(test_config_copy)
+    assert 'Error loading file rule1.yaml: Duplicate rule named duplicate' in str(e.value)
+
+
+def test_load_rules_rule_filter():
+    rule_files = ['rule%d.yaml' % i for i in range(4)]
+    rules_loader = FileRulesLoader(test_config)
+    with mock.patch.object(rules_loader, 'get_names', return_value=rule_files):
+        with mock.patch.object(rules_loader, 'load_configuration',
+                               side_effect=lambda rule_file, conf, args=None: {'name': rule_file, 'rule_file': rule_file}) as mock_load:
+            rules = rules_loader.load(test_config, rule_filter=lambda rule_file: rule_file in ('rule1.yaml', 'rule3.yaml'))
+    # Filtered out files are not loaded at all
+    assert [call[0][0] for call in mock_load.call_args_list] == ['rule1.yaml', 'rule3.yaml']
+    assert [rule['rule_file'] for rule in rules] == ['rule1.yaml', 'rule3.yaml']
+
+
 def test_load_default_host_port():
     test_rule_copy = copy.deepcopy(test_rule)
     test_rule_copy.pop('es_host')
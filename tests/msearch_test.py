@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import mock
+import pytest
+from elasticsearch.exceptions import TransportError
+
+from elastalert.msearch import MultiSearchBatcher
+from elastalert.msearch import PendingSearch
+
+
+def test_msearch_batcher_single_search():
+    es = mock.Mock()
+    es.msearch.return_value = {'responses': [{'hits': {'total': 1, 'hits': [{'_id': '1'}]}}]}
+    batcher = MultiSearchBatcher(es, max_batch_size=10, batch_window=0)
+
+    res = batcher.search('idx', {'query': {'match_all': {}}}, ignore_unavailable=True)
+
+    assert res == {'hits': {'total': 1, 'hits': [{'_id': '1'}]}}
+    es.msearch.assert_called_once_with(body=[{'index': 'idx', 'ignore_unavailable': True},
+                                             {'query': {'match_all': {}}}])
+
+
+def test_msearch_batcher_coalesces_concurrent_searches():
+    es = mock.Mock()
+    es.msearch.side_effect = lambda body: {'responses': [{'index': header['index']} for header in body[::2]]}
+    batcher = MultiSearchBatcher(es, max_batch_size=3, batch_window=10)
+    results = {}
+
+    def run(index):
+        results[index] = batcher.search(index, {})
+
+    threads = [threading.Thread(target=run, args=('idx%s' % i,)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    # The batch is sent as soon as it is full, without waiting for the window
+    assert es.msearch.call_count == 1
+    assert results == {'idx0': {'index': 'idx0'}, 'idx1': {'index': 'idx1'}, 'idx2': {'index': 'idx2'}}
+
+
+def test_msearch_batcher_filter_path():
+    es = mock.Mock()
+    es.msearch.side_effect = lambda body, **kwargs: {'responses': [{} for header in body[::2]]}
+    batcher = MultiSearchBatcher(es, batch_window=0)
+
+    batcher.search('idx', {}, filter_path=['hits.total'])
+    assert es.msearch.call_args[1]['filter_path'] == ['responses.hits.total', 'responses.error', 'responses.status']
+
+    # A filter_path which not every search of the batch has is left out
+    pending = [PendingSearch({'index': 'idx'}, {}, ['hits.total']), PendingSearch({'index': 'idx'}, {})]
+    batcher.send(pending)
+    assert 'filter_path' not in es.msearch.call_args[1]
+
+
+def test_msearch_batcher_errors():
+    es = mock.Mock()
+    es.msearch.return_value = {'responses': [{'error': {'type': 'index_not_found_exception'}, 'status': 404}]}
+    batcher = MultiSearchBatcher(es, batch_window=0)
+    with pytest.raises(TransportError) as e:
+        batcher.search('idx', {})
+    assert e.value.status_code == 404
+
+    es.msearch.side_effect = TransportError(500, 'Internal error')
+    with pytest.raises(TransportError):
+        batcher.search('idx', {})
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+
+from elastalert.query_plan import ENDTIME_PLACEHOLDER
+from elastalert.query_plan import QueryTemplate
+from elastalert.query_plan import STARTTIME_PLACEHOLDER
+from elastalert.util import dt_to_ts
+from elastalert.util import dt_to_unix
+
+
+START = datetime.datetime(2014, 9, 26, 12, 0, tzinfo=datetime.timezone.utc)
+END = datetime.datetime(2014, 9, 26, 13, 0, tzinfo=datetime.timezone.utc)
+
+
+def test_query_template_render():
+    query = {'query': {'bool': {'filter': {'bool': {'must': [
+        {'range': {'@timestamp': {'gt': STARTTIME_PLACEHOLDER, 'lte': ENDTIME_PLACEHOLDER}}},
+        {'term': {'user': 'qlo'}}]}}}},
+        'sort': [{'@timestamp': {'order': 'asc'}}]}
+    template = QueryTemplate(query, dt_to_ts)
+
+    body = json.loads(template.render(START, END))
+
+    assert body['query']['bool']['filter']['bool']['must'] == [
+        {'range': {'@timestamp': {'gt': dt_to_ts(START), 'lte': dt_to_ts(END)}}},
+        {'term': {'user': 'qlo'}}]
+    assert body['sort'] == [{'@timestamp': {'order': 'asc'}}]
+
+
+def test_query_template_render_numeric_timestamps():
+    query = {'range': {'@timestamp': {'gt': STARTTIME_PLACEHOLDER, 'lte': ENDTIME_PLACEHOLDER}}}
+    template = QueryTemplate(query, dt_to_unix)
+
+    assert json.loads(template.render(START, END)) == {'range': {'@timestamp': {'gt': dt_to_unix(START), 'lte': dt_to_unix(END)}}}
+    # Rendering does not modify the template
+    assert json.loads(template.render(END, END)) == {'range': {'@timestamp': {'gt': dt_to_unix(END), 'lte': dt_to_unix(END)}}}
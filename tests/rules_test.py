@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import copy
 import datetime
+import threading
+import time
 
 import mock
 import pytest
@@ -617,6 +619,71 @@ def test_new_term():
     assert rule.matches[0]['missing_field'] == 'b'
 
 
+def test_new_term_background_warmup():
+    rules = {'fields': ['a'],
+             'timestamp_field': '@timestamp',
+             'es_host': 'example.com', 'es_port': 10, 'index': 'logstash',
+             'ts_to_dt': ts_to_dt, 'dt_to_ts': dt_to_ts,
+             'terms_background_warmup': True}
+    mock_res = {'aggregations': {'filtered': {'values': {'buckets': [{'key': 'key1', 'doc_count': 1}]}}}}
+    searching = threading.Event()
+    resume = threading.Event()
+
+    def search(*args, **kwargs):
+        searching.set()
+        resume.wait(5)
+        return mock_res
+
+    with mock.patch('elastalert.ruletypes.elasticsearch_client') as mock_es:
+        mock_es.return_value.search.side_effect = search
+        mock_es.return_value.info.return_value = {'version': {'number': '2.x.x'}}
+        rule = NewTermsRule(rules)
+        assert searching.wait(5)
+
+        # Data is held back while the existing terms are collected
+        assert rule.warming
+        assert rule.warmup_progress == 0
+        rule.add_data([{'@timestamp': ts_now(), 'a': 'key1'}, {'@timestamp': ts_now(), 'a': 'key2'}])
+        rule.garbage_collect(ts_now())
+        assert rule.matches == []
+
+        resume.set()
+        for _ in range(50):
+            if not rule.warming:
+                break
+            time.sleep(0.1)
+    assert rule.warmup_progress == 1
+    assert mock_es.return_value.search.call_count == 30
+
+    # Only key2 is new
+    rule.garbage_collect(ts_now())
+    assert len(rule.matches) == 1
+    assert rule.matches[0]['a'] == 'key2'
+
+    # If the background collection failed, the existing terms are collected when the rule runs
+    rule.matches = []
+    rule.warmup_error = Exception('error')
+    with mock.patch('elastalert.ruletypes.elasticsearch_client') as mock_es:
+        mock_es.return_value.search.side_effect = Exception('error')
+        mock_es.return_value.info.return_value = {'version': {'number': '2.x.x'}}
+        with pytest.raises(EAException):
+            rule.add_data([{'@timestamp': ts_now(), 'a': 'key3'}])
+        # Data is still held back while they cannot be collected, at most terms_warmup_buffer_size batches of it
+        rule.warmup_buffer_size = 2
+        for key in ('key4', 'key5'):
+            with pytest.raises(EAException):
+                rule.add_data([{'@timestamp': ts_now(), 'a': key}])
+        assert len(rule.warmup_buffer) == 2
+        assert rule.matches == []
+
+        mock_es.return_value.search.side_effect = None
+        mock_es.return_value.search.return_value = mock_res
+        rule.garbage_collect(ts_now())
+    assert rule.warmup_error is None
+    assert not rule.warmup_buffer
+    assert sorted(match['a'] for match in rule.matches) == ['key4', 'key5']
+
+
 def test_new_term_nested_field():
 
     rules = {'fields': ['a', 'b.c'],
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import datetime
+import decimal
+import json
+
+import mock
+import pytest
+from elasticsearch.exceptions import ImproperlyConfigured
+
+from elastalert import serializer
+from elastalert.alerts import DateTimeEncoder
+from elastalert.serializer import get_serializer
+from elastalert.serializer import OrjsonSerializer
+from elastalert.serializer import StdlibSerializer
+
+
+DOC = {
+    '@timestamp': datetime.datetime(2021, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc),
+    'day': datetime.date(2021, 1, 2),
+    'price': decimal.Decimal('1.5'),
+    'name': 'é',
+    'nested': {'values': [1, 2]},
+}
+
+
+@pytest.mark.parametrize('name', ['json', 'orjson'])
+def test_serializer_round_trip(name):
+    if name == 'orjson':
+        pytest.importorskip('orjson')
+    es_serializer = get_serializer(name)
+    body = es_serializer.dumps(DOC)
+
+    assert es_serializer.loads(body) == {
+        '@timestamp': '2021-01-02T03:04:05+00:00',
+        'day': '2021-01-02',
+        'price': 1.5,
+        'name': 'é',
+        'nested': {'values': [1, 2]},
+    }
+    # Bodies which are already serialized are sent as they are
+    assert es_serializer.dumps(body) is body
+
+
+def test_orjson_serializer_falls_back_to_json():
+    pytest.importorskip('orjson')
+    big = {'value': 2 ** 70}
+    body = OrjsonSerializer().dumps(big)
+    assert json.loads(body) == big
+
+
+def test_get_serializer():
+    with mock.patch.object(serializer, 'orjson', mock.Mock()):
+        # orjson is only used when it is asked for
+        assert isinstance(get_serializer(), StdlibSerializer)
+        assert isinstance(get_serializer(None), StdlibSerializer)
+        assert isinstance(get_serializer('orjson'), OrjsonSerializer)
+    assert isinstance(get_serializer('json'), StdlibSerializer)
+    with mock.patch.object(serializer, 'orjson', None):
+        with pytest.raises(ImproperlyConfigured):
+            get_serializer('orjson')
+    with pytest.raises(ImproperlyConfigured):
+        get_serializer('ujson')
+
+
+def test_datetime_encoder():
+    assert json.loads(json.dumps(DOC, cls=DateTimeEncoder))['@timestamp'] == '2021-01-02T03:04:05+00:00'
+    with pytest.raises(TypeError):
+        json.dumps({'value': object()}, cls=DateTimeEncoder)
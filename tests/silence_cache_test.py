@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from elastalert.silence_cache import SilenceCache
+from elastalert.util import ts_now
+
+
+def test_silence_cache_bounded():
+    cache = SilenceCache(max_size=2)
+    until = ts_now() + datetime.timedelta(hours=1)
+    cache['a'] = (until, 0)
+    cache['b'] = (until, 0)
+    cache['a'] = (until, 1)
+    cache['c'] = (until, 0)
+    # b was set least recently
+    assert sorted(cache) == ['a', 'c']
+    assert cache['a'] == (until, 1)
+    assert cache.dropped_active
+
+
+def test_silence_cache_drops_ended_first():
+    cache = SilenceCache(max_size=2)
+    now = ts_now()
+    cache['long'] = (now + datetime.timedelta(days=7), 0)
+    cache['ended'] = (now - datetime.timedelta(minutes=5), 1)
+    cache['new'] = (now + datetime.timedelta(hours=1), 0)
+    assert sorted(cache) == ['long', 'new']
+    assert not cache.dropped_active
+
+
+def test_silence_cache_update_silence():
+    cache = SilenceCache()
+    now = ts_now()
+    cache.update_silence('a', now + datetime.timedelta(hours=1), 2)
+    cache.update_silence('a', now, 0)
+    assert cache['a'] == (now + datetime.timedelta(hours=1), 2)
+    cache.update_silence('a', now + datetime.timedelta(hours=2), 3)
+    assert cache['a'] == (now + datetime.timedelta(hours=2), 3)
+
+
+def test_silence_cache_expire():
+    cache = SilenceCache(ttl=datetime.timedelta(hours=1))
+    now = ts_now()
+    cache['active'] = (now + datetime.timedelta(minutes=5), 0)
+    cache['ended'] = (now - datetime.timedelta(minutes=5), 1)
+    cache['expired'] = (now - datetime.timedelta(hours=2), 1)
+    assert cache.expire() == 1
+    assert sorted(cache) == ['active', 'ended']
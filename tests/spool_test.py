@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import os
+
+from elastalert.spool import Spool
+
+
+def test_spool_append_and_drain(tmpdir):
+    spool = Spool(str(tmpdir), segment_size=30)
+    for i in range(5):
+        spool.append(b'record %d' % i)
+    written = []
+
+    def write(records):
+        written.append(records)
+        return True
+    assert spool.drain(write) == 3
+    assert [record for records in written for record in records] == [b'record %d' % i for i in range(5)]
+    assert os.listdir(str(tmpdir)) == []
+    assert spool.drain(write) == 0
+
+
+def test_spool_keeps_segments_until_written(tmpdir):
+    spool = Spool(str(tmpdir), segment_size=30)
+    for i in range(4):
+        spool.append(b'record %d' % i)
+    assert spool.drain(lambda records: False) == 0
+    spool.close()
+
+    # The segments are read back after a restart
+    spool = Spool(str(tmpdir), segment_size=30)
+    spool.append(b'record 4')
+    written = []
+    assert spool.drain(lambda records: written.extend(records) or True) == 3
+    assert written == [b'record %d' % i for i in range(5)]
+
+
+def test_spool_stops_at_corrupt_record(tmpdir):
+    spool = Spool(str(tmpdir))
+    spool.append(b'first')
+    spool.append(b'second')
+    spool.close()
+    path = spool.get_path(1)
+    with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b'X')
+    assert spool.read_segment(1) == [b'first']
+
+
+def test_spool_evicts_oldest_segments(tmpdir):
+    spool = Spool(str(tmpdir), segment_size=20, max_size=60)
+    for i in range(10):
+        spool.append(b'record %d' % i)
+    assert spool.size <= 60
+    written = []
+    spool.drain(lambda records: written.extend(records) or True)
+    assert written[-1] == b'record 9'
+    assert b'record 0' not in written
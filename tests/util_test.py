@@ -6,13 +6,20 @@ import mock
 import pytest
 from dateutil.parser import parse as dt
 
+from elastalert import ElasticSearchClient
 from elastalert.util import add_raw_postfix
 from elastalert.util import dt_to_ts_with_format
+from elastalert.util import elasticsearch_client
+from elastalert.util import es_client_registry
+from elastalert.util import get_es_client_key
+from elastalert.util import build_es_conn_config
 from elastalert.util import flatten_dict
+from elastalert.util import coarsen_index
 from elastalert.util import format_index
 from elastalert.util import lookup_es_key
 from elastalert.util import parse_deadline
 from elastalert.util import parse_duration
+from elastalert.util import prune_es_client_registry
 from elastalert.util import pytzfy
 from elastalert.util import replace_dots_in_field_names
 from elastalert.util import resolve_string
@@ -220,6 +227,19 @@ def test_format_index():
     assert sorted(format_index(pattern2, date, date2, True).split(',')) == ['logstash-2018.25', 'logstash-2018.26']
 
 
+def test_coarsen_index():
+    pattern = 'logstash-%Y.%m.%d'
+    start = dt('2018-12-30T12:00:00Z')
+    end = dt('2019-02-02T12:00:00Z')
+    indices = ['logstash-2018.12.29', 'logstash-2018.12.30', 'logstash-2019.01.15', 'logstash-2019.02.01']
+    # Indices outside of the time range are kept
+    assert coarsen_index(pattern, indices, start, end, 4) == 'logstash-2018.12.*,logstash-2018.12.29,logstash-2019.01.*,logstash-2019.02.*'
+    assert coarsen_index(pattern, indices[1:], start, end, 3) == 'logstash-2018.12.*,logstash-2019.01.*,logstash-2019.02.*'
+    assert coarsen_index(pattern, indices[1:], start, end, 2) == 'logstash-2018.*,logstash-2019.*'
+    assert coarsen_index(pattern, indices[1:], start, end, 1) is None
+    assert coarsen_index('logstash-%Y.%W', ['logstash-2019.01', 'logstash-2019.02'], start, end, 1) == 'logstash-2019.*'
+
+
 def test_should_scrolling_continue():
     rule_no_max_scrolling = {'max_scrolling_count': 0, 'scrolling_cycle': 1}
     rule_reached_max_scrolling = {'max_scrolling_count': 2, 'scrolling_cycle': 2}
@@ -251,3 +271,48 @@ def test_flatten_dict():
 def test_pytzfy():
     assert pytzfy(dt('2021-02-01 12:30:00+00:00')) == dt('2021-02-01 12:30:00+00:00')
     assert pytzfy(datetime(2018, 12, 31, 5, 0, 30, 1000)) == dt('2018-12-31 05:00:30.001000')
+
+
+def test_get_es_client_key():
+    key = get_es_client_key(build_es_conn_config({'es_host': 'ES.example.com', 'es_port': 9200}))
+    assert key == get_es_client_key(build_es_conn_config({'es_host': ' es.example.com', 'es_port': 9200, 'name': 'rule'}))
+    assert key != get_es_client_key(build_es_conn_config({'es_host': 'es.example.com', 'es_port': 9201}))
+    assert key != get_es_client_key(build_es_conn_config({'es_host': 'es.example.com', 'es_port': 9200,
+                                                          'es_username': 'user', 'es_password': 'pass'}))
+
+
+def test_es_client_registry():
+    es_client_registry.clear()
+    rule1 = {'es_host': 'es', 'es_port': 9200, 'name': 'rule1', 'es_client_registry': True}
+    rule2 = {'es_host': 'es', 'es_port': 9200, 'name': 'rule2', 'es_client_registry': True}
+    rule3 = {'es_host': 'other', 'es_port': 9200, 'name': 'rule3', 'es_client_registry': True}
+    with mock.patch('elastalert.util.create_elasticsearch_client', side_effect=lambda conf: mock.Mock()) as create:
+        client = elasticsearch_client(rule1)
+        assert elasticsearch_client(rule2) is client
+        assert elasticsearch_client(rule3) is not client
+        assert create.call_count == 2
+        assert create.call_args[0][0]['es_pool_maxsize'] == 10
+
+        # Without the registry, every call creates a client
+        elasticsearch_client({'es_host': 'es', 'es_port': 9200})
+        assert create.call_count == 3
+
+    prune_es_client_registry([rule1])
+    assert list(es_client_registry.values()) == [client]
+    prune_es_client_registry([])
+    assert es_client_registry == {}
+
+
+def test_es_version_cached_per_cluster():
+    ElasticSearchClient.es_versions.clear()
+    conf = build_es_conn_config({'es_host': 'es.example.com', 'es_port': 9200})
+    conf['http_auth'] = None
+    info = {'version': {'number': '7.10.0'}}
+    with mock.patch.object(ElasticSearchClient, 'info', return_value=info) as mock_info:
+        assert ElasticSearchClient(conf).is_atleastseventen()
+        assert ElasticSearchClient(dict(conf, es_host='ES.example.com')).es_version == '7.10.0'
+        assert mock_info.call_count == 1
+
+        ElasticSearchClient(dict(conf, es_port=9201)).es_version
+        assert mock_info.call_count == 2
+    ElasticSearchClient.es_versions.clear()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import mock
+
+from elastalert.worker_pool import rule_worker
+from elastalert.worker_pool import WorkerPool
+
+
+def make_pool(worker_processes=2):
+    rules_loader = mock.Mock()
+    rules_loader.get_hashes.return_value = {'rules/a.yaml': 'A'}
+    conf = {'rules_loader': rules_loader, 'worker_processes': worker_processes,
+            'run_every': datetime.timedelta(minutes=1)}
+    parsed_args = mock.Mock(rule=None, pin_rules=False, prometheus_port=None, debug=False)
+    return WorkerPool(mock.Mock(), ['--config', 'config.yaml'], parsed_args, conf)
+
+
+def test_rule_worker():
+    rule_files = ['rules/rule%s.yaml' % i for i in range(100)]
+    workers = [rule_worker(rule_file, 4) for rule_file in rule_files]
+    assert workers == [rule_worker(rule_file, 4) for rule_file in rule_files]
+    assert set(workers) == {0, 1, 2, 3}
+
+
+def test_worker_pool_rule_changes():
+    pool = make_pool()
+    pool.queues = [mock.Mock(), mock.Mock()]
+    pool.rule_hashes = {'rules/a.yaml': 'A'}
+
+    pool.check_rule_changes()
+    assert not pool.queues[0].put.called
+
+    new_hashes = {'rules/a.yaml': 'B', 'rules/b.yaml': 'C'}
+    pool.rules_loader.get_hashes.return_value = new_hashes
+    pool.check_rule_changes()
+    for queue in pool.queues:
+        queue.put.assert_called_once_with(new_hashes)
+
+
+def test_worker_pool_restarts_exited_workers():
+    pool = make_pool()
+    pool.workers = [mock.Mock(), mock.Mock()]
+    pool.workers[0].is_alive.return_value = True
+    pool.workers[1].is_alive.return_value = False
+    pool.started_at = [0, 100]
+
+    # A worker which exits right after it was started is restarted after restart_delay
+    with mock.patch('elastalert.worker_pool.time.time', return_value=104), \
+            mock.patch.object(pool, 'start_worker') as start_worker:
+        assert pool.handle_exited_workers() == 6
+        assert not start_worker.called
+    with mock.patch('elastalert.worker_pool.time.time', return_value=110), \
+            mock.patch.object(pool, 'start_worker') as start_worker:
+        assert pool.handle_exited_workers() is None
+        start_worker.assert_called_once_with(1)
+
+
+def test_worker_pool_stop():
+    pool = make_pool()
+    pool.workers = [mock.Mock(), mock.Mock()]
+    pool.workers[0].is_alive.return_value = True
+    pool.workers[1].is_alive.return_value = False
+    pool.running = True
+
+    pool.stop()
+
+    assert not pool.running
+    assert pool.workers[0].terminate.called
+    assert not pool.workers[1].terminate.called
+    assert pool.workers[0].join.called and pool.workers[1].join.called
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+
+import mock
+from elasticsearch.exceptions import ConnectionError
+
+from elastalert.spool import Spool
+from elastalert.writeback_buffer import WritebackBuffer
+
+
+def bulk_docs(call):
+    """ Returns the (_id, body) of the documents written by a bulk call. """
+    body = call[1]['body']
+    return [(action['index']['_id'], doc) for action, doc in zip(body[::2], body[1::2])]
+
+
+def test_writeback_buffer_flushes_by_index():
+    es = mock.Mock()
+    es.is_atleastsixtwo.return_value = True
+    es.bulk.return_value = {'items': []}
+    buffer = WritebackBuffer(es, bulk_size=100, flush_interval=60)
+    buffer.add('wb_status', 'elastalert_status', 'a', {'rule_name': 'a'})
+    buffer.add('wb', 'elastalert', 'b', {'rule_name': 'b'})
+    buffer.add('wb_status', 'elastalert_status', 'c', {'rule_name': 'c'})
+    assert not es.bulk.called
+
+    buffer.shutdown()
+    assert es.bulk.call_count == 2
+    calls = {call[1]['index']: bulk_docs(call) for call in es.bulk.call_args_list}
+    assert calls == {'wb_status': [('a', {'rule_name': 'a'}), ('c', {'rule_name': 'c'})],
+                     'wb': [('b', {'rule_name': 'b'})]}
+    assert '_type' not in es.bulk.call_args[1]['body'][0]['index']
+
+
+def test_writeback_buffer_flushes_when_full():
+    es = mock.Mock()
+    es.is_atleastsixtwo.return_value = False
+    es.bulk.return_value = {'items': []}
+    buffer = WritebackBuffer(es, bulk_size=2, flush_interval=60)
+    buffer.add('wb', 'elastalert', 'a', {})
+    buffer.add('wb', 'elastalert', 'b', {})
+    for _ in range(50):
+        if es.bulk.called:
+            break
+        buffer.thread.join(0.1)
+    assert [doc_id for doc_id, _ in bulk_docs(es.bulk.call_args)] == ['a', 'b']
+    assert es.bulk.call_args[1]['body'][0]['index']['_type'] == 'elastalert'
+    buffer.shutdown()
+
+
+@mock.patch('time.sleep')
+def test_writeback_buffer_retries(mock_sleep):
+    es = mock.Mock()
+    es.is_atleastsixtwo.return_value = True
+    es.bulk.side_effect = [
+        ConnectionError('N/A', 'error', None),
+        {'items': [{'index': {'status': 201}}, {'index': {'status': 429, 'error': 'rejected'}},
+                   {'index': {'status': 400, 'error': 'mapper_parsing_exception'}}]},
+        {'items': [{'index': {'status': 201}}]},
+    ]
+    buffer = WritebackBuffer(es, bulk_size=100, flush_interval=60, max_retries=3)
+    buffer.add('wb', 'elastalert', 'a', {})
+    buffer.add('wb', 'elastalert', 'b', {})
+    buffer.add('wb', 'elastalert', 'c', {})
+    buffer.shutdown()
+
+    # Only the rejected document is sent again
+    assert es.bulk.call_count == 3
+    assert [doc_id for doc_id, _ in bulk_docs(es.bulk.call_args_list[1])] == ['a', 'b', 'c']
+    assert [doc_id for doc_id, _ in bulk_docs(es.bulk.call_args_list[2])] == ['b']
+
+
+@mock.patch('time.sleep')
+def test_writeback_buffer_spool(mock_sleep, tmpdir):
+    es = mock.Mock()
+    es.is_atleastsixtwo.return_value = True
+    es.bulk.side_effect = ConnectionError('N/A', 'error', None)
+    buffer = WritebackBuffer(es, flush_interval=60, max_retries=0, spool=Spool(str(tmpdir)))
+    buffer.add('wb_status', 'elastalert_status', 'a', {'rule_name': 'a', '@timestamp': datetime.datetime(2021, 1, 1)})
+    buffer.add('wb', 'elastalert', 'b', {'rule_name': 'b'})
+    buffer.shutdown()
+    assert es.bulk.call_count == 2
+
+    # The documents are written once Elasticsearch is back, also after a restart
+    es.bulk.side_effect = None
+    es.bulk.return_value = {'items': []}
+    buffer = WritebackBuffer(es, flush_interval=60, spool=Spool(str(tmpdir)))
+    buffer.shutdown()
+    calls = {call[1]['index']: bulk_docs(call) for call in es.bulk.call_args_list[2:]}
+    assert calls == {'wb_status': [('a', {'rule_name': 'a', '@timestamp': '2021-01-01T00:00:00'})],
+                     'wb': [('b', {'rule_name': 'b'})]}
+    assert os.listdir(str(tmpdir)) == []